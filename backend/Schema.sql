@@ -88,4 +88,49 @@ CREATE TABLE IF NOT EXISTS "transactions" (
 	FOREIGN KEY("document_id") REFERENCES "documents"("id"),
 	FOREIGN KEY("tax_items_id") REFERENCES "tax_items"("id")
 );
+CREATE INDEX IF NOT EXISTS "idx_transactions_taxpayer_year_sort" ON "transactions" ("taxpayer_id", "year", "transaction_date" DESC, "source_id", "id" DESC);
+CREATE INDEX IF NOT EXISTS "idx_transactions_taxpayer_sort" ON "transactions" ("taxpayer_id", "transaction_date" DESC, "source_id", "id" DESC);
+CREATE INDEX IF NOT EXISTS "idx_transactions_year_sort" ON "transactions" ("year", "transaction_date" DESC, "source_id", "id" DESC);
+CREATE INDEX IF NOT EXISTS "idx_transactions_month_sort" ON "transactions" ("month", "transaction_date" DESC, "source_id", "id" DESC);
+CREATE INDEX IF NOT EXISTS "idx_transactions_source" ON "transactions" ("source_id", "year");
+CREATE INDEX IF NOT EXISTS "idx_transactions_tax_item" ON "transactions" ("tax_items_id", "year");
+CREATE INDEX IF NOT EXISTS "idx_transactions_sort" ON "transactions" ("transaction_date" DESC, "source_id", "id" DESC);
+CREATE INDEX IF NOT EXISTS "idx_declarations_taxpayer_year" ON "declarations" ("taxpayer_id", "year");
+CREATE TABLE IF NOT EXISTS "transaction_rollup" (
+	"taxpayer_id"	INTEGER NOT NULL,
+	"year"	INTEGER NOT NULL,
+	"month"	INTEGER NOT NULL,
+	"source_id"	INTEGER NOT NULL,
+	"tax_items_id"	INTEGER NOT NULL,
+	"type"	INTEGER NOT NULL,
+	"is_taxable"	INTEGER NOT NULL,
+	"amount"	REAL NOT NULL DEFAULT 0,
+	"count"	INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY("taxpayer_id","year","month","source_id","tax_items_id","type","is_taxable")
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS "archived_years" (
+	"taxpayer_id"	INTEGER NOT NULL,
+	"year"	INTEGER NOT NULL,
+	"file"	TEXT NOT NULL,
+	"rows"	INTEGER NOT NULL,
+	"amount"	REAL NOT NULL,
+	"archived_at"	DATETIME DEFAULT CURRENT_TIMESTAMP,
+	PRIMARY KEY("taxpayer_id","year")
+);
+CREATE TABLE IF NOT EXISTS "data_versions" (
+	"entity"	TEXT NOT NULL,
+	"version"	INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY("entity")
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS "data_scope_versions" (
+	"entity"	TEXT NOT NULL,
+	"taxpayer_id"	INTEGER NOT NULL,
+	"year"	INTEGER NOT NULL,
+	"version"	INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY("entity","taxpayer_id","year")
+) WITHOUT ROWID;
+CREATE VIRTUAL TABLE IF NOT EXISTS "transaction_search" USING fts5(
+	"description", "source_name", "tax_item_name", "doc_name", "doc_ref",
+	tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+);
 COMMIT;
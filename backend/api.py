@@ -1,14 +1,35 @@
-from fastapi import FastAPI, HTTPException, Query
+import time
+# Modül import süresinin başlangıcı (GET /stats/startup); diğer importlardan önce alınır
+IMPORT_STARTED = time.perf_counter()
+
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, model_validator
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, TypeAdapter, ValidationError, model_validator
 from datetime import date
-from typing import List, Optional, Dict, Any
-import uvicorn
-
+from typing import Annotated, List, Optional, Dict, Any
+from contextlib import asynccontextmanager
+import codecs
+import csv
+import json
+
+from compression import CompressionMiddleware, available_encodings
+from declaration_run import DeclarationJobs, DeclarationRun
 # core.py içerisindeki mevcut servisleri kullanıyoruz
-from core import Database, TaxpayerService, SourceService, TransactionService, PaymentMethodService, DocumentService, DeclarationService, TaxSettingService, TaxItemService, Transaction, Document, Declaration, TaxSetting, Taxpayer, Source, PaymentMethod, TaxItem
+from core import BROTLI_QUALITY, COMPRESSION, COMPRESSION_MIN_SIZE, GZIP_LEVEL, HTTP_IMMUTABLE_MAX_AGE, MAX_PAGE_SIZE, METRICS_ENABLED, SLOW_QUERY_LOG, Database, ServiceContainer, dump_json, TaxpayerService, SourceService, TransactionService, PaymentMethodService, DocumentService, DeclarationService, TaxSettingService, TaxItemService, Transaction, Document, Declaration, TaxSetting, Taxpayer, Source, PaymentMethod, TaxItem
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Eksik tabloları ve şema migration'larını (indexler vb.) uygula
+    started = time.perf_counter()
+    services.db.init_db()
+    startup["init_db_ms"] = round((time.perf_counter() - started) * 1000, 3)
+    startup["ready_ms"] = round((time.perf_counter() - IMPORT_STARTED) * 1000, 3)
+    yield
+    # Uygulama kapanırken havuzdaki bağlantıları serbest bırak
+    services.close()
 
-app = FastAPI(title="mTax API", version="2.0.0")
+app = FastAPI(title="mTax API", version="2.0.0", lifespan=lifespan)
 
 # Angular (genelde 4200 portu) için CORS ayarı
 app.add_middleware(
@@ -19,16 +40,45 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Servisleri başlatalım
-db = Database()
-tp_service = TaxpayerService(db)
-src_service = SourceService(db)
-tx_service = TransactionService(db)
-pm_service = PaymentMethodService(db)
-doc_service = DocumentService(db)
-dec_service = DeclarationService(db)
-ts_service = TaxSettingService(db)
-ti_service = TaxItemService(db)
+# COMPRESSION_MIN_SIZE baytın üzerindeki yanıtlar brotli (kuruluysa) veya gzip ile sıkıştırılır
+if available_encodings(COMPRESSION):
+    app.add_middleware(CompressionMiddleware, encodings=available_encodings(COMPRESSION), minimum_size=COMPRESSION_MIN_SIZE,
+                       gzip_level=GZIP_LEVEL, brotli_quality=BROTLI_QUALITY)
+
+# Veritabanı ve servisler import sırasında değil, ilk kullanıldıklarında kurulur (soğuk başlangıç).
+# Endpointler onları FastAPI dependency'leri olarak alır. Servis metotları bloklayan sqlite3 çağrıları yapar;
+# endpointler bunları event loop'u tıkamadan `await db.run(...)` ile DB_MAX_CONCURRENCY boyutlu thread havuzunda çalıştırır
+services = ServiceContainer()
+startup: Dict[str, Any] = {}
+# Arka planda çalışan toplu beyanname hazırlama işleri (POST /declarations/runs)
+declaration_jobs = DeclarationJobs()
+
+# async dependency'ler: senkron olanları FastAPI her istekte thread havuzunda çalıştırırdı
+async def get_db() -> Database:
+    return services.db
+
+def provide(service_cls):
+    async def get_service():
+        return services.get(service_cls)
+    return Depends(get_service)
+
+DB = Annotated[Database, Depends(get_db)]
+TaxpayerServiceDep = Annotated[TaxpayerService, provide(TaxpayerService)]
+SourceServiceDep = Annotated[SourceService, provide(SourceService)]
+TransactionServiceDep = Annotated[TransactionService, provide(TransactionService)]
+PaymentMethodServiceDep = Annotated[PaymentMethodService, provide(PaymentMethodService)]
+DocumentServiceDep = Annotated[DocumentService, provide(DocumentService)]
+DeclarationServiceDep = Annotated[DeclarationService, provide(DeclarationService)]
+TaxSettingServiceDep = Annotated[TaxSettingService, provide(TaxSettingService)]
+TaxItemServiceDep = Annotated[TaxItemService, provide(TaxItemService)]
+
+class FastJSONResponse(Response):
+    """İçeriği jsonable_encoder'dan geçirmeden core.dump_json (orjson) ile yazar.
+    Endpointler bunu doğrudan döndürmeli; FastAPI dönen dict'leri yine jsonable_encoder'a sokar."""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dump_json(content)
 
 # --- SCHEMAS (Pydantic models for API) ---
 class TaxpayerIn(BaseModel):
@@ -88,6 +138,11 @@ class TransactionIn(BaseModel):
                         data['transaction_date'] = f"{year}-{month}-{day}"
         return data
 
+    def to_transaction(self, tx_id: Optional[int] = None) -> Transaction:
+        return Transaction(tx_id, self.taxpayer_id, self.transaction_date, self.year, self.month, self.day, self.type,
+                           self.source_id, self.payment_method_id, self.document_id, self.amount, self.description,
+                           self.is_taxable, self.tax_items_id, self.gdrive_id)
+
 class DocumentIn(BaseModel):
     doc_ref: Optional[str] = None
     display_name: str
@@ -110,12 +165,31 @@ class SpecialDeductionIn(BaseModel):
     name: str # e.g. "Health", "Education"
     amount: float
 
+class LiabilityRequest(BaseModel):
+    bases: List[float]
+
 class CalculateRequest(BaseModel):
     taxpayer_id: int
     year: int
     method: str
     other_deductions: List[SpecialDeductionIn]
 
+class OptimizeRequest(BaseModel):
+    taxpayer_id: int
+    year: int
+    # Verilmezse özel indirim kaynaklarındaki işlemler kullanılır
+    other_deductions: Optional[List[SpecialDeductionIn]] = None
+
+class DeclarationRunRequest(BaseModel):
+    year: int
+    # lump_sum, actual ya da her mükellef için en düşük vergili yasal yöntem (optimal)
+    method: str = "optimal"
+    name: Optional[str] = None
+    # Verilmezse tüm mükellefler
+    taxpayer_ids: Optional[List[int]] = None
+    # Verilmezse DECLARATION_RUN_WORKERS ya da CPU sayısı
+    workers: Optional[int] = None
+
 class DeclarationIn(BaseModel):
     taxpayer_id: int
     year: int
@@ -131,22 +205,153 @@ class DeclarationIn(BaseModel):
     net_tax_to_pay: float
     status: str
 
+# --- METRICS ---
+# METRICS_ENABLED=1 ile açılır; her route için gecikme histogramı tutar (Database.metrics ile aynı koşul)
+if METRICS_ENABLED or SLOW_QUERY_LOG:
+    @app.middleware("http")
+    async def record_request_metrics(request: Request, call_next):
+        started = time.perf_counter()
+        response = await call_next(request)
+        # Yol parametreleri yerine route şablonu etiketlenir (/transactions/{tx_id})
+        route = request.scope.get("route")
+        services.db.metrics.observe_request(request.method, route.path if route else "unmatched", response.status_code,
+                                            time.perf_counter() - started)
+        return response
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(db: DB):
+    """Prometheus formatında route/sorgu metrikleri ile havuz ve önbellek istatistikleri"""
+    import metrics  # Soğuk başlangıçta yüklenmez (benchmarks/cold_start.py)
+    body = metrics.render_stats(db.pool_stats(), db.cache.stats())
+    if db.metrics:
+        body = db.metrics.render() + body
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/stats/slow-queries")
+async def get_slow_queries(db: DB, limit: int = Query(20, ge=1, le=100)):
+    """SLOW_QUERY_LOG açıkken son yavaş sorguları (SQL, maskelenmiş parametreler, çağıran metot, plan) döner"""
+    if not db.slow_query_log:
+        raise HTTPException(status_code=404, detail="Slow query log is disabled, set SLOW_QUERY_LOG")
+    return list(db.slow_query_log.recent)[-limit:][::-1]
+
 # --- ENDPOINTS ---
 
+METADATA_ENTITIES = ("taxpayers", "sources", "payment_methods", "tax_items", "transactions")
+# İşlem listesi bu tablolarla join edilir; herhangi birine yazılması listenin ETag'ini değiştirir
+TRANSACTION_ENTITIES = ("transactions", "taxpayers", "sources", "payment_methods", "tax_items", "documents")
+
+def cache_headers(*entities: str) -> Dict[str, str]:
+    # ETag, yazmaların kendi işlemlerinde artırdığı data_versions sürümlerinden üretilir; başka süreçlerin
+    # (CLI'lar, diğer worker'lar) yazmaları da görülür. Sürümler yalnızca PRAGMA data_version değişince okunur
+    # no-cache: tarayıcı yanıtı saklar ama her seferinde ETag ile doğrular
+    return {"ETag": services.db.cache.etag(*entities), "Cache-Control": "no-cache"}
+
+def not_modified(request: Request, headers: Dict[str, str]) -> Optional[Response]:
+    """If-None-Match ETag ile eşleşiyorsa SQLite'a hiç gitmeden dönülecek 304 yanıtı"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return None
+    # Zayıf karşılaştırma: sıkıştırmanın eklediği W/ öneki yok sayılır
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    if "*" in tags or headers["ETag"] in tags:
+        return Response(status_code=304, headers=headers)
+    return None
+
 @app.get("/metadata")
-async def get_metadata():
+async def get_metadata(db: DB, request: Request):
     """Dropdownlar için gerekli tüm verileri döner"""
+    headers = cache_headers(*METADATA_ENTITIES)
+    cached = not_modified(request, headers)
+    if cached is not None:
+        return cached
+    return FastJSONResponse(await db.run(load_metadata), headers=headers)
+
+def load_metadata() -> Dict[str, Any]:
+    tx_service = services.get(TransactionService)
     return {
-        "taxpayers": tp_service.get_all(),
-        "sources": src_service.get_all(),
-        "payment_methods": pm_service.get_all(),
-        "tax_items": ti_service.get_all(),
+        "taxpayers": services.get(TaxpayerService).get_all(),
+        "sources": services.get(SourceService).get_all(),
+        "payment_methods": services.get(PaymentMethodService).get_all(),
+        "tax_items": services.get(TaxItemService).get_all(),
         "last_year": tx_service.get_last_year(),
         "years": tx_service.get_years()
     }
 
 @app.get("/transactions")
 async def get_transactions(
+    db: DB,
+    tx_service: TransactionServiceDep,
+    request: Request,
+    year: Optional[int] = Query(None),
+    taxpayer_id: Optional[int] = Query(None),
+    type: Optional[int] = Query(None),
+    month: Optional[int] = Query(None),
+    source_id: Optional[List[int]] = Query(None),
+    is_taxable: Optional[bool] = Query(None),
+    tax_items_id: Optional[int] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+    sort: str = Query("date_desc"),
+    shape: str = Query("objects")
+):
+    # shape=columnar: kolon adları bir kez, her satır bir değer dizisi olarak döner
+    headers = cache_headers(*TRANSACTION_ENTITIES)
+    cached = not_modified(request, headers)
+    if cached is not None:
+        return cached
+    if limit is not None or cursor is not None:
+        # Sayfalı mod: keyset cursor ile sadece istenen sayfa döner
+        try:
+            page = await db.run(tx_service.get_transactions_page, limit=limit or 100, cursor=cursor, sort=sort, shape=shape, year=year, taxpayer_id=taxpayer_id, transaction_type=type, month=month, source_id=source_id, is_taxable=is_taxable, tax_items_id=tax_items_id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return FastJSONResponse(page, headers=headers)
+    # Liste ve özet tek sorgudan hesaplanır; satırlar cursor'dan ara dict listesi kurulmadan JSON'a yazılır
+    try:
+        chunks = tx_service.iter_transactions_json(shape=shape, year=year, taxpayer_id=taxpayer_id, transaction_type=type, month=month, source_id=source_id, is_taxable=is_taxable, tax_items_id=tax_items_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Response(await db.run(b"".join, chunks), media_type="application/json", headers=headers)
+
+@app.get("/analytics")
+async def get_analytics(
+    db: DB,
+    tx_service: TransactionServiceDep,
+    request: Request,
+    group_by: List[str] = Query(["year"]),
+    years: Optional[List[int]] = Query(None),
+    taxpayer_id: Optional[int] = Query(None),
+    type: Optional[int] = Query(None),
+    month: Optional[int] = Query(None),
+    source_id: Optional[List[int]] = Query(None),
+    is_taxable: Optional[bool] = Query(None),
+    tax_items_id: Optional[int] = Query(None),
+    shape: str = Query("objects")
+):
+    """Yıl, ay, mükellef, kaynak, vergi kalemi veya ödeme yöntemine göre gruplanmış gelir/gider/vergiye tabi/net serileri.
+    Birden çok yıl tek çağrıda karşılaştırılabilir: ?years=2023&years=2024&group_by=year&group_by=month"""
+    headers = cache_headers("transactions")
+    cached = not_modified(request, headers)
+    if cached is not None:
+        return cached
+    try:
+        result = await db.run(tx_service.get_analytics, group_by, years=years, shape=shape, taxpayer_id=taxpayer_id, transaction_type=type, month=month, source_id=source_id, is_taxable=is_taxable, tax_items_id=tax_items_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FastJSONResponse(result, headers=headers)
+
+@app.get("/stats/db-pool")
+async def get_db_pool_stats(db: DB):
+    """Bağlantı havuzunun doluluk istatistiklerini döner"""
+    return db.pool_stats()
+
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+
+@app.get("/transactions/export")
+async def export_transactions(
+    db: DB,
+    tx_service: TransactionServiceDep,
+    format: str = Query("ndjson"),
     year: Optional[int] = Query(None),
     taxpayer_id: Optional[int] = Query(None),
     type: Optional[int] = Query(None),
@@ -155,42 +360,76 @@ async def get_transactions(
     is_taxable: Optional[bool] = Query(None),
     tax_items_id: Optional[int] = Query(None)
 ):
-    txs = tx_service.get_transactions(year=year, taxpayer_id=taxpayer_id, transaction_type=type, month=month, source_id=source_id, is_taxable=is_taxable, tax_items_id=tax_items_id)
-    summary = tx_service.get_summary(year=year, taxpayer_id=taxpayer_id, transaction_type=type, month=month, source_id=source_id, is_taxable=is_taxable, tax_items_id=tax_items_id)
-    return {
-        "transactions": txs,
-        "summary": summary
-    }
+    """Filtrelenmiş işlemleri NDJSON veya CSV olarak parça parça akıtır"""
+    if format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format '{format}'")
+    chunks = tx_service.export_transactions(fmt=format, year=year, taxpayer_id=taxpayer_id, transaction_type=type, month=month, source_id=source_id, is_taxable=is_taxable, tax_items_id=tax_items_id)
+    filename = f"transactions_{year or 'all'}.{format}"
+    # Parçalar Starlette'in thread havuzunda değil, DB_MAX_CONCURRENCY sınırlı db executor'unda okunur
+    return StreamingResponse(db.iterate(chunks), media_type=EXPORT_MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.get("/transactions/search")
+async def search_transactions(
+    db: DB,
+    tx_service: TransactionServiceDep,
+    request: Request,
+    q: str = Query(..., min_length=1),
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    year: Optional[int] = Query(None),
+    taxpayer_id: Optional[int] = Query(None),
+    type: Optional[int] = Query(None),
+    month: Optional[int] = Query(None),
+    source_id: Optional[List[int]] = Query(None),
+    is_taxable: Optional[bool] = Query(None),
+    tax_items_id: Optional[int] = Query(None)
+):
+    """Açıklama, kaynak, vergi kalemi ve belge adlarında FTS5 araması; en alakalı sonuç önce, sayfalı"""
+    headers = cache_headers(*TRANSACTION_ENTITIES)
+    cached = not_modified(request, headers)
+    if cached is not None:
+        return cached
+    try:
+        result = await db.run(tx_service.search_transactions, q, limit=limit, offset=offset, year=year, taxpayer_id=taxpayer_id, transaction_type=type, month=month, source_id=source_id, is_taxable=is_taxable, tax_items_id=tax_items_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FastJSONResponse(result, headers=headers)
+
+@app.get("/stats/cache")
+async def get_cache_stats(db: DB):
+    """Referans veri önbelleğinin isabet istatistiklerini döner"""
+    return db.cache.stats()
 
 # --- Taxpayer Endpoints ---
 @app.get("/taxpayers")
-async def get_taxpayers():
-    return tp_service.get_all()
+async def get_taxpayers(db: DB, tp_service: TaxpayerServiceDep):
+    return FastJSONResponse(await db.run(tp_service.get_all))
 
 @app.post("/taxpayers")
-async def add_taxpayer(t: TaxpayerIn):
+async def add_taxpayer(db: DB, tp_service: TaxpayerServiceDep, t: TaxpayerIn):
     new_tp = Taxpayer(id=None, full_name=t.full_name)
-    tp_id = tp_service.add_taxpayer(new_tp)
+    tp_id = await db.run(tp_service.add_taxpayer, new_tp)
     return {"id": tp_id}
 
 @app.put("/taxpayers/{tp_id}")
-async def update_taxpayer(tp_id: int, t: TaxpayerIn):
+async def update_taxpayer(db: DB, tp_service: TaxpayerServiceDep, tp_id: int, t: TaxpayerIn):
     up_tp = Taxpayer(id=tp_id, full_name=t.full_name)
-    tp_service.update_taxpayer(up_tp)
+    await db.run(tp_service.update_taxpayer, up_tp)
     return {"status": "updated"}
 
 @app.delete("/taxpayers/{tp_id}")
-async def delete_taxpayer(tp_id: int):
-    tp_service.delete_taxpayer(tp_id)
+async def delete_taxpayer(db: DB, tp_service: TaxpayerServiceDep, tp_id: int):
+    await db.run(tp_service.delete_taxpayer, tp_id)
     return {"status": "deleted"}
 
 # --- Source Endpoints ---
 @app.get("/sources")
-async def get_sources():
-    return src_service.get_all()
+async def get_sources(db: DB, src_service: SourceServiceDep):
+    return FastJSONResponse(await db.run(src_service.get_all))
 
 @app.post("/sources")
-async def add_source(s: SourceIn):
+async def add_source(db: DB, src_service: SourceServiceDep, s: SourceIn):
     new_src = Source(
         id=None,
         name=s.name,
@@ -202,11 +441,11 @@ async def add_source(s: SourceIn):
         is_net=s.is_net,
         deduction_type=s.deduction_type
     )
-    src_id = src_service.add_source(new_src)
+    src_id = await db.run(src_service.add_source, new_src)
     return {"id": src_id}
 
 @app.put("/sources/{s_id}")
-async def update_source(s_id: int, s: SourceIn):
+async def update_source(db: DB, src_service: SourceServiceDep, s_id: int, s: SourceIn):
     up_src = Source(
         id=s_id,
         name=s.name,
@@ -218,60 +457,60 @@ async def update_source(s_id: int, s: SourceIn):
         is_net=s.is_net,
         deduction_type=s.deduction_type
     )
-    src_service.update_source(up_src)
+    await db.run(src_service.update_source, up_src)
     return {"status": "updated"}
 
 @app.delete("/sources/{s_id}")
-async def delete_source(s_id: int):
-    src_service.delete_source(s_id)
+async def delete_source(db: DB, src_service: SourceServiceDep, s_id: int):
+    await db.run(src_service.delete_source, s_id)
     return {"status": "deleted"}
 
 # --- Tax Item Endpoints ---
 @app.get("/tax-items")
-async def get_tax_items():
-    return ti_service.get_all()
+async def get_tax_items(db: DB, ti_service: TaxItemServiceDep):
+    return FastJSONResponse(await db.run(ti_service.get_all))
 
 @app.post("/tax-items")
-async def add_tax_item(ti: TaxItemIn):
+async def add_tax_item(db: DB, ti_service: TaxItemServiceDep, ti: TaxItemIn):
     new_ti = TaxItem(id=None, code=ti.code, name=ti.name)
-    ti_id = ti_service.add_tax_item(new_ti)
+    ti_id = await db.run(ti_service.add_tax_item, new_ti)
     return {"id": ti_id}
 
 @app.put("/tax-items/{ti_id}")
-async def update_tax_item(ti_id: int, ti: TaxItemIn):
+async def update_tax_item(db: DB, ti_service: TaxItemServiceDep, ti_id: int, ti: TaxItemIn):
     up_ti = TaxItem(id=ti_id, code=ti.code, name=ti.name)
-    ti_service.update_tax_item(up_ti)
+    await db.run(ti_service.update_tax_item, up_ti)
     return {"status": "updated"}
 
 @app.delete("/tax-items/{ti_id}")
-async def delete_tax_item(ti_id: int):
-    ti_service.delete_tax_item(ti_id)
+async def delete_tax_item(db: DB, ti_service: TaxItemServiceDep, ti_id: int):
+    await db.run(ti_service.delete_tax_item, ti_id)
     return {"status": "deleted"}
 
 # --- PaymentMethod Endpoints ---
 @app.get("/payment-methods")
-async def get_payment_methods():
-    return pm_service.get_all()
+async def get_payment_methods(db: DB, pm_service: PaymentMethodServiceDep):
+    return FastJSONResponse(await db.run(pm_service.get_all))
 
 @app.post("/payment-methods")
-async def add_payment_method(pm: PaymentMethodIn):
+async def add_payment_method(db: DB, pm_service: PaymentMethodServiceDep, pm: PaymentMethodIn):
     new_pm = PaymentMethod(id=None, method_name=pm.method_name)
-    pm_id = pm_service.add_payment_method(new_pm)
+    pm_id = await db.run(pm_service.add_payment_method, new_pm)
     return {"id": pm_id}
 
 @app.put("/payment-methods/{pm_id}")
-async def update_payment_method(pm_id: int, pm: PaymentMethodIn):
+async def update_payment_method(db: DB, pm_service: PaymentMethodServiceDep, pm_id: int, pm: PaymentMethodIn):
     up_pm = PaymentMethod(id=pm_id, method_name=pm.method_name)
-    pm_service.update_payment_method(up_pm)
+    await db.run(pm_service.update_payment_method, up_pm)
     return {"status": "updated"}
 
 @app.delete("/payment-methods/{pm_id}")
-async def delete_payment_method(pm_id: int):
-    pm_service.delete_payment_method(pm_id)
+async def delete_payment_method(db: DB, pm_service: PaymentMethodServiceDep, pm_id: int):
+    await db.run(pm_service.delete_payment_method, pm_id)
     return {"status": "deleted"}
 
 @app.post("/transactions")
-async def add_transaction(tx: TransactionIn):
+async def add_transaction(db: DB, tx_service: TransactionServiceDep, tx: TransactionIn):
     # Pydantic modelini core.py Transaction modeline çevir
     new_tx = Transaction(
         id=None,
@@ -290,11 +529,113 @@ async def add_transaction(tx: TransactionIn):
         tax_items_id=tx.tax_items_id,
         gdrive_id=tx.gdrive_id
     )
-    tx_service.add_transaction(new_tx)
+    try:
+        await db.run(tx_service.add_transaction, new_tx)
+    except ValueError as e:
+        # Arşivlenmiş yıla işlem eklenemez
+        raise HTTPException(status_code=400, detail=str(e))
     return {"status": "success"}
 
+BULK_CONTENT_TYPES = ("application/json", "application/x-ndjson", "text/csv")
+
+async def iter_body_lines(request: Request):
+    # İstek gövdesini bellekte biriktirmeden satır satır okur
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in request.stream():
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+async def iter_bulk_records(request: Request):
+    content_type = request.headers.get("content-type", "application/json").split(";")[0].strip()
+    if content_type not in BULK_CONTENT_TYPES:
+        raise HTTPException(status_code=415, detail=f"Unsupported content type '{content_type}'")
+    if content_type == "application/json":
+        records = await request.json()
+        if not isinstance(records, list):
+            raise HTTPException(status_code=400, detail="Expected a JSON array of transactions")
+        for record in records:
+            yield record
+        return
+
+    header = None
+    record_lines = []
+    async for line in iter_body_lines(request):
+        if content_type == "application/x-ndjson":
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield e
+            continue
+        # CSV: tırnak içindeki satır sonları kapanana kadar satırları birleştir
+        record_lines.append(line)
+        if sum(l.count('"') for l in record_lines) % 2:
+            continue
+        row = next(csv.reader(["\n".join(record_lines)]), [])
+        record_lines = []
+        if not any(cell.strip() for cell in row):
+            continue
+        if header is None:
+            header = [h.strip() for h in row]
+            continue
+        yield {k: (v if v != "" else None) for k, v in zip(header, row)}
+
+BULK_VALIDATION_BATCH = 1000
+TRANSACTION_LIST_ADAPTER = TypeAdapter(List[TransactionIn])
+
+def format_validation_error(e: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+
+def validate_bulk_batch(batch: List, first_row: int, valid: List, valid_rows: List, errors: List):
+    # Listeyi tek seferde doğrula; hata varsa sadece o partiyi satır satır doğrula
+    try:
+        models = TRANSACTION_LIST_ADAPTER.validate_python(batch)
+        valid.extend(m.to_transaction() for m in models)
+        valid_rows.extend(range(first_row, first_row + len(batch)))
+        return
+    except ValidationError:
+        pass
+    for offset, record in enumerate(batch):
+        row = first_row + offset
+        if isinstance(record, Exception):
+            errors.append({"row": row, "error": str(record)})
+            continue
+        try:
+            valid.append(TransactionIn.model_validate(record).to_transaction())
+            valid_rows.append(row)
+        except ValidationError as e:
+            errors.append({"row": row, "error": format_validation_error(e)})
+
+@app.post("/transactions/bulk")
+async def bulk_add_transactions(db: DB, tx_service: TransactionServiceDep, request: Request, atomic: bool = Query(False)):
+    """JSON dizisi, NDJSON veya CSV gövdesinden toplu işlem ekler; satır bazında hata döner"""
+    valid = []
+    valid_rows = []
+    errors = []
+    batch = []
+    row = 0
+    async for record in iter_bulk_records(request):
+        batch.append(record)
+        if len(batch) == BULK_VALIDATION_BATCH:
+            validate_bulk_batch(batch, row, valid, valid_rows, errors)
+            row += len(batch)
+            batch = []
+    validate_bulk_batch(batch, row, valid, valid_rows, errors)
+
+    if atomic and errors:
+        return {"inserted": 0, "rejected": len(errors), "errors": errors}
+    inserted, db_errors = await db.run(tx_service.add_transactions, valid, atomic=atomic)
+    errors.extend({"row": valid_rows[e["index"]], "error": e["error"]} for e in db_errors)
+    errors.sort(key=lambda e: e["row"])
+    return {"inserted": inserted, "rejected": len(errors), "errors": errors}
+
 @app.put("/transactions/{tx_id}")
-async def update_transaction(tx_id: int, tx: TransactionIn):
+async def update_transaction(db: DB, tx_service: TransactionServiceDep, tx_id: int, tx: TransactionIn):
     up_tx = Transaction(
         id=tx_id,
         taxpayer_id=tx.taxpayer_id,
@@ -312,23 +653,29 @@ async def update_transaction(tx_id: int, tx: TransactionIn):
         tax_items_id=tx.tax_items_id,
         gdrive_id=tx.gdrive_id
     )
-    tx_service.update_transaction(up_tx)
+    try:
+        await db.run(tx_service.update_transaction, up_tx)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {"status": "updated"}
 
 @app.delete("/transactions/{tx_id}")
-async def delete_transaction(tx_id: int):
-    tx_service.delete_transaction(tx_id)
+async def delete_transaction(db: DB, tx_service: TransactionServiceDep, tx_id: int):
+    try:
+        await db.run(tx_service.delete_transaction, tx_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {"status": "deleted"}
 
 @app.get("/transactions/{tx_id}")
-async def get_transaction(tx_id: int):
-    tx = tx_service.get_transaction(tx_id)
+async def get_transaction(db: DB, tx_service: TransactionServiceDep, tx_id: int):
+    tx = await db.run(tx_service.get_transaction, tx_id)
     if not tx:
         raise HTTPException(status_code=404, detail="Transaction not found")
     return tx
 
 @app.post("/documents")
-async def add_document(doc: DocumentIn):
+async def add_document(db: DB, doc_service: DocumentServiceDep, doc: DocumentIn):
     new_doc = Document(
         id=None,
         doc_ref=doc.doc_ref,
@@ -336,21 +683,25 @@ async def add_document(doc: DocumentIn):
         relative_path=doc.relative_path,
         gdrive_id=doc.gdrive_id
     )
-    doc_id = doc_service.add_document(new_doc)
+    doc_id = await db.run(doc_service.add_document, new_doc)
     return {"document_id": doc_id}
 
 # --- Tax Settings Endpoints ---
 @app.get("/tax-settings/{year}")
-async def get_tax_settings(year: int):
-    settings = ts_service.get_settings(year)
+async def get_tax_settings(db: DB, ts_service: TaxSettingServiceDep, year: int, request: Request):
+    headers = cache_headers("tax_settings")
+    cached = not_modified(request, headers)
+    if cached is not None:
+        return cached
+    settings = await db.run(ts_service.get_settings, year)
     if not settings:
         # Return empty or construct default structure if service returns None for non-2025?
         # Service logic handles defaults for 2025.
-        return {}
-    return settings
+        return FastJSONResponse({}, headers=headers)
+    return FastJSONResponse(settings, headers=headers)
 
 @app.post("/tax-settings")
-async def save_tax_settings(s: TaxSettingIn):
+async def save_tax_settings(db: DB, ts_service: TaxSettingServiceDep, s: TaxSettingIn):
     new_s = TaxSetting(
         year=s.year,
         exemption_amount=s.exemption_amount,
@@ -359,22 +710,51 @@ async def save_tax_settings(s: TaxSettingIn):
         withholding_rate=s.withholding_rate,
         tax_brackets=s.tax_brackets
     )
-    ts_service.save_settings(new_s)
+    await db.run(ts_service.save_settings, new_s)
     return {"status": "saved"}
 
+@app.post("/tax-settings/{year}/liability")
+async def calculate_liabilities(db: DB, ts_service: TaxSettingServiceDep, year: int, req: LiabilityRequest):
+    """Senaryo analizi: verilen matrahların her biri için gelir vergisini döner"""
+    compiled = await db.run(ts_service.get_compiled_brackets, year)
+    if not compiled:
+        raise HTTPException(status_code=404, detail=f"Tax settings for {year} not found")
+    return {"year": year, "taxes": compiled.tax_array(req.bases).tolist()}
+
 # --- Declaration Endpoints ---
 @app.post("/declarations/calculate")
-async def calculate_declaration(req: CalculateRequest):
+async def calculate_declaration(db: DB, dec_service: DeclarationServiceDep, req: CalculateRequest):
     try:
         # Convert Pydantic list to dict list for service
         deductions = [d.dict() for d in req.other_deductions]
-        result = dec_service.calculate(req.taxpayer_id, req.year, req.method, deductions)
+        # Güncel önbellek sonucu thread havuzuna gitmeden döner
+        result = dec_service.get_cached_calculation(req.taxpayer_id, req.year, req.method, deductions)
+        if result is None:
+            result = await db.run(dec_service.calculate, req.taxpayer_id, req.year, req.method, deductions)
         return result
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.post("/declarations/calculate-batch")
+async def calculate_declarations_batch(db: DB, dec_service: DeclarationServiceDep, reqs: List[CalculateRequest]):
+    """Birden çok mükellef/yıl/yöntem için hesaplamayı tek sorgu ve vektörel adımlarla yapar"""
+    try:
+        jobs = [(r.taxpayer_id, r.year, r.method, [d.model_dump() for d in r.other_deductions]) for r in reqs]
+        return await db.run(dec_service.calculate_batch, jobs)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/declarations/optimize")
+async def optimize_declaration(db: DB, dec_service: DeclarationServiceDep, req: OptimizeRequest):
+    """Veriyi bir kez yükleyip tüm yöntem/indirim senaryolarını karşılaştırır, en düşük vergili yasal seçeneği döner"""
+    try:
+        deductions = None if req.other_deductions is None else [d.model_dump() for d in req.other_deductions]
+        return await db.run(dec_service.optimize, req.taxpayer_id, req.year, deductions)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.post("/declarations")
-async def save_declaration(d: DeclarationIn):
+async def save_declaration(db: DB, dec_service: DeclarationServiceDep, d: DeclarationIn):
     new_dec = Declaration(
         id=None,
         taxpayer_id=d.taxpayer_id,
@@ -391,21 +771,59 @@ async def save_declaration(d: DeclarationIn):
         net_tax_to_pay=d.net_tax_to_pay,
         status=d.status
     )
-    dec_service.save_declaration(new_dec)
+    await db.run(dec_service.save_declaration, new_dec)
     return {"status": "saved"}
 
 @app.get("/declarations/special-deductions/{taxpayer_id}/{year}")
-async def get_special_deductions_api(taxpayer_id: int, year: int):
-    return dec_service.get_special_deductions_from_db(taxpayer_id, year)
+async def get_special_deductions_api(db: DB, dec_service: DeclarationServiceDep, taxpayer_id: int, year: int):
+    return FastJSONResponse(await db.run(dec_service.get_special_deductions_from_db, taxpayer_id, year))
     
 @app.get("/declarations/list/{taxpayer_id}/{year}")
-async def list_declarations(taxpayer_id: int, year: int):
-    return dec_service.get_declarations(taxpayer_id, year)
+async def list_declarations(db: DB, dec_service: DeclarationServiceDep, taxpayer_id: int, year: int, request: Request):
+    headers = cache_headers("declarations")
+    cached = not_modified(request, headers)
+    if cached is not None:
+        return cached
+    declarations = await db.run(dec_service.get_declarations, taxpayer_id, year)
+    # Geçmiş yılın kesinleşmiş beyannameleri artık değişmez; tarayıcı yeniden doğrulamadan kullanabilir
+    if HTTP_IMMUTABLE_MAX_AGE and year < date.today().year and declarations and all(d.status == 'final' for d in declarations):
+        headers["Cache-Control"] = f"private, max-age={HTTP_IMMUTABLE_MAX_AGE}, immutable"
+    return FastJSONResponse(declarations, headers=headers)
+
+@app.post("/declarations/runs", status_code=202)
+async def start_declaration_run(db: DB, req: DeclarationRunRequest):
+    """Mükelleflerin taslak beyannamelerini süreç havuzunda arka planda hazırlar; ilerleme GET /declarations/runs/{run_id} ile izlenir"""
+    try:
+        run = DeclarationRun(req.year, req.method, req.name, req.taxpayer_ids, req.workers or 0)
+        await db.run(declaration_jobs.start, db, run)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return run.status()
+
+@app.get("/declarations/runs")
+async def list_declaration_runs():
+    return [run.status() for run in declaration_jobs.all()]
+
+@app.get("/declarations/runs/{run_id}")
+async def get_declaration_run(run_id: str):
+    """İlerleme (done/total), hazırlanan/kaydedilen taslaklar ve mükellef bazında hatalar"""
+    run = declaration_jobs.get(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Declaration run not found")
+    return run.status()
 
 @app.delete("/declarations/{dec_id}")
-async def delete_declaration(dec_id: int):
-    dec_service.delete_declaration(dec_id)
+async def delete_declaration(db: DB, dec_service: DeclarationServiceDep, dec_id: int):
+    await db.run(dec_service.delete_declaration, dec_id)
     return {"status": "deleted"}
 
+@app.get("/stats/startup")
+async def get_startup_profile():
+    """Soğuk başlangıç profili: api.py import süresi, init_db, hazır olma süresi ve servislerin kurulum süreleri (ms)"""
+    return dict(startup, init_ms=services.init_ms)
+
+startup["import_ms"] = round((time.perf_counter() - IMPORT_STARTED) * 1000, 3)
+
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run("api:app", host="127.0.0.1", port=8000, reload=True)
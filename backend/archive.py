@@ -0,0 +1,236 @@
+"""Columnar, memory-mapped files for the transactions of archived (closed) tax years.
+
+One file holds one taxpayer's year: an 8-byte magic, the length of a JSON header, the header,
+then one 64-byte aligned block per column. Readers map the file with numpy.memmap, so every
+column is a view into the page cache and filters and sums are vector operations without copies.
+Dates, sources, tax items, descriptions and Drive ids are dictionary-encoded (int32 codes, -1 is
+NULL); other integer columns store NULL as the smallest value of their dtype.
+"""
+import json
+import os
+import struct
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+MAGIC = b"MTAXARC1"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+FILE_SUFFIX = ".mtxa"
+
+# (column, dtype) stored as plain values
+VALUE_COLUMNS = (("id", "<i8"), ("month", "<i2"), ("day", "<i2"), ("type", "<i2"), ("payment_method_id", "<i8"),
+                 ("document_id", "<i8"), ("amount", "<f8"), ("is_taxable", "i1"))
+# Columns stored as int32 codes into a dictionary kept in the header
+DICTIONARY_COLUMNS = ("transaction_date", "source_id", "tax_items_id", "description", "gdrive_id")
+NULL_CODE = -1
+# Decoded rows use the column order of the transactions table
+RECORD_COLUMNS = ("id", "taxpayer_id", "transaction_date", "year", "month", "day", "type", "source_id",
+                  "payment_method_id", "document_id", "description", "amount", "is_taxable", "tax_items_id", "gdrive_id")
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _null(dtype: str):
+    return np.iinfo(np.dtype(dtype)).min
+
+
+def _list_order(row: Dict) -> Tuple:
+    # Date (newest first), source id, id (newest first), the GET /transactions order
+    return (str(row["transaction_date"]), -row["source_id"], row["id"])
+
+
+def write_archive(path: str, taxpayer_id: int, year: int, rows: List[Dict]) -> Dict:
+    """Writes the transaction rows (dicts with the transactions columns) of one taxpayer and year to `path`
+    in list order. The file is written next to `path` and renamed, so readers never see a partial file.
+    Returns the header."""
+    rows = sorted(rows, key=_list_order, reverse=True)
+    blocks = []
+    for name, dtype in VALUE_COLUMNS:
+        if name == "is_taxable":
+            values = [NULL_CODE if r[name] is None else (1 if r[name] else 0) for r in rows]
+        elif name == "amount":
+            values = [r[name] for r in rows]
+        else:
+            values = [_null(dtype) if r[name] is None else r[name] for r in rows]
+        blocks.append((name, np.asarray(values, dtype=dtype)))
+    dictionaries = {}
+    for name in DICTIONARY_COLUMNS:
+        index: Dict = {}
+        codes = [NULL_CODE if r[name] is None else index.setdefault(str(r[name]) if name == "transaction_date" else r[name], len(index))
+                 for r in rows]
+        dictionaries[name] = list(index)
+        blocks.append((name, np.asarray(codes, dtype="<i4")))
+
+    columns, offset = [], 0
+    for name, values in blocks:
+        columns.append({"name": name, "dtype": values.dtype.str, "offset": offset, "nbytes": values.nbytes})
+        offset = _aligned(offset + values.nbytes)
+    header = {"format": FORMAT_VERSION, "taxpayer_id": taxpayer_id, "year": year, "rows": len(rows),
+              "amount": float(sum(r["amount"] for r in rows)), "columns": columns, "dictionaries": dictionaries}
+    encoded = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    data_start = _aligned(len(MAGIC) + 8 + len(encoded))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + struct.pack("<Q", len(encoded)) + encoded)
+        for column, (_, values) in zip(columns, blocks):
+            f.seek(data_start + column["offset"])
+            f.write(values.tobytes())
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return header
+
+
+class ArchiveFile:
+    """Read-only, memory-mapped view of one archive file"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not an mTax archive file")
+            (length,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(length))
+        if header["format"] != FORMAT_VERSION:
+            raise ValueError(f"{path} has archive format {header['format']}, expected {FORMAT_VERSION}")
+        self.path = path
+        self.header = header
+        self.taxpayer_id: int = header["taxpayer_id"]
+        self.year: int = header["year"]
+        self.rows: int = header["rows"]
+        self.dictionaries: Dict[str, list] = header["dictionaries"]
+        data_start = _aligned(len(MAGIC) + 8 + length)
+        self._map = np.memmap(path, dtype=np.uint8, mode="r")
+        self._columns = {c["name"]: self._map[data_start + c["offset"]:data_start + c["offset"] + c["nbytes"]].view(c["dtype"])
+                         for c in header["columns"]}
+
+    def column(self, name: str) -> np.ndarray:
+        """Raw stored values (dictionary codes for dictionary-encoded columns), a view into the file"""
+        return self._columns[name]
+
+    def _codes(self, name: str, values: Sequence) -> List[int]:
+        wanted = set(values)
+        return [code for code, value in enumerate(self.dictionaries[name]) if value in wanted]
+
+    def key(self, name: str) -> np.ndarray:
+        """int64 values of an integer column with NULL as 0, like the rollup and analytics keys"""
+        if name == "taxpayer_id":
+            return np.full(self.rows, self.taxpayer_id, dtype=np.int64)
+        if name == "year":
+            return np.full(self.rows, self.year, dtype=np.int64)
+        raw = self._columns[name]
+        if name in DICTIONARY_COLUMNS:
+            lookup = np.asarray([v or 0 for v in self.dictionaries[name]] + [0], dtype=np.int64)
+            return lookup[raw]  # NULL_CODE (-1) picks the trailing 0
+        null = NULL_CODE if name == "is_taxable" else _null(raw.dtype.str)
+        return np.where(raw == null, 0, raw).astype(np.int64)
+
+    def mask(self, year=None, taxpayer_id=None, transaction_type=None, month=None, source_id=None, is_taxable=None,
+             tax_items_id=None) -> np.ndarray:
+        """Rows matching the GET /transactions filters, same semantics as core._transaction_filters"""
+        if (year and year != self.year) or (taxpayer_id and taxpayer_id != self.taxpayer_id):
+            return np.zeros(self.rows, dtype=bool)
+        keep = np.ones(self.rows, dtype=bool)
+        if month:
+            keep &= self._columns["month"] == month
+        if transaction_type:
+            keep &= self._columns["type"] == transaction_type
+        if source_id:
+            keep &= np.isin(self._columns["source_id"], self._codes("source_id", source_id if isinstance(source_id, list) else [source_id]))
+        if is_taxable is not None:
+            keep &= self._columns["is_taxable"] == (1 if is_taxable else 0)
+        if tax_items_id:
+            keep &= np.isin(self._columns["tax_items_id"], self._codes("tax_items_id", [tax_items_id]))
+        return keep
+
+    def records(self, mask: Optional[np.ndarray] = None) -> List[Dict]:
+        """Decoded rows (dicts in transactions column order), in list order"""
+        return self._decode(np.nonzero(mask)[0] if mask is not None else np.arange(self.rows))
+
+    def _sort_column(self, name: str) -> np.ndarray:
+        """Numbers that order every row like the SQLite values of a list sort column. Dates are ranked in
+        their sorted dictionary with odd ranks, so dates between two stored ones fit the even ranks."""
+        if name == "transaction_date":
+            dictionary = self.dictionaries[name]
+            ranks = np.full(len(dictionary) + 1, -1, dtype=np.int64)  # NULL_CODE picks the trailing -1, NULL sorts first
+            ranks[sorted(range(len(dictionary)), key=dictionary.__getitem__)] = 2 * np.arange(len(dictionary)) + 1
+            return ranks[self._columns[name]]
+        return self._columns["amount"] if name == "amount" else self.key(name)
+
+    def _sort_value(self, name: str, value):
+        """`value` of a sort column on the scale of _sort_column"""
+        if name == "transaction_date":
+            if value is None:
+                return -1
+            dates = sorted(self.dictionaries[name])
+            position = int(np.searchsorted(dates, str(value)))
+            return 2 * position + 1 if position < len(dates) and dates[position] == str(value) else 2 * position
+        return 0 if value is None else value
+
+    def page(self, order: Sequence[Tuple[str, str]], limit: int, after: Optional[Sequence] = None,
+             mask: Optional[np.ndarray] = None) -> List[Dict]:
+        """Up to `limit` decoded rows in `order` ((column, "ASC" or "DESC") pairs) that come after the
+        key values `after`, like a keyset page of the transactions table"""
+        selected = np.nonzero(mask)[0] if mask is not None else np.arange(self.rows)
+        keys = [self._sort_column(name)[selected] for name, _ in order]
+        if after is not None:
+            keep, equal = np.zeros(len(selected), dtype=bool), np.ones(len(selected), dtype=bool)
+            for (name, direction), values, value in zip(order, keys, after):
+                value = self._sort_value(name, value)
+                keep |= equal & ((values < value) if direction == "DESC" else (values > value))
+                equal &= values == value
+            selected, keys = selected[keep], [values[keep] for values in keys]
+        # lexsort sorts by its last key first and ascending only
+        ranked = np.lexsort([-values if direction == "DESC" else values for (_, direction), values in reversed(list(zip(order, keys)))])
+        return self._decode(selected[ranked[:limit]])
+
+    def _decode(self, selected: np.ndarray) -> List[Dict]:
+        values = {}
+        for name, dtype in VALUE_COLUMNS:
+            raw = self._columns[name][selected]
+            null = NULL_CODE if name == "is_taxable" else (None if name == "amount" else _null(dtype))
+            values[name] = [None if v == null else v for v in raw.tolist()] if null is not None else raw.tolist()
+        for name in DICTIONARY_COLUMNS:
+            dictionary = self.dictionaries[name]
+            values[name] = [None if code == NULL_CODE else dictionary[code] for code in self._columns[name][selected].tolist()]
+        count = len(selected)
+        values["taxpayer_id"] = [self.taxpayer_id] * count
+        values["year"] = [self.year] * count
+        return [dict(zip(RECORD_COLUMNS, row)) for row in zip(*(values[n] for n in RECORD_COLUMNS))]
+
+    def find(self, t_id: int) -> Optional[Dict]:
+        """The row with id `t_id`, if it is in this file"""
+        hits = np.nonzero(self._columns["id"] == t_id)[0]
+        if not len(hits):
+            return None
+        return self._decode(hits[:1])[0]
+
+    def aggregate(self, keys: Sequence[str], mask: Optional[np.ndarray] = None) -> List[Tuple]:
+        """(key values..., count, amount, income, expense, taxable income) per distinct combination of `keys`,
+        with NULL keys as 0. One np.unique over the key columns and a bincount per measure."""
+        selected = np.nonzero(mask)[0] if mask is not None else np.arange(self.rows)
+        if not len(selected):
+            return []
+        amount = self._columns["amount"][selected]
+        if keys:
+            stacked = np.stack([self.key(k)[selected] for k in keys], axis=1)
+            groups, inverse = np.unique(stacked, axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+        else:
+            groups, inverse = np.zeros((1, 0), dtype=np.int64), np.zeros(len(selected), dtype=np.intp)
+        size = len(groups)
+        tx_type = self.key("type")[selected]
+        income = np.where(tx_type == 1, amount, 0.0)
+        taxable = np.where(self._columns["is_taxable"][selected] == 1, income, 0.0)
+        sums = [np.bincount(inverse, weights=w, minlength=size).tolist() for w in
+                (amount, income, np.where(tx_type == -1, amount, 0.0), taxable)]
+        counts = np.bincount(inverse, minlength=size).tolist()
+        return [tuple(group) + (count,) + tuple(s[i] for s in sums) for i, (group, count) in enumerate(zip(groups.tolist(), counts))]
+
+
+def archive_path(directory: str, taxpayer_id: int, year: int) -> str:
+    return os.path.join(directory, f"{taxpayer_id}-{year}{FILE_SUFFIX}")
@@ -0,0 +1,71 @@
+"""Archives closed tax years into memory-mapped column files, lists or restores them.
+
+Archived transactions leave the transactions table and are read from ARCHIVE_DIR (next to the
+database by default); lists, summaries, exports and calculations return the same results. A year
+is closed once it has a final declaration; --force archives it without one. Archived years are
+read-only, restore a year before changing its transactions.
+
+    python archive_years.py --list
+    python archive_years.py --closed                        # every closed year not yet archived
+    python archive_years.py --taxpayer 1 --year 2023
+    python archive_years.py personal_finance.db --taxpayer 1 --year 2023 --restore
+"""
+import argparse
+import sys
+
+from core import DB_NAME, Database
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("db", nargs="?", default=DB_NAME)
+    parser.add_argument("--list", action="store_true", help="Show the archived years")
+    parser.add_argument("--closed", action="store_true", help="Archive every year with a final declaration")
+    parser.add_argument("--taxpayer", type=int)
+    parser.add_argument("--year", type=int)
+    parser.add_argument("--restore", action="store_true", help="Move the year back into the transactions table")
+    parser.add_argument("--force", action="store_true", help="Archive the year even without a final declaration")
+    args = parser.parse_args(argv[1:])
+    if not (args.list or args.closed) and (args.taxpayer is None or args.year is None):
+        parser.error("--taxpayer and --year are required unless --list or --closed is given")
+
+    db = Database(args.db)
+    db.init_db()
+    try:
+        if args.list:
+            with db.get_connection(readonly=True) as conn:
+                rows = conn.execute("SELECT * FROM archived_years ORDER BY taxpayer_id, year").fetchall()
+            for row in rows:
+                print(f"taxpayer {row['taxpayer_id']} {row['year']}: {row['rows']} transactions, "
+                      f"{row['amount']:.2f} total, {row['file']} ({row['archived_at']})")
+            print(f"{len(rows)} archived years in {db.archive_dir}")
+            return 0
+        if args.restore:
+            restored = db.restore_year(args.taxpayer, args.year)
+            print(f"Restored {args.year} of taxpayer {args.taxpayer}: {restored} transactions")
+            return 0
+
+        if args.closed:
+            with db.get_connection(readonly=True) as conn:
+                pairs = [tuple(r) for r in conn.execute("""
+                    SELECT DISTINCT d.taxpayer_id, d.year FROM declarations d
+                    WHERE d.status = 'final' AND EXISTS (
+                        SELECT 1 FROM transactions t WHERE t.taxpayer_id = d.taxpayer_id AND t.year = d.year)
+                    ORDER BY d.taxpayer_id, d.year""")]
+        else:
+            pairs = [(args.taxpayer, args.year)]
+        for taxpayer_id, year in pairs:
+            result = db.archive_year(taxpayer_id, year, force=args.force)
+            print(f"Archived {year} of taxpayer {taxpayer_id}: {result['rows']} transactions, "
+                  f"{result['bytes']} bytes in {result['file']}")
+        print(f"{len(pairs)} years archived")
+        return 0
+    except ValueError as e:
+        print(f"ERROR {e}")
+        return 1
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
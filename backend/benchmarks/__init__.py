@@ -0,0 +1,4 @@
+"""Performance benchmarks for the mTax backend. Run modules from the backend directory, e.g.
+
+    python -m benchmarks.export_memory --rows 1000000
+"""
@@ -0,0 +1,92 @@
+"""Reads of archived years versus the same years in the transactions table.
+
+Builds a synthetic database, times get_transactions, the GET /transactions body and a
+payment-method analytics scan over the older years, then archives every taxpayer's older
+years (Database.archive_year) and times the same calls again. Reports the hot table size,
+the archive size on disk and whether every result stayed the same (to the cent):
+
+    python -m benchmarks.archive_scan --transactions 1000000 --taxpayers 100
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from benchmarks.synthetic import build_database
+from core import TransactionService
+
+
+def timed(fn, repeat: int) -> float:
+    """Median milliseconds of `repeat` calls"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(samples), 2)
+
+
+def rounded(value):
+    """Amounts to the cent; archive scans add the same amounts in a different order"""
+    if isinstance(value, float):
+        return round(value, 2)
+    if isinstance(value, dict):
+        return {k: rounded(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [rounded(v) for v in value]
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transactions", type=int, default=200_000)
+    parser.add_argument("--taxpayers", type=int, default=10)
+    parser.add_argument("--years", type=int, default=5, help="Years of data; all but the last one are archived")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    last_year = 2024
+    closed = range(last_year - args.years + 1, last_year)
+    with tempfile.TemporaryDirectory(prefix="mtax-archive-") as work_dir:
+        db = build_database(os.path.join(work_dir, "bench.db"), args.transactions, taxpayers=args.taxpayers,
+                            years=range(closed.start, last_year + 1))
+        tx_service = TransactionService(db)
+        year = closed.start
+        cases = {
+            "get_transactions.taxpayer_year": lambda: tx_service.get_transactions(year=year, taxpayer_id=1),
+            "get_transactions.year": lambda: tx_service.get_transactions(year=year),
+            "list_json.year": lambda: b"".join(tx_service.iter_transactions_json(year=year)),
+            "analytics.payment_method": lambda: tx_service.get_analytics(["year", "payment_method_id"], years=list(closed)),
+            "summary.year": lambda: tx_service.get_summary(year=year),
+        }
+        hot = {name: timed(fn, args.repeat) for name, fn in cases.items()}
+        results = {name: rounded(fn()) for name, fn in cases.items()}
+
+        started = time.perf_counter()
+        archived = [db.archive_year(tp, y, force=True) for tp in range(1, args.taxpayers + 1) for y in closed]
+        archive_seconds = time.perf_counter() - started
+        cold = {name: timed(fn, args.repeat) for name, fn in cases.items()}
+        unchanged = {name: rounded(fn()) == results[name] for name, fn in cases.items()}
+        with db.get_connection(readonly=True) as conn:
+            hot_rows = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+        drift = len(db.verify_rollup())
+        db.close()
+
+    print(json.dumps({
+        "transactions": args.transactions,
+        "archived_years": len(archived),
+        "archived_rows": sum(a["rows"] for a in archived),
+        "archive_bytes": sum(a["bytes"] for a in archived),
+        "archive_seconds": round(archive_seconds, 2),
+        "hot_rows_after": hot_rows,
+        "table_ms": hot,
+        "archive_ms": cold,
+        "unchanged": unchanged,
+        "rollup_drift": drift,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
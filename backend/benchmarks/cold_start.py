@@ -0,0 +1,114 @@
+"""Cold start of the API: import cost per package and time to the first /metadata response.
+
+The import profile comes from `python -X importtime -c "import api"` in a fresh interpreter.
+Then `--runs` uvicorn processes are started one after another against a synthetic database,
+and each is polled until GET /metadata answers. The time from spawning the process to that
+response is compared with `--budget-ms`, and the run exits non-zero when the median is over it
+or when `import api` loads one of the DEFERRED modules. The default budget of 1200 ms is the
+measured median of about 900 ms plus headroom; with numpy imported by core it was about 1120 ms:
+
+    python -m benchmarks.cold_start --budget-ms 2000
+    python -m benchmarks.cold_start --db bench.db --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import httpx
+
+from benchmarks.load_test import free_port, start_server
+from benchmarks.synthetic import build_database
+
+# First-party modules are reported by name, everything else by top-level package
+FIRST_PARTY = ("api", "core", "declaration_run", "compression", "metrics", "tax_engine", "archive")
+# Imported by the paths that use them (archive, brackets, batch calculations, enabled metrics), never on cold start
+DEFERRED = ("numpy", "archive", "tax_engine", "metrics")
+
+
+def import_profile(top: int) -> dict:
+    """Import time (ms) of the first-party modules and the costliest packages for `import api` in a fresh interpreter"""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import api"], capture_output=True, text=True,
+                         check=True)
+    self_us, cumulative_us = defaultdict(int), defaultdict(int)
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+        # Self times are disjoint, so their sum per package is what the package itself costs
+        self_us[package] += int(own)
+        cumulative_us[package] = max(cumulative_us[package], int(cumulative))
+    packages = [p for p in sorted(self_us, key=self_us.get, reverse=True) if p not in FIRST_PARTY][:top]
+    return {
+        "total_ms": round(cumulative_us["api"] / 1000, 1),
+        # Cumulative includes what a module imports, e.g. core includes dotenv
+        "modules": {m: {"self_ms": round(self_us[m] / 1000, 1), "cumulative_ms": round(cumulative_us[m] / 1000, 1)}
+                    for m in FIRST_PARTY if m in self_us},
+        "packages_self_ms": {p: round(self_us[p] / 1000, 1) for p in packages},
+        "deferred_loaded": [m for m in DEFERRED if m in self_us],
+    }
+
+
+def first_response(db_path: str, timeout: float) -> dict:
+    """Spawns uvicorn and polls GET /metadata; returns the spawn-to-response time and the in-process profile"""
+    port = free_port()
+    started = time.perf_counter()
+    server = start_server(db_path, port, {})
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=timeout) as client:
+            while True:
+                try:
+                    if client.get("/metadata").status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if time.perf_counter() - started > timeout:
+                    raise RuntimeError("API did not answer /metadata in time")
+                time.sleep(0.005)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            return {"first_metadata_ms": round(elapsed_ms, 1), "startup": client.get("/stats/startup").json()}
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="Database to serve (default: a synthetic one built in a temp directory)")
+    parser.add_argument("--rows", type=int, default=10_000, help="Size of the synthetic database")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--budget-ms", type=float, default=1200.0,
+                        help="Allowed median time from process spawn to the first /metadata response")
+    parser.add_argument("--top", type=int, default=10, help="Third-party packages listed in the import profile")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    report = {"import": import_profile(args.top)}
+    with tempfile.TemporaryDirectory(prefix="mtax-cold-") as work_dir:
+        path = args.db
+        if not path:
+            path = os.path.join(work_dir, "cold.db")
+            build_database(path, args.rows).close()
+        runs = [first_response(path, args.timeout) for _ in range(args.runs)]
+
+    median = statistics.median(run["first_metadata_ms"] for run in runs)
+    report["cold_start"] = {
+        "runs": [run["first_metadata_ms"] for run in runs],
+        "median_ms": round(median, 1),
+        "budget_ms": args.budget_ms,
+        "over_budget": median > args.budget_ms,
+        # In-process phases of the last run: api.py import, init_db, ready, Database/service construction
+        "startup": runs[-1]["startup"],
+    }
+    print(json.dumps(report, indent=2))
+    return 1 if median > args.budget_ms or report["import"]["deferred_loaded"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
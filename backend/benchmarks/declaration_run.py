@@ -0,0 +1,58 @@
+"""Throughput of a batch declaration run (declaration_run.py) by number of worker processes.
+
+Builds a synthetic database and prepares the drafts of every taxpayer once per worker count,
+reporting taxpayers per second, the speedup over one worker and whether every run saved the
+same drafts. Speedup is bounded by the CPUs of the machine (reported as `cpus`) and includes
+the start-up of the spawned workers:
+
+    python -m benchmarks.declaration_run --taxpayers 10000 --transactions 1000000 --workers 1 2 4 8
+"""
+import argparse
+import json
+import os
+import tempfile
+
+from benchmarks.synthetic import build_database
+from declaration_run import DeclarationRun, run_declarations
+
+
+def saved_drafts(db, name: str) -> list:
+    with db.get_connection(readonly=True) as conn:
+        return [tuple(row) for row in conn.execute("""
+            SELECT taxpayer_id, year, expense_method, ROUND(total_income, 2), ROUND(net_tax_to_pay, 2)
+            FROM declarations WHERE name = ? AND status = 'draft' ORDER BY taxpayer_id""", (name,))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--taxpayers", type=int, default=2000)
+    parser.add_argument("--transactions", type=int, default=200_000)
+    parser.add_argument("--year", type=int, default=2024)
+    parser.add_argument("--method", default="optimal")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    runs = []
+    with tempfile.TemporaryDirectory(prefix="mtax-run-") as work_dir:
+        db = build_database(os.path.join(work_dir, "bench.db"), args.transactions, taxpayers=args.taxpayers,
+                            sources_per_taxpayer=5, years=range(args.year - 2, args.year + 1))
+        reference = None
+        for workers in args.workers:
+            run = run_declarations(db, DeclarationRun(args.year, args.method, workers=workers))
+            status = run.status()
+            drafts = saved_drafts(db, run.name)
+            reference = reference if reference is not None else drafts
+            runs.append({key: status[key] for key in ("workers", "state", "done", "saved", "failed", "elapsed_seconds",
+                                                      "per_second", "error")})
+            runs[-1]["same_drafts"] = drafts == reference
+        db.close()
+
+    base = runs[0]["per_second"] or 1
+    for run in runs:
+        run["speedup"] = round(run["per_second"] / base, 2)
+    print(json.dumps({"cpus": os.cpu_count(), "taxpayers": args.taxpayers, "transactions": args.transactions,
+                      "method": args.method, "runs": runs}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
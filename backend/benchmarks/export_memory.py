@@ -0,0 +1,79 @@
+"""Peak memory of the streaming transaction export versus a fully materialized list.
+
+Each mode runs in its own subprocess so the reported peak RSS is not shared:
+
+    python -m benchmarks.export_memory --rows 1000000
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from core import Database, TransactionService
+from benchmarks.synthetic import build_database
+
+MODES = ("stream_ndjson", "stream_csv", "fetchall")
+
+
+def peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_mode(path: str, mode: str) -> dict:
+    tx_service = TransactionService(Database(path))
+    baseline = peak_rss_mb()
+    started = time.perf_counter()
+    written = 0
+    with open(os.devnull, "w", encoding="utf-8") as sink:
+        if mode == "fetchall":
+            rows = tx_service.get_transactions()
+            for row in rows:
+                written += sink.write(json.dumps(row, ensure_ascii=False) + "\n")
+        else:
+            fmt = mode.split("_", 1)[1]
+            for chunk in tx_service.export_transactions(fmt=fmt):
+                written += sink.write(chunk)
+    return {
+        "mode": mode,
+        "seconds": round(time.perf_counter() - started, 3),
+        "chars_written": written,
+        "baseline_rss_mb": round(baseline, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--db", help="Existing database to export instead of a synthetic one")
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)  # Internal: single-mode child process
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args.db, args.mode)))
+        return
+
+    with tempfile.TemporaryDirectory(prefix="mtax-bench-") as work_dir:
+        path = args.db
+        if not path:
+            path = os.path.join(work_dir, "bench.db")
+            build_database(path, args.rows).close()
+        results = []
+        for mode in MODES:
+            out = subprocess.run([sys.executable, "-m", "benchmarks.export_memory", "--db", path, "--mode", mode],
+                                 check=True, capture_output=True, text=True)
+            results.append(json.loads(out.stdout))
+    print(json.dumps({"rows": args.rows if not args.db else None, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""p50/p99 latency of the API under concurrent mixed traffic.
+
+Starts uvicorn in a subprocess against a synthetic database and drives it with `--concurrency`
+async clients issuing a weighted mix of GET /metadata, paged GET /transactions and
+POST /declarations/calculate:
+
+    python -m benchmarks.load_test --rows 200000 --concurrency 32 --requests 3000
+    python -m benchmarks.load_test --url http://127.0.0.1:8000 --taxpayers 1 --years 2024
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.synthetic import build_database
+
+# (name, weight) of each request kind in the mix
+MIX = (("metadata", 4), ("transactions", 4), ("calculate", 2))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    k = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def start_server(db_path: str, port: int, workers_env: dict) -> subprocess.Popen:
+    env = dict(os.environ, DB_PATH=db_path, **workers_env)
+    return subprocess.Popen([sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(port),
+                             "--log-level", "warning"], env=env)
+
+
+async def wait_ready(client: httpx.AsyncClient, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if (await client.get("/stats/cache")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError("API did not start in time")
+        await asyncio.sleep(0.2)
+
+
+def make_request(kind: str, rnd: random.Random, taxpayers: int, years: list):
+    taxpayer_id, year = rnd.randint(1, taxpayers), rnd.choice(years)
+    if kind == "metadata":
+        return "GET", "/metadata", None
+    if kind == "transactions":
+        return "GET", f"/transactions?year={year}&taxpayer_id={taxpayer_id}&limit=100", None
+    method = rnd.choice(("lump_sum", "actual"))
+    return "POST", "/declarations/calculate", {"taxpayer_id": taxpayer_id, "year": year, "method": method,
+                                               "other_deductions": []}
+
+
+async def drive(base_url: str, total: int, concurrency: int, taxpayers: int, years: list, seed: int) -> dict:
+    rnd = random.Random(seed)
+    kinds = [name for name, weight in MIX for _ in range(weight)]
+    plan = [(kind,) + make_request(kind, rnd, taxpayers, years) for kind in (rnd.choice(kinds) for _ in range(total))]
+    latencies = {name: [] for name, _ in MIX}
+    errors = {name: 0 for name, _ in MIX}
+    queue = iter(plan)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        await wait_ready(client)
+
+        async def worker():
+            for kind, method, path, body in queue:
+                started = time.perf_counter()
+                try:
+                    response = await client.request(method, path, json=body)
+                    ok = response.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                latencies[kind].append((time.perf_counter() - started) * 1000)
+                if not ok:
+                    errors[kind] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        pool_stats = (await client.get("/stats/db-pool")).json()
+
+    def summarize(values: list) -> dict:
+        values = sorted(values)
+        return {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 0.50), 2),
+            "p99_ms": round(percentile(values, 0.99), 2),
+            "max_ms": round(values[-1], 2) if values else None,
+        }
+
+    result = {name: dict(summarize(values), errors=errors[name]) for name, values in latencies.items()}
+    result["all"] = summarize([v for values in latencies.values() for v in values])
+    result["all"]["requests_per_second"] = round(total / elapsed, 1)
+    result["pool"] = pool_stats
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--taxpayers", type=int, default=20)
+    parser.add_argument("--years", type=int, nargs="+", default=list(range(2015, 2025)))
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--max-concurrency", type=int, help="DB_MAX_CONCURRENCY for the started server")
+    parser.add_argument("--url", help="Drive an already running API instead of starting one")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    report = {"requests": args.requests, "concurrency": args.concurrency}
+    if args.url:
+        report["results"] = asyncio.run(drive(args.url, args.requests, args.concurrency, args.taxpayers,
+                                              args.years, args.seed))
+        print(json.dumps(report, indent=2))
+        return
+
+    workers_env = {"DB_MAX_CONCURRENCY": str(args.max_concurrency)} if args.max_concurrency else {}
+    with tempfile.TemporaryDirectory(prefix="mtax-load-") as work_dir:
+        path = os.path.join(work_dir, "load.db")
+        build_database(path, args.rows, taxpayers=args.taxpayers, years=range(min(args.years), max(args.years) + 1)).close()
+        port = free_port()
+        server = start_server(path, port, workers_env)
+        try:
+            report["rows"] = args.rows
+            report["results"] = asyncio.run(drive(f"http://127.0.0.1:{port}", args.requests, args.concurrency,
+                                                  args.taxpayers, args.years, args.seed))
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""Timings of the backend hot paths on a synthetic database, written as JSON.
+
+Covers TransactionService.get_transactions with each filter, get_summary, the /metadata
+loaders, DeclarationService.calculate, full-text search, analytics, bulk inserts and the API endpoints through an
+in-process TestClient. Compare two runs to spot regressions between commits:
+
+    python -m benchmarks.suite --transactions 100000 --output before.json
+    python -m benchmarks.suite --transactions 100000 --output after.json --baseline before.json
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+from fastapi.testclient import TestClient
+
+from core import Database, DeclarationService, Transaction, TransactionService
+from benchmarks.synthetic import build_database
+
+YEAR = 2024
+
+# get_transactions / get_summary filter cases, one per filter accepted by GET /transactions
+FILTER_CASES = {
+    "all": {},
+    "year": {"year": YEAR},
+    "year_month": {"year": YEAR, "month": 6},
+    "taxpayer": {"taxpayer_id": 1},
+    "taxpayer_year": {"taxpayer_id": 1, "year": YEAR},
+    "type": {"transaction_type": -1},
+    "source": {"source_id": 1},
+    "source_list": {"source_id": [1, 2, 3]},
+    "taxable": {"is_taxable": True},
+    "tax_item": {"tax_items_id": 2},
+}
+
+
+def measure(fn, repeat: int) -> dict:
+    fn()  # Warm-up: statement cache, reference cache, page cache
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return {
+        "repeat": repeat,
+        "min_ms": round(min(samples), 3),
+        "median_ms": round(statistics.median(samples), 3),
+        "mean_ms": round(statistics.fmean(samples), 3),
+    }
+
+
+def git_commit() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def service_cases(db, args) -> dict:
+    tx_service = TransactionService(db)
+    dec_service = DeclarationService(db)
+    cases = {}
+    for name, filters in FILTER_CASES.items():
+        if name == "all" and args.transactions > args.full_list_limit:
+            continue
+        cases[f"get_transactions.{name}"] = lambda f=filters: tx_service.get_transactions(**f)
+    for name, filters in FILTER_CASES.items():
+        cases[f"get_summary.{name}"] = lambda f=filters: tx_service.get_summary(**f)
+
+    def metadata_cold():
+        db.cache.invalidate("taxpayers", "sources", "payment_methods", "tax_items", "transactions")
+        return metadata_warm()
+
+    def metadata_warm():
+        return api_module(db.db_name).load_metadata()
+
+    cases["metadata.cold"] = metadata_cold
+    cases["metadata.warm"] = metadata_warm
+    for method in ("lump_sum", "actual"):
+        cases[f"calculate.{method}"] = lambda m=method: dec_service.calculate(1, YEAR, m, [])
+    cases["calculate_batch.all_taxpayers"] = lambda: dec_service.calculate_batch(
+        [(tp, YEAR, m) for tp in range(1, args.taxpayers + 1) for m in ("lump_sum", "actual")])
+    cases["optimize"] = lambda: dec_service.optimize(1, YEAR)
+    cases["search.word"] = lambda: tx_service.search_transactions("konut")
+    cases["search.prefix_taxpayer_year"] = lambda: tx_service.search_transactions("ai", taxpayer_id=1, year=YEAR)
+    cases["search.rare"] = lambda: tx_service.search_transactions("transaction 4242")
+    years = list(range(YEAR - 2, YEAR + 1))
+    cases["analytics.year_month"] = lambda: tx_service.get_analytics(["year", "month"], years=years)
+    cases["analytics.taxpayer_year"] = lambda: tx_service.get_analytics(["taxpayer_id", "year"])
+    cases["analytics.payment_method"] = lambda: tx_service.get_analytics(["payment_method_id"], years=[YEAR])
+    return cases
+
+
+def api_cases(client, args) -> dict:
+    calculate = {"taxpayer_id": 1, "year": YEAR, "method": "actual", "other_deductions": []}
+    etag = client.get("/metadata").headers["etag"]
+    cases = {
+        "api.metadata": lambda: client.get("/metadata"),
+        "api.metadata_304": lambda: client.get("/metadata", headers={"If-None-Match": etag}),
+        "api.transactions.taxpayer_year": lambda: client.get(f"/transactions?taxpayer_id=1&year={YEAR}"),
+        "api.transactions.taxpayer_year_columnar": lambda: client.get(f"/transactions?taxpayer_id=1&year={YEAR}&shape=columnar"),
+        "api.transactions.page": lambda: client.get(f"/transactions?year={YEAR}&limit=100"),
+        "api.transactions.export_taxpayer_year": lambda: client.get(f"/transactions/export?taxpayer_id=1&year={YEAR}"),
+        "api.declarations.calculate": lambda: client.post("/declarations/calculate", json=calculate),
+        "api.declarations.optimize": lambda: client.post("/declarations/optimize", json={"taxpayer_id": 1, "year": YEAR}),
+    }
+    return cases
+
+
+_api = None
+
+
+def api_module(path: str):
+    """api.py with its service container pointed at the benchmark file"""
+    global _api
+    if _api is None:
+        _api = importlib.import_module("api")
+        # DB_PATH was read when core was imported, so the Database is swapped in afterwards
+        _api.services.use(Database(path))
+    return _api
+
+
+def bulk_insert(db, rows: int) -> dict:
+    tx_service = TransactionService(db)
+    batch = [Transaction(id=None, taxpayer_id=1, transaction_date=f"{YEAR}-01-15", year=YEAR, month=1, day=15, type=1,
+                         source_id=1, payment_method_id=1, document_id=None, amount=1000.0 + i % 100,
+                         description=f"Bulk {i}", is_taxable=True, tax_items_id=1) for i in range(rows)]
+    started = time.perf_counter()
+    inserted, errors = tx_service.add_transactions(batch)
+    seconds = time.perf_counter() - started
+    return {"rows": inserted, "errors": len(errors), "seconds": round(seconds, 3),
+            "rows_per_second": round(inserted / seconds)}
+
+
+def compare(results: dict, baseline: dict, threshold: float, min_delta_ms: float) -> dict:
+    # Fastest samples are compared, they are the least affected by scheduler noise
+    changes = {}
+    for name, current in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if not previous or "min_ms" not in current or not previous.get("min_ms"):
+            continue
+        ratio = current["min_ms"] / previous["min_ms"]
+        changes[name] = {"baseline_min_ms": previous["min_ms"], "ratio": round(ratio, 3),
+                         "regression": ratio > threshold and current["min_ms"] - previous["min_ms"] > min_delta_ms}
+    return changes
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transactions", type=int, default=100_000)
+    parser.add_argument("--taxpayers", type=int, default=10)
+    parser.add_argument("--sources-per-taxpayer", type=int, default=20)
+    parser.add_argument("--years", type=int, default=10, help=f"Number of years ending with {YEAR}")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--bulk-rows", type=int, default=50_000)
+    parser.add_argument("--full-list-limit", type=int, default=1_000_000,
+                        help="Skip the unfiltered get_transactions case above this many rows")
+    parser.add_argument("--db", help="Existing synthetic database to benchmark (bulk_insert adds rows to it)")
+    parser.add_argument("--output", help="Write the JSON report here as well as to stdout")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=1.3, help="Slowdown ratio counted as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0, help="Ignore slowdowns smaller than this")
+    args = parser.parse_args()
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+    with tempfile.TemporaryDirectory(prefix="mtax-bench-") as work_dir:
+        path = args.db
+        started = time.perf_counter()
+        if not path:
+            path = os.path.join(work_dir, "bench.db")
+            build_database(path, args.transactions, taxpayers=args.taxpayers,
+                           sources_per_taxpayer=args.sources_per_taxpayer,
+                           years=range(YEAR - args.years + 1, YEAR + 1)).close()
+        build_seconds = time.perf_counter() - started
+
+        # Services and endpoints share the api module's Database, as they do in production
+        api = api_module(path)
+        db = api.services.db
+        db.init_db()
+        results = {name: measure(fn, args.repeat) for name, fn in service_cases(db, args).items()}
+
+        client = TestClient(api.app)
+        results.update({name: measure(fn, args.repeat) for name, fn in api_cases(client, args).items()})
+
+        # Last, because it adds rows to the database
+        results["bulk_insert"] = bulk_insert(db, args.bulk_rows)
+        db.close()
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "transactions": args.transactions if not args.db else None,
+            "taxpayers": args.taxpayers,
+            "repeat": args.repeat,
+            "build_seconds": round(build_seconds, 1),
+        },
+        "results": results,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            report["comparison"] = compare(results, json.load(f), args.threshold, args.min_delta_ms)
+        regressions = [name for name, change in report["comparison"].items() if change["regression"]]
+        report["regressions"] = regressions
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
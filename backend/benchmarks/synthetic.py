@@ -0,0 +1,130 @@
+"""Synthetic mTax databases built from Schema.sql for benchmarks.
+
+The generated data follows the shape of a real portfolio: a few taxpayers own most of the
+activity, every source has its own typical amount that grows with yearly rent increases,
+income comes from mesken (gross) and işyeri (net) rents, and expenses are spread over the
+tax items. Databases can also be created from the command line:
+
+    python -m benchmarks.synthetic bench.db --transactions 1000000 --taxpayers 100
+"""
+import argparse
+import itertools
+import json
+import random
+import time
+
+from core import Database, TaxSetting, TaxSettingService
+
+INSERT_TRANSACTION = """INSERT INTO transactions (taxpayer_id, transaction_date, year, month, day, type, source_id,
+                        payment_method_id, amount, description, is_taxable, tax_items_id)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+TAX_BRACKETS = '[{"limit":158000,"rate":0.15},{"limit":330000,"rate":0.2},{"limit":800000,"rate":0.27},{"limit":4300000,"rate":0.35},{"limit":999999999,"rate":0.4}]'
+
+# The first item is the income item, the rest are expense items
+TAX_ITEM_NAMES = ("Kira Geliri", "Aidat", "Onarım", "Sigorta", "Emlak Vergisi", "Yönetim Gideri", "Elektrik",
+                  "Su", "Doğalgaz", "Faiz", "Amortisman", "Diğer Giderler")
+PAYMENT_METHOD_NAMES = ("Banka", "Nakit", "Kredi Kartı", "Çek")
+
+# Source kinds by position within a taxpayer's sources (repeats every 10):
+# (name, transaction type, is_net, deduction_type, lognormal mu, lognormal sigma, relative frequency)
+SOURCE_KINDS = (
+    ("Konut", 1, 0, 0, 9.5, 0.6, 4.0),
+    ("Konut", 1, 0, 0, 9.5, 0.6, 4.0),
+    ("İşyeri", 1, 1, 0, 10.3, 0.7, 3.0),
+    ("Konut", 1, 0, 0, 9.5, 0.6, 4.0),
+    ("Gider", -1, 0, 0, 7.8, 1.0, 2.0),
+    ("Konut", 1, 0, 0, 9.5, 0.6, 4.0),
+    ("İşyeri", 1, 1, 0, 10.3, 0.7, 3.0),
+    ("Gider", -1, 0, 0, 7.8, 1.0, 2.0),
+    ("İşyeri Gider", -1, 1, 0, 8.2, 1.0, 1.5),
+    ("Özel İndirim", -1, 0, 1, 8.5, 0.8, 0.5),
+)
+YEARLY_INCREASE = 1.25  # Rents and expenses grow every year
+
+
+def build_database(path: str, transactions: int, taxpayers: int = 1, sources_per_taxpayer: int = 20,
+                   years: range = range(2015, 2025), seed: int = 42, tax_items: int = len(TAX_ITEM_NAMES),
+                   payment_methods: int = 2) -> Database:
+    """Creates `path` from Schema.sql and fills it with reproducible random data"""
+    db = Database(path)
+    db.init_db()
+    rnd = random.Random(seed)
+    year_list = list(years)
+    tax_items = max(2, tax_items)
+    with db.get_connection() as conn:
+        conn.executemany("INSERT INTO taxpayers (id, full_name) VALUES (?, ?)",
+                         [(i, f"Taxpayer {i}") for i in range(1, taxpayers + 1)])
+        conn.executemany("INSERT INTO payment_methods (id, method_name) VALUES (?, ?)",
+                         [(i + 1, f"{PAYMENT_METHOD_NAMES[i % len(PAYMENT_METHOD_NAMES)]} {i + 1}")
+                          for i in range(payment_methods)])
+        conn.executemany("INSERT INTO tax_items (id, code, name) VALUES (?, ?, ?)",
+                         [(i + 1, f"{i + 1:03d}", TAX_ITEM_NAMES[i % len(TAX_ITEM_NAMES)]) for i in range(tax_items)])
+
+        # Activity is skewed: taxpayer k gets weight 1 / k^0.8
+        sources, profiles, weights = [], [], []
+        for tp in range(1, taxpayers + 1):
+            for k in range(sources_per_taxpayer):
+                sid = (tp - 1) * sources_per_taxpayer + k + 1
+                kind, tx_type, is_net, deduction_type, mu, sigma, frequency = SOURCE_KINDS[k % len(SOURCE_KINDS)]
+                sources.append((sid, f"{kind} {sid}", tp, tx_type, is_net, deduction_type))
+                profiles.append((sid, tp, tx_type, rnd.lognormvariate(mu, sigma)))
+                weights.append(frequency / tp ** 0.8)
+        conn.executemany("INSERT INTO sources (id, name, taxpayer_id, type, is_net, deduction_type) VALUES (?, ?, ?, ?, ?, ?)",
+                         sources)
+
+        cum_weights = list(itertools.accumulate(weights))
+        pm_weights = list(itertools.accumulate(1 / (i + 1) ** 1.5 for i in range(payment_methods)))
+        growth = {y: YEARLY_INCREASE ** (y - year_list[0]) for y in year_list}
+        done = 0
+        while done < transactions:
+            size = min(50000, transactions - done)
+            picks = rnd.choices(profiles, cum_weights=cum_weights, k=size)
+            methods = rnd.choices(range(1, payment_methods + 1), cum_weights=pm_weights, k=size)
+            batch = []
+            for i, ((source_id, tp, tx_type, base), pm) in enumerate(zip(picks, methods)):
+                year = rnd.choice(year_list)
+                month, day = rnd.randint(1, 12), rnd.randint(1, 28)
+                amount = round(base * growth[year] * rnd.uniform(0.9, 1.1), 2)
+                if tx_type == 1:
+                    item, taxable = 1, rnd.random() < 0.9
+                else:
+                    item, taxable = rnd.randint(2, tax_items), rnd.random() < 0.75
+                batch.append((tp, f"{year}-{month:02d}-{day:02d}", year, month, day, tx_type, source_id,
+                              pm, amount, f"Synthetic transaction {done + i}", 1 if taxable else 0, item))
+            conn.executemany(INSERT_TRANSACTION, batch)
+            done += size
+    # Raw executemany bypasses TransactionService, so the rollup and search index are built once at the end
+    db.rebuild_rollup()
+    db.rebuild_search_index()
+
+    ts_service = TaxSettingService(db)
+    for year in year_list:
+        ts_service.save_settings(TaxSetting(year=year, exemption_amount=47000.0, declaration_limit=330000.0,
+                                            lump_sum_rate=0.15, withholding_rate=0.20, tax_brackets=TAX_BRACKETS))
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument("--transactions", type=int, default=100_000)
+    parser.add_argument("--taxpayers", type=int, default=10)
+    parser.add_argument("--sources-per-taxpayer", type=int, default=20)
+    parser.add_argument("--tax-items", type=int, default=len(TAX_ITEM_NAMES))
+    parser.add_argument("--payment-methods", type=int, default=2)
+    parser.add_argument("--first-year", type=int, default=2015)
+    parser.add_argument("--last-year", type=int, default=2024)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    build_database(args.path, args.transactions, taxpayers=args.taxpayers,
+                   sources_per_taxpayer=args.sources_per_taxpayer, years=range(args.first_year, args.last_year + 1),
+                   seed=args.seed, tax_items=args.tax_items, payment_methods=args.payment_methods).close()
+    print(json.dumps({"path": args.path, "transactions": args.transactions, "taxpayers": args.taxpayers,
+                      "seconds": round(time.perf_counter() - started, 1)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Throughput of DeclarationService.calculate_batch versus calling calculate once per taxpayer,
+and of repeated calculate calls served by the calculation cache.
+
+    python -m benchmarks.tax_batch --taxpayers 10000 --transactions 1000000
+    python -m benchmarks.tax_batch --backend memory   # same data copied into a MemoryRepository, no disk I/O
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from core import DeclarationService
+from benchmarks.synthetic import build_database
+from memory_repository import MemoryRepository
+
+METHODS = ("lump_sum", "actual")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--taxpayers", type=int, default=10000)
+    parser.add_argument("--transactions", type=int, default=1_000_000)
+    parser.add_argument("--year", type=int, default=2024)
+    parser.add_argument("--scalar-sample", type=int, default=500, help="Taxpayers timed on the scalar path")
+    parser.add_argument("--backend", choices=("sqlite", "memory"), default="sqlite")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="mtax-bench-") as work_dir:
+        db = build_database(os.path.join(work_dir, "bench.db"), args.transactions, taxpayers=args.taxpayers,
+                            sources_per_taxpayer=5, years=range(args.year - 2, args.year + 1))
+        dec_service = DeclarationService(MemoryRepository.from_database(db) if args.backend == "memory" else db)
+        jobs = [(tp, args.year, m, []) for tp in range(1, args.taxpayers + 1) for m in METHODS]
+
+        started = time.perf_counter()
+        batch = dec_service.calculate_batch(jobs)
+        batch_seconds = time.perf_counter() - started
+
+        sample = jobs[:args.scalar_sample * len(METHODS)]
+        started = time.perf_counter()
+        scalar = [dec_service.calculate(*job) for job in sample]
+        scalar_seconds = time.perf_counter() - started
+
+        # Same calls again, unchanged data: every one is a calculation cache hit
+        started = time.perf_counter()
+        cached = [dec_service.calculate(*job) for job in sample]
+        cached_seconds = time.perf_counter() - started
+        cache_stats = dec_service.cache.calculations.stats()
+
+        worst = max(abs(s[k] - b[k]) for s, b in zip(scalar, batch) for k in s if isinstance(s[k], float))
+        db.close()
+
+    print(json.dumps({
+        "backend": args.backend,
+        "declarations": len(jobs),
+        "batch_seconds": round(batch_seconds, 3),
+        "batch_per_second": round(len(jobs) / batch_seconds),
+        "scalar_per_second": round(len(sample) / scalar_seconds),
+        "cached_per_second": round(len(sample) / cached_seconds),
+        "cached_matches": cached == scalar,
+        "calculation_cache": cache_stats,
+        "speedup": round((len(jobs) / batch_seconds) / (len(sample) / scalar_seconds), 1),
+        "max_abs_difference": worst,
+        "matches_to_kurus": worst < 0.005,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
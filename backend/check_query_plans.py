@@ -0,0 +1,94 @@
+"""Query plan regression check for TransactionService.get_transactions.
+
+Runs EXPLAIN QUERY PLAN for every filter combination accepted by GET /transactions
+and exits with a non-zero status if any of them scans the whole transactions table (also through
+a whole index), or if a dashboard filter (SORTED_FILTERS) needs a temp B-tree to sort the list.
+
+    python check_query_plans.py                 # fresh database built from Schema.sql
+    python check_query_plans.py personal_finance.db
+"""
+import itertools
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+from core import Database, TransactionService
+
+# One representative value per filter the API accepts (source_id also comes as a list)
+FILTER_VALUES = {
+    "year": [2025],
+    "month": [3],
+    "taxpayer_id": [1],
+    "transaction_type": [1],
+    "source_id": [1, [1, 2]],
+    "is_taxable": [True],
+    "tax_items_id": [8],
+}
+
+# "SCAN t", with or without "USING INDEX", visits every row of transactions
+TABLE_SCAN = re.compile(r"^SCAN t\b")
+TEMP_SORT = "USE TEMP B-TREE FOR ORDER BY"
+# The one allowed scan: without a selective filter (only type and is_taxable, which keep about half the
+# rows each) the list is most of the table. Walking idx_transactions_sort returns the rows in list order,
+# so a page stops after its LIMIT rows instead of sorting the whole table.
+UNSELECTIVE_FILTERS = {"transaction_type", "is_taxable"}
+ALLOWED_SCAN = "SCAN t USING INDEX idx_transactions_sort"
+# Selective filters of the dashboard lists and their pages; these must read the list order from an index
+SORTED_FILTERS = [set(), {"year"}, {"taxpayer_id"}, {"taxpayer_id", "year"}, {"month"}, {"year", "month"}]
+
+
+def filter_combinations():
+    names = list(FILTER_VALUES)
+    for r in range(len(names) + 1):
+        for combo in itertools.combinations(names, r):
+            for values in itertools.product(*(FILTER_VALUES[n] for n in combo)):
+                yield dict(zip(combo, values))
+
+
+def plan_problems(filters: dict, plan: list) -> list:
+    selective = set(filters) - UNSELECTIVE_FILTERS
+    problems = [f"TABLE SCAN ({line})" for line in plan
+                if TABLE_SCAN.match(line) and (selective or line != ALLOWED_SCAN)]
+    if selective in SORTED_FILTERS and TEMP_SORT in plan:
+        problems.append("TEMP B-TREE SORT")
+    return problems
+
+
+def find_plan_problems(db: Database) -> list:
+    tx_service = TransactionService(db)
+    failures = []
+    for filters in filter_combinations():
+        plan = tx_service.explain_transactions(**filters)
+        problems = plan_problems(filters, plan)
+        if problems:
+            failures.append((filters, problems, plan))
+    return failures
+
+
+def main(argv) -> int:
+    work_dir = tempfile.mkdtemp(prefix="mtax-plan-")
+    try:
+        db_path = os.path.join(work_dir, "plan.db")
+        if len(argv) > 1:
+            # Work on a copy so migrations never touch the original file
+            shutil.copyfile(argv[1], db_path)
+        db = Database(db_path)
+        db.init_db()
+        failures = find_plan_problems(db)
+        total = sum(1 for _ in filter_combinations())
+        db.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for filters, problems, plan in failures:
+        print(f"{', '.join(problems)} {filters}")
+        for line in plan:
+            print(f"    {line}")
+    print(f"{total - len(failures)}/{total} filter combinations are index-backed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,237 @@
+"""Conformance check for Repository backends.
+
+Runs the same scenario through the services on every backend: reference data, bulk imports
+with rejected rows, edits and deletes, tax settings, declarations, batch drafts and all
+calculations. After each step the service results of every backend are compared with
+SqliteRepository's (amounts within 0.005) and the run exits with a non-zero status on the first
+difference. A new backend passes when it is added to BACKENDS and this check stays green:
+
+    python check_repositories.py
+    python check_repositories.py --transactions 20000 --seed 7
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+from dataclasses import asdict, is_dataclass, replace
+
+from core import (Database, Declaration, DeclarationService, PaymentMethod, PaymentMethodService, Source,
+                  SourceService, SqliteRepository, TaxItem, TaxItemService, TaxSetting, TaxSettingService, Taxpayer,
+                  TaxpayerService, Transaction, TransactionService)
+from memory_repository import MemoryRepository
+
+TOLERANCE = 0.005
+# Set by the backend when the row is written, so it differs between runs
+IGNORED_KEYS = {"created_at"}
+YEARS = (2023, 2024, 2025)
+BRACKETS = '[{"limit":158000,"rate":0.15},{"limit":330000,"rate":0.2},{"limit":800000,"rate":0.27},{"limit":4300000,"rate":0.35},{"limit":999999999,"rate":0.4}]'
+
+BACKENDS = {
+    "sqlite": lambda work_dir: SqliteRepository(_sqlite_database(work_dir)),
+    "memory": lambda work_dir: MemoryRepository(),
+}
+
+
+def _sqlite_database(work_dir: str) -> Database:
+    # Characters that are URI syntax to SQLite, the read-only pool must still open the same file
+    db_dir = os.path.join(work_dir, "mtax #1 100%")
+    os.makedirs(db_dir, exist_ok=True)
+    db = Database(os.path.join(db_dir, "conformance.db"))
+    db.init_db()
+    return db
+
+
+def normalize(value):
+    """Plain JSON-like values: dataclasses as dicts, tuples as lists, backend-set keys dropped"""
+    if is_dataclass(value):
+        value = asdict(value)
+    if isinstance(value, dict):
+        return {k: normalize(v) for k, v in value.items() if k not in IGNORED_KEYS}
+    if isinstance(value, (list, tuple)):
+        return [normalize(v) for v in value]
+    return value
+
+
+def differences(expected, actual, path: str = "") -> list:
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        found = [f"{path}.{k}: missing on one side" for k in expected.keys() ^ actual.keys()]
+        for k in expected.keys() & actual.keys():
+            found += differences(expected[k], actual[k], f"{path}.{k}")
+        return found
+    if isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            return [f"{path}: {len(expected)} items != {len(actual)} items"]
+        return [d for i, (e, a) in enumerate(zip(expected, actual)) for d in differences(e, a, f"{path}[{i}]")]
+    numbers = (int, float)
+    if isinstance(expected, numbers) and isinstance(actual, numbers) and not isinstance(expected, bool):
+        return [] if abs(expected - actual) <= TOLERANCE else [f"{path}: {expected!r} != {actual!r}"]
+    return [] if expected == actual else [f"{path}: {expected!r} != {actual!r}"]
+
+
+class Scenario:
+    """The service calls of the check, applied to one backend"""
+
+    def __init__(self, repo):
+        self.taxpayers = TaxpayerService(repo)
+        self.sources = SourceService(repo)
+        self.payment_methods = PaymentMethodService(repo)
+        self.tax_items = TaxItemService(repo)
+        self.transactions = TransactionService(repo)
+        self.tax_settings = TaxSettingService(repo)
+        self.declarations = DeclarationService(repo)
+
+    def reference_data(self, rnd: random.Random) -> dict:
+        taxpayer_ids = [self.taxpayers.add_taxpayer(Taxpayer(id=None, full_name=f"Mükellef {i}")) for i in range(1, 4)]
+        pm_ids = [self.payment_methods.add_payment_method(PaymentMethod(id=None, method_name=name))
+                  for name in ("Banka", "Nakit")]
+        item_ids = [self.tax_items.add_tax_item(TaxItem(id=None, code=f"{i:03d}", name=name))
+                    for i, name in enumerate(("Kira Geliri", "Aidat", "Onarım", "Sigorta"), start=1)]
+        source_ids = []
+        for tp in taxpayer_ids:
+            # Mesken, işyeri (net), general expense and special deduction sources per taxpayer
+            for name, tx_type, is_net, deduction_type in (("Konut", 1, 0, 0), ("İşyeri", 1, 1, 0),
+                                                          ("Gider", -1, 0, 0), ("Bağış", -1, 0, 1)):
+                source_ids.append(self.sources.add_source(Source(
+                    id=None, name=f"{name} {tp}", taxpayer_id=tp, type=tx_type, is_net=is_net,
+                    deduction_type=deduction_type, default_amount=round(rnd.uniform(1000, 50000), 2))))
+        for year in YEARS:
+            self.tax_settings.save_settings(TaxSetting(year=year, exemption_amount=47000.0, declaration_limit=330000.0,
+                                                       lump_sum_rate=0.15, withholding_rate=0.20, tax_brackets=BRACKETS))
+        return {"taxpayers": taxpayer_ids, "payment_methods": pm_ids, "tax_items": item_ids, "sources": source_ids}
+
+    def transaction(self, rnd: random.Random, t_id=None) -> Transaction:
+        source = rnd.choice(self.sources.get_all())
+        year, month, day = rnd.choice(YEARS), rnd.randint(1, 12), rnd.randint(1, 28)
+        return Transaction(id=t_id, taxpayer_id=source.taxpayer_id, transaction_date=f"{year}-{month:02d}-{day:02d}",
+                           year=year, month=month, day=day, type=source.type, source_id=source.id,
+                           payment_method_id=rnd.choice((1, 2)), document_id=None,
+                           amount=round(rnd.lognormvariate(9, 1), 2), description=f"İşlem {rnd.randint(1, 10 ** 6)}",
+                           is_taxable=rnd.random() < 0.8, tax_items_id=1 if source.type == 1 else rnd.randint(2, 4))
+
+    def snapshot(self, ids: dict) -> dict:
+        """Every read the services offer on all backends"""
+        result = {
+            "taxpayers": self.taxpayers.get_all(),
+            "sources": self.sources.get_all(),
+            "payment_methods": self.payment_methods.get_all(),
+            "tax_items": self.tax_items.get_all(),
+            "years": self.transactions.get_years(),
+            "last_year": self.transactions.get_last_year(),
+            "settings": [self.tax_settings.get_settings(year) for year in YEARS + (2030,)],
+        }
+        filter_sets = [{}, {"year": 2024}, {"taxpayer_id": ids["taxpayers"][0]},
+                       {"year": 2025, "taxpayer_id": ids["taxpayers"][1], "transaction_type": -1},
+                       {"month": 3, "is_taxable": True}, {"source_id": ids["sources"][:3], "is_taxable": False},
+                       {"source_id": ids["sources"][2], "tax_items_id": 3}]
+        for i, filters in enumerate(filter_sets):
+            result[f"transactions.{i}"] = self.transactions.get_transactions(**filters)
+            result[f"summary.{i}"] = self.transactions.get_summary(**filters)
+            result[f"with_summary.{i}"] = self.transactions.get_transactions_with_summary(**filters)[1]
+        jobs = []
+        for tp in ids["taxpayers"]:
+            for year in YEARS:
+                result[f"special_deductions.{tp}.{year}"] = self.declarations.get_special_deductions_from_db(tp, year)
+                result[f"declarations.{tp}.{year}"] = self.declarations.get_declarations(tp, year)
+                result[f"optimize.{tp}.{year}"] = self.declarations.optimize(tp, year)
+                for method in ("lump_sum", "actual"):
+                    deductions = [{"name": "Eğitim", "amount": 1500.0}]
+                    jobs.append((tp, year, method, deductions))
+                    try:
+                        result[f"calculate.{tp}.{year}.{method}"] = self.declarations.calculate(tp, year, method, deductions)
+                    except ValueError as e:
+                        result[f"calculate.{tp}.{year}.{method}"] = f"ValueError: {e}"
+        result["calculate_batch"] = self.declarations.calculate_batch(jobs)
+        return result
+
+
+def steps(scenario: Scenario, seed: int, transactions: int):
+    """Yields (step name, snapshot) after each change; identical seeds give identical calls on every backend"""
+    rnd = random.Random(seed)
+    ids = scenario.reference_data(rnd)
+    yield "reference data", scenario.snapshot(ids)
+
+    batch = [scenario.transaction(rnd) for _ in range(transactions)]
+    # A few rows the database rejects (NOT NULL columns)
+    for index in rnd.sample(range(transactions), k=min(5, transactions)):
+        batch[index] = replace(batch[index], amount=None)
+    bulk = scenario.transactions.add_transactions(batch, chunk_size=500)
+    yield "bulk import", dict(scenario.snapshot(ids), bulk=bulk)
+    atomic = [scenario.transaction(rnd) for _ in range(50)] + [replace(scenario.transaction(rnd), tax_items_id=None)]
+    bulk = scenario.transactions.add_transactions(atomic, atomic=True)
+    yield "atomic import", dict(scenario.snapshot(ids), bulk=bulk)
+
+    single = scenario.transactions.add_transaction(scenario.transaction(rnd))
+    moved = replace(scenario.transaction(rnd, t_id=single), year=2023, month=12)
+    scenario.transactions.update_transaction(moved)
+    scenario.transactions.delete_transaction(single - 1)
+    scenario.transactions.delete_transaction(single + 1000)  # Missing ids are ignored
+    yield "edit transactions", dict(scenario.snapshot(ids), single=scenario.transactions.get_transaction(single),
+                                    deleted=scenario.transactions.get_transaction(single - 1))
+
+    renamed = replace(scenario.sources.get_source(ids["sources"][0]), name="Konut (yeni)")
+    scenario.sources.update_source(renamed)
+    scenario.tax_items.update_tax_item(TaxItem(id=ids["tax_items"][1], code="002", name="Site Aidatı"))
+    scenario.payment_methods.delete_payment_method(ids["payment_methods"][1])
+    yield "edit reference data", scenario.snapshot(ids)
+
+    tp = ids["taxpayers"][0]
+    result = scenario.declarations.calculate(tp, 2023, "actual", [])
+    dec_ids = [scenario.declarations.save_declaration(Declaration(
+        id=None, taxpayer_id=tp, year=2023, name=f"Beyan {status}", expense_method="actual",
+        total_income=result["total_income"], exemption_applied=result["exemption_applied"],
+        expense_amount=result["expense_amount"], deductions_amount=result["deductions_amount"],
+        tax_base=result["tax_base"], calculated_tax=result["calculated_tax"], withholding_tax=result["withholding_tax"],
+        net_tax_to_pay=result["net_tax_to_pay"], status=status)) for status in ("draft", "final")]
+    # The final actual declaration blocks lump sum in the following years
+    yield "declarations", scenario.snapshot(ids)
+    scenario.declarations.delete_declaration(dec_ids[1])
+    yield "delete declaration", scenario.snapshot(ids)
+
+    # Batch drafts twice with the same name: the second save replaces the first one's drafts
+    for method in ("optimal", "actual"):
+        drafts = [scenario.declarations.prepare_declaration(tp, year, method, name="Toplu")
+                  for tp in ids["taxpayers"] for year in YEARS]
+        scenario.declarations.save_declarations([d for d in drafts if d], replace_drafts=True)
+    yield "batch drafts", scenario.snapshot(ids)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transactions", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="mtax-repo-")
+    failures = []
+    try:
+        runs = {name: steps(Scenario(factory(work_dir)), args.seed, args.transactions)
+                for name, factory in BACKENDS.items()}
+        reference = runs.pop("sqlite")
+        step_count = 0
+        for name, expected in reference:
+            step_count += 1
+            expected = normalize(expected)
+            for backend, run in runs.items():
+                _, actual = next(run)
+                found = differences(expected, normalize(actual))
+                if found:
+                    failures.append((backend, name, found))
+            if failures:
+                break
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for backend, step, found in failures:
+        print(f"MISMATCH {backend} after '{step}':")
+        for line in found[:20]:
+            print(f"    {line}")
+        if len(found) > 20:
+            print(f"    ... {len(found) - 20} more")
+    print(f"{', '.join(runs)} vs sqlite: {step_count} steps, {'FAILED' if failures else 'identical'}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
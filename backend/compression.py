@@ -0,0 +1,96 @@
+"""Response compression for the API.
+
+Bodies of at least `minimum_size` bytes are compressed with brotli when the client accepts `br`
+and the optional `brotli` package is installed, otherwise with gzip. Streaming responses
+(e.g. /transactions/export) are compressed chunk by chunk. Strong ETags of compressed responses
+are weakened, since the encoded bytes differ from the identity representation the tag was
+computed for; If-None-Match uses weak comparison, so revalidation keeps returning 304.
+"""
+from typing import Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.gzip import GZipResponder, IdentityResponder
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli  # Optional, gzip only when missing
+except ImportError:
+    brotli = None
+
+SUPPORTED_ENCODINGS = ("br", "gzip")
+
+
+def available_encodings(configured: str) -> Tuple[str, ...]:
+    """Parses a COMPRESSION value such as "br,gzip" or "off" into the usable encodings, in preference order"""
+    names = [name.strip().lower() for name in configured.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SUPPORTED_ENCODINGS + ("off",)]
+    if unknown:
+        raise ValueError(f"Unsupported compression '{unknown[0]}', expected a list of: {', '.join(SUPPORTED_ENCODINGS)} or 'off'")
+    return tuple(name for name in names if name != "off" and (name != "br" or brotli is not None))
+
+
+def negotiate(accept_encoding: str, encodings: Tuple[str, ...]) -> Optional[str]:
+    """First server-preferred encoding that the Accept-Encoding header allows (q > 0)"""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.strip().lower()] = q
+    for encoding in encodings:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+class BrotliResponder(IdentityResponder):
+    content_encoding = "br"
+
+    def __init__(self, app: ASGIApp, minimum_size: int, quality: int = 5):
+        super().__init__(app, minimum_size)
+        self.quality = quality
+        self._compressor = None
+
+    async def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        if self._compressor is None:
+            self._compressor = brotli.Compressor(quality=self.quality)
+        chunk = self._compressor.process(body)
+        return chunk + (self._compressor.flush() if more_body else self._compressor.finish())
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, encodings: Tuple[str, ...] = ("br", "gzip"), minimum_size: int = 1024,
+                 gzip_level: int = 6, brotli_quality: int = 5):
+        self.app = app
+        self.encodings = encodings
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""), self.encodings)
+        if encoding == "br":
+            responder = BrotliResponder(self.app, self.minimum_size, quality=self.brotli_quality)
+        elif encoding == "gzip":
+            responder = GZipResponder(self.app, self.minimum_size, compresslevel=self.gzip_level)
+        else:
+            responder = IdentityResponder(self.app, self.minimum_size)
+
+        async def send_with_weak_etag(message: Message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(raw=message["headers"])
+                etag = headers.get("etag")
+                if etag and not etag.startswith("W/") and "content-encoding" in headers:
+                    headers["ETag"] = "W/" + etag
+            await send(message)
+
+        await responder(scope, receive, send_with_weak_etag)
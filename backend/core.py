@@ -1,15 +1,218 @@
-from dataclasses import dataclass
-from typing import List, Optional, Dict, Any
-from datetime import date
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass, is_dataclass
+from typing import TYPE_CHECKING, Callable, Iterable, List, Optional, Dict, Any, Tuple, Union
+from datetime import date, datetime
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import csv
+import functools
+import itertools
+import io
+import base64
+import json
 import sqlite3
+import sys
+import threading
+import time
 import os
+import pathlib
 from dotenv import load_dotenv
+try:
+    import orjson  # Optional, list endpoints fall back to the stdlib encoder
+except ImportError:
+    orjson = None
+
+# numpy and the modules built on it (archive, tax_engine) are imported by the archive, bracket and batch paths,
+# metrics only when enabled, so the import of core and the first GET /metadata do not pay for them
+if TYPE_CHECKING:
+    import archive
+    import tax_engine
 
 # --- CONFIG ---
 load_dotenv()
-DB_NAME = "personal_finance.db"
+DB_NAME = os.getenv("DB_PATH", "personal_finance.db")
 SCHEMA_FILE = "Schema.sql"
 DOCS_ROOT = os.getenv("DOCS_ROOT_PATH", "")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_HEALTH_CHECK_INTERVAL = float(os.getenv("DB_HEALTH_CHECK_INTERVAL", "60"))
+DB_READER_POOL_SIZE = int(os.getenv("DB_READER_POOL_SIZE", "8"))
+DB_STORAGE_PROFILE = os.getenv("DB_STORAGE_PROFILE", "wal")
+# Worker threads that run blocking service calls for async endpoints, including the chunks of streamed exports
+DB_MAX_CONCURRENCY = int(os.getenv("DB_MAX_CONCURRENCY", str(DB_READER_POOL_SIZE)))
+# Opt-in query/route instrumentation exposed at /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0").lower() in ("1", "true", "yes")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+# Diagnostic JSON-lines log of slow statements with their EXPLAIN QUERY PLAN, off when unset
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG")
+SLOW_QUERY_LOG_MAX_BYTES = int(os.getenv("SLOW_QUERY_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+SLOW_QUERY_LOG_BACKUPS = int(os.getenv("SLOW_QUERY_LOG_BACKUPS", "5"))
+# Response compression in api.py: preferred encodings ("br,gzip", "gzip" or "off") and the size threshold
+COMPRESSION = os.getenv("COMPRESSION", "br,gzip")
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+# Browser cache lifetime of data that no longer changes (past years' final declarations), 0 disables
+HTTP_IMMUTABLE_MAX_AGE = int(os.getenv("HTTP_IMMUTABLE_MAX_AGE", "86400"))
+# Directory of the archived years' column files, by default "<database name>_archive" next to the database
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "")
+# Memory cap of the DeclarationService.calculate result cache, 0 disables it
+CALCULATION_CACHE_MAX_BYTES = int(os.getenv("CALCULATION_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+# Worker processes of batch declaration runs (declaration_run.py), 0 uses one per CPU
+DECLARATION_RUN_WORKERS = int(os.getenv("DECLARATION_RUN_WORKERS", "0"))
+
+# Versioned schema changes, applied in order by Database.migrate() and tracked with PRAGMA user_version.
+# Keep Schema.sql in sync so fresh installs start from the latest layout.
+# Materialized sums/counts of transactions per group. TransactionService keeps it current in the
+# same SQLite transaction as every insert, update and delete. Nullable key columns are stored as 0.
+ROLLUP_KEYS = ("taxpayer_id", "year", "month", "source_id", "tax_items_id", "type", "is_taxable")
+
+ROLLUP_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS transaction_rollup (
+        taxpayer_id INTEGER NOT NULL,
+        year INTEGER NOT NULL,
+        month INTEGER NOT NULL,
+        source_id INTEGER NOT NULL,
+        tax_items_id INTEGER NOT NULL,
+        type INTEGER NOT NULL,
+        is_taxable INTEGER NOT NULL,
+        amount REAL NOT NULL DEFAULT 0,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (taxpayer_id, year, month, source_id, tax_items_id, type, is_taxable)
+    ) WITHOUT ROWID;
+"""
+
+ROLLUP_UPSERT = """INSERT INTO transaction_rollup (taxpayer_id, year, month, source_id, tax_items_id, type, is_taxable, amount, count)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (taxpayer_id, year, month, source_id, tax_items_id, type, is_taxable)
+                   DO UPDATE SET amount = amount + excluded.amount, count = count + excluded.count"""
+
+ROLLUP_PRUNE = """DELETE FROM transaction_rollup WHERE count <= 0 AND taxpayer_id = ? AND year = ? AND month = ?
+                  AND source_id = ? AND tax_items_id = ? AND type = ? AND is_taxable = ?"""
+
+ROLLUP_SELECT = """
+    SELECT IFNULL(taxpayer_id, 0) AS taxpayer_id, IFNULL(year, 0) AS year, IFNULL(month, 0) AS month,
+           source_id, tax_items_id, IFNULL(type, 0) AS type, IFNULL(is_taxable, 0) AS is_taxable,
+           SUM(amount) AS amount, COUNT(*) AS count
+    FROM transactions
+    GROUP BY 1, 2, 3, 4, 5, 6, 7
+"""
+
+ROLLUP_INSERT = """
+    INSERT INTO transaction_rollup (taxpayer_id, year, month, source_id, tax_items_id, type, is_taxable, amount, count)
+""" + ROLLUP_SELECT
+
+# Full-text index of GET /transactions/search, one row per transaction (rowid = transactions.id) with the
+# names of its source, tax item and document copied in. Written by the same service methods that change
+# those rows. unicode61 does not fold the Turkish dotless ı, so it is indexed (and searched) as i.
+SEARCH_SCHEMA = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS transaction_search USING fts5(
+        description, source_name, tax_item_name, doc_name, doc_ref,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    );
+"""
+
+SEARCH_INSERT = """
+    INSERT INTO transaction_search (rowid, description, source_name, tax_item_name, doc_name, doc_ref)
+    SELECT t.id, replace(t.description, 'ı', 'i'), replace(s.name, 'ı', 'i'), replace(ti.name, 'ı', 'i'),
+           replace(d.display_name, 'ı', 'i'), replace(d.doc_ref, 'ı', 'i')
+    FROM transactions t
+    LEFT JOIN sources s ON t.source_id = s.id
+    LEFT JOIN tax_items ti ON t.tax_items_id = ti.id
+    LEFT JOIN documents d ON t.document_id = d.id
+"""
+
+# bm25 column weights, in SEARCH_SCHEMA column order
+SEARCH_WEIGHTS = (4.0, 2.0, 1.0, 2.0, 2.0)
+# bm25 is computed for every match, so broader searches are listed newest first instead of by relevance
+SEARCH_RANK_LIMIT = 10000
+
+# Registry of the (taxpayer, year) pairs whose transactions moved into archive files (see archive.py).
+# Their rows are no longer in transactions or transaction_search, but their transaction_rollup groups stay.
+ARCHIVE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS archived_years (
+        taxpayer_id INTEGER NOT NULL,
+        year INTEGER NOT NULL,
+        file TEXT NOT NULL,
+        rows INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        archived_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (taxpayer_id, year)
+    );
+"""
+
+# Version of every cached entity (taxpayers, sources, transactions, ...). Writes bump it in their own
+# transaction, so the caches and ETags of every process serving the database notice (see ReferenceCache).
+DATA_VERSIONS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS data_versions (
+        entity TEXT NOT NULL PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID;
+"""
+
+MIGRATIONS = [
+    (1, """
+        -- Equality filters of get_transactions, most selective column first
+        CREATE INDEX IF NOT EXISTS idx_transactions_taxpayer_year_type_taxable ON transactions (taxpayer_id, year, type, is_taxable);
+        CREATE INDEX IF NOT EXISTS idx_transactions_year_month ON transactions (year, month);
+        CREATE INDEX IF NOT EXISTS idx_transactions_source ON transactions (source_id, year);
+        CREATE INDEX IF NOT EXISTS idx_transactions_tax_item ON transactions (tax_items_id, year);
+        -- Matches the dashboard ORDER BY so unfiltered lists need no temp B-tree sort
+        CREATE INDEX IF NOT EXISTS idx_transactions_sort ON transactions (transaction_date DESC, source_id, id DESC);
+    """),
+    (2, """
+        CREATE INDEX IF NOT EXISTS idx_transactions_amount ON transactions (amount DESC, id DESC);
+    """),
+    (3, ROLLUP_SCHEMA + ROLLUP_INSERT + ";"),
+    (4, SEARCH_SCHEMA + "DELETE FROM transaction_search;" + SEARCH_INSERT + ";"),
+    (5, ARCHIVE_SCHEMA),
+    (6, """
+        -- Per-taxpayer declaration lookups of the optimizer and batch declaration runs
+        CREATE INDEX IF NOT EXISTS idx_declarations_taxpayer_year ON declarations (taxpayer_id, year);
+    """),
+    (7, """
+        -- Equality filters first, then the list order, so filtered lists and pages need no temp B-tree sort
+        CREATE INDEX IF NOT EXISTS idx_transactions_taxpayer_year_sort ON transactions (taxpayer_id, year, transaction_date DESC, source_id, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_transactions_taxpayer_sort ON transactions (taxpayer_id, transaction_date DESC, source_id, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_transactions_year_sort ON transactions (year, transaction_date DESC, source_id, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_transactions_month_sort ON transactions (month, transaction_date DESC, source_id, id DESC);
+        -- Prefixes of the indexes above
+        DROP INDEX IF EXISTS idx_transactions_taxpayer_year_type_taxable;
+        DROP INDEX IF EXISTS idx_transactions_year_month;
+    """),
+    (8, DATA_VERSIONS_SCHEMA),
+    (9, """
+        -- Versions of single (taxpayer_id, year) scopes of an entity, (0, 0) counts the writes that named no scope
+        CREATE TABLE IF NOT EXISTS data_scope_versions (
+            entity TEXT NOT NULL,
+            taxpayer_id INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (entity, taxpayer_id, year)
+        ) WITHOUT ROWID;
+    """),
+]
+
+# Whitelisted orderings for paged transaction lists. Each one is the forward or reverse order
+# of an index, so keyset pages never fall back to a full sort. `id` is always last to keep keys unique.
+TRANSACTION_SORTS = {
+    "date_desc": (("transaction_date", "DESC"), ("source_id", "ASC"), ("id", "DESC")),
+    "date_asc": (("transaction_date", "ASC"), ("source_id", "DESC"), ("id", "ASC")),
+    "amount_desc": (("amount", "DESC"), ("id", "DESC")),
+    "amount_asc": (("amount", "ASC"), ("id", "ASC")),
+}
+MAX_PAGE_SIZE = 1000
+# Transaction list layouts: one object per row, or the column names once plus one value array per row
+TRANSACTION_SHAPES = ("objects", "columnar")
+# Columns GET /analytics can group by. All but payment_method_id are transaction_rollup keys.
+ANALYTICS_GROUPS = ("year", "month", "taxpayer_id", "source_id", "tax_items_id", "payment_method_id")
+
+# Declaration optimizer
+EXPENSE_METHODS = ('lump_sum', 'actual')
+OPTIMIZER_MAX_DEDUCTION_SUBSETS = 6  # 2^6 subsets per method, above that only none/all are compared
+ACTUAL_METHOD_LOCK_YEARS = 2
 
 class TransactionType:
     INCOME = 1
@@ -107,33 +310,912 @@ class Declaration:
     status: str # 'draft', 'final'
     created_at: Optional[str] = None
 
+# --- JSON ---
+def _json_default(obj):
+    if is_dataclass(obj):
+        return asdict(obj)
+    if isinstance(obj, date):
+        return obj.isoformat()
+    np = sys.modules.get("numpy")  # No numpy values exist before something imported it
+    if np is not None and isinstance(obj, np.generic):
+        return obj.item()
+    if np is not None and isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def dump_json(obj) -> bytes:
+    """Compact UTF-8 JSON. orjson encodes dataclasses, tuples and numpy values natively, stdlib json is the fallback"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+
 # --- DATABASE MANAGER ---
+class ConnectionPool:
+    """Bounded pool of long-lived SQLite connections.
+
+    Connections are created lazily up to `size`; callers block for at most
+    `timeout` seconds when all of them are checked out. Idle connections are
+    pinged before reuse once `health_check_interval` seconds have passed.
+    """
+    def __init__(self, factory, size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT,
+                 health_check_interval: float = DB_HEALTH_CHECK_INTERVAL):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = []  # [(conn, last_used)] - LIFO keeps hot connections in use
+        self._created = 0
+        self._in_use = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {"checkouts": 0, "waits": 0, "wait_time": 0.0, "timeouts": 0,
+                       "discarded": 0, "peak_in_use": 0}
+
+    def _is_healthy(self, conn) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._cond:
+            self._created -= 1
+            self._stats["discarded"] += 1
+            self._cond.notify()
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        wait_started = time.monotonic()
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("Connection pool is closed")
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        break
+                    if self._created < self.size:
+                        self._created += 1
+                        conn, last_used = None, None
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise TimeoutError(f"No database connection available within {self.timeout}s (pool size {self.size})")
+                    waited = True
+                    self._cond.wait(remaining)
+                self._in_use += 1
+                self._stats["checkouts"] += 1
+                self._stats["peak_in_use"] = max(self._stats["peak_in_use"], self._in_use)
+                if waited:
+                    self._stats["waits"] += 1
+                    self._stats["wait_time"] += time.monotonic() - wait_started
+
+            # Connect / ping outside the lock so slow I/O does not stall other threads
+            if conn is None:
+                try:
+                    return self.factory()
+                except Exception:
+                    with self._cond:
+                        self._created -= 1
+                        self._in_use -= 1
+                        self._cond.notify()
+                    raise
+            if time.monotonic() - last_used < self.health_check_interval or self._is_healthy(conn):
+                return conn
+            with self._cond:
+                self._in_use -= 1
+            self._discard(conn)
+
+    def release(self, conn, broken: bool = False):
+        if broken or self._closed:
+            with self._cond:
+                self._in_use -= 1
+            self._discard(conn)
+            return
+        with self._cond:
+            self._in_use -= 1
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._created -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "size": self.size,
+                "created": self._created,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "saturation": self._in_use / self.size,
+                **self._stats,
+            }
+
+@dataclass
+class StorageProfile:
+    """SQLite pragma set applied once to every pooled connection."""
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    busy_timeout_ms: int = 5000
+    cache_size_kib: int = 16384
+    mmap_size: int = 256 * 1024 * 1024
+    temp_store: str = "MEMORY"
+    reader_mode: bool = True # Serve read-only queries from a separate mode=ro pool
+
+STORAGE_PROFILES = {
+    # Concurrent readers alongside a single writer, fsync only at checkpoints
+    "wal": StorageProfile(),
+    # WAL but fsync on every commit, for machines without a UPS
+    "durable": StorageProfile(synchronous="FULL"),
+    # Original rollback-journal behaviour
+    "legacy": StorageProfile(journal_mode="DELETE", synchronous="FULL", cache_size_kib=2000,
+                             mmap_size=0, temp_store="DEFAULT", reader_mode=False),
+}
+
+# Scope of the data_scope_versions rows that count writes which did not name their (taxpayer_id, year)
+UNSCOPED = (0, 0)
+
+class ReferenceCache:
+    """Cache for rarely changing lookup data (taxpayers, sources, payment methods, ...).
+
+    Every entity has a version that write paths bump. Cached values remember the version they were
+    loaded at, so a load racing with a write is simply reloaded on the next call. Writes that know
+    which (taxpayer_id, year) they touched also bump that scope, see scoped_version.
+
+    With a database file the versions live in its data_versions and data_scope_versions tables and
+    are bumped in the transaction of the write, so writes of other processes (CLIs, other API workers)
+    are seen too. They are only re-read when PRAGMA data_version shows that another connection committed.
+    Without one (MemoryRepository, ":memory:") they are process-local counters.
+    """
+    def __init__(self, db: Optional["Database"] = None):
+        self._db = db if db is not None and db.db_name != ":memory:" else None
+        self._lock = threading.Lock()
+        # Process-local versions restart at 0, the epoch keeps their ETags unique across restarts
+        self._epoch = "" if self._db else f"{os.getpid():x}{int(time.time()):x}"
+        self._watch: Optional[sqlite3.Connection] = None
+        self._data_version: Optional[int] = None
+        self._versions: Dict[str, int] = {}
+        self._unscoped: Dict[str, int] = {}
+        self._scoped: Dict[Tuple, int] = {}
+        self._entries: Dict[Tuple, Tuple[int, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.calculations = CalculationCache(self, CALCULATION_CACHE_MAX_BYTES)
+
+    def _sync(self):
+        """Reloads the stored versions once another connection, of this process or another one, has committed"""
+        if self._db is None:
+            return
+        with self._lock:
+            if self._watch is None:
+                self._watch = self._db._connect_watch()
+            data_version = self._watch.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return
+            try:
+                versions = dict(self._watch.execute("SELECT entity, version FROM data_versions").fetchall())
+            except sqlite3.OperationalError:  # Not migrated yet
+                versions = {}
+            # Scope versions are read on demand, those of entities that changed are read again
+            changed = {e for e in versions.keys() | self._versions.keys() if versions.get(e) != self._versions.get(e)}
+            self._scoped = {k: v for k, v in self._scoped.items() if k[0] not in changed}
+            self._versions = versions
+            self._data_version = data_version
+
+    def version(self, entity: str) -> int:
+        self._sync()
+        return self._versions.get(entity, 0)
+
+    def versions(self, *entities: str) -> Tuple[int, ...]:
+        """Versions of several entities, checked against the database once"""
+        self._sync()
+        return tuple(self._versions.get(e, 0) for e in entities)
+
+    def scoped_version(self, entity: str, scope: Tuple[int, int]) -> Tuple[int, int]:
+        """Version of one (taxpayer_id, year) scope of an entity. It changes with writes to that
+        scope and with writes that did not name their scopes, but not with writes to other scopes."""
+        if self._db is None:
+            return self._unscoped.get(entity, 0), self._scoped.get((entity, scope), 0)
+        self._sync()
+        with self._lock:
+            if (entity, scope) not in self._scoped or (entity, UNSCOPED) not in self._scoped:
+                try:
+                    stored = {(tp, year): version for tp, year, version in self._watch.execute(
+                        """SELECT taxpayer_id, year, version FROM data_scope_versions
+                           WHERE entity = ? AND taxpayer_id IN (0, ?) AND year IN (0, ?)""", (entity, *scope))}
+                except sqlite3.OperationalError:  # Not migrated yet
+                    stored = {}
+                for key in (UNSCOPED, scope):
+                    self._scoped[(entity, key)] = stored.get(key, 0)
+            return self._scoped[(entity, UNSCOPED)], self._scoped[(entity, scope)]
+
+    def get_or_load(self, entity: str, loader, key: Any = None):
+        version = self.version(entity)
+        entry = self._entries.get((entity, key))
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = loader()
+        with self._lock:
+            self._entries[(entity, key)] = (version, value)
+        return value
+
+    def invalidate(self, *entities: str, scopes: Optional[Iterable[Tuple]] = None):
+        """Bumps the entities for a write. `scopes` lists the (taxpayer_id, year) pairs the write touched;
+        without it every scope of the entities counts as changed. Called inside the write's
+        Database.get_connection() block, the stored versions commit together with the write."""
+        if self._db is not None:
+            scopes = [UNSCOPED] if scopes is None else list(scopes)
+            with self._db.get_connection() as conn:
+                conn.executemany("""INSERT INTO data_versions (entity, version) VALUES (?, 1)
+                                    ON CONFLICT (entity) DO UPDATE SET version = version + 1""",
+                                 [(entity,) for entity in entities])
+                conn.executemany("""INSERT INTO data_scope_versions (entity, taxpayer_id, year, version) VALUES (?, ?, ?, 1)
+                                    ON CONFLICT (entity, taxpayer_id, year) DO UPDATE SET version = version + 1""",
+                                 [(entity, *scope) for entity in entities for scope in scopes])
+            return
+        with self._lock:
+            for entity in entities:
+                self._versions[entity] = self._versions.get(entity, 0) + 1
+                if scopes is None:
+                    self._unscoped[entity] = self._unscoped.get(entity, 0) + 1
+                    continue
+                for scope in scopes:
+                    self._scoped[(entity, scope)] = self._scoped.get((entity, scope), 0) + 1
+
+    def etag(self, *entities: str) -> str:
+        return '"' + "-".join(([self._epoch] if self._epoch else []) + [str(v) for v in self.versions(*entities)]) + '"'
+
+    def stats(self) -> Dict[str, Any]:
+        self._sync()
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "versions": dict(self._versions),
+                "calculations": self.calculations.stats()}
+
+    def close(self):
+        with self._lock:
+            if self._watch is not None:
+                self._watch.close()
+                self._watch = None
+
+# Reference data DeclarationService.calculate reads besides the transactions of its (taxpayer_id, year)
+CALCULATION_ENTITIES = ("sources", "tax_items", "tax_settings", "taxpayers")
+
+def _result_copy(result: Dict) -> Dict:
+    # calculate results hold lists of flat dicts (tax_breakdown, actual_expenses_breakdown)
+    return {k: [dict(item) for item in v] if isinstance(v, list) else v for k, v in result.items()}
+
+def _approximate_size(value) -> int:
+    """Bytes held by a calculate result or key, counting the containers and their items"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_approximate_size(k) + _approximate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_approximate_size(v) for v in value)
+    return size
+
+class CalculationCache:
+    """LRU cache of DeclarationService.calculate results, bounded by their approximate size in bytes.
+
+    Entries are keyed by the call arguments and remember the data stamp they were computed at: the
+    scoped transactions version of their (taxpayer_id, year) plus the versions of CALCULATION_ENTITIES.
+    Any of those writes changes the stamp, so the next lookup misses and recomputes, also when another
+    process wrote (the versions are stored in the database, see ReferenceCache). The stamp is read
+    before the inputs are loaded, so a result racing with a write is never served for the newer data.
+    """
+    def __init__(self, versions: ReferenceCache, max_bytes: int):
+        self._versions = versions
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple, Tuple[Tuple, Dict, int]]" = OrderedDict()
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stamp(self, taxpayer_id: int, year: int) -> Tuple:
+        return (self._versions.scoped_version("transactions", (taxpayer_id, year)),
+                self._versions.versions(*CALCULATION_ENTITIES))
+
+    def get(self, key: Tuple, stamp: Tuple, count_miss: bool = True) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != stamp:
+                self.misses += count_miss
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            result = entry[1]
+        return _result_copy(result)
+
+    def put(self, key: Tuple, stamp: Tuple, result: Dict):
+        result = _result_copy(result)
+        size = _approximate_size(key) + _approximate_size(result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            replaced = self._entries.pop(key, None)
+            if replaced is not None:
+                self.bytes -= replaced[2]
+            self._entries[key] = (stamp, result, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+class DatabaseExecutor:
+    """Bounded thread pool that runs blocking sqlite3 service calls off the asyncio event loop.
+
+    At most `max_workers` calls run at once, the rest queue inside the executor. The pool is
+    created on first use and again after `shutdown()`.
+    """
+    def __init__(self, max_workers: int = DB_MAX_CONCURRENCY):
+        if max_workers < 1:
+            raise ValueError("Executor needs at least 1 worker")
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._queued = 0
+        self._running = 0
+        self._peak_running = 0
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="mtax-db")
+            return self._executor
+
+    def _call(self, fn, args, kwargs):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._peak_running = max(self._peak_running, self._running)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        executor = self._get_executor()
+        with self._lock:
+            self._submitted += 1
+            self._queued += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(self._call, fn, args, kwargs))
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "submitted": self._submitted,
+                "running": self._running,
+                # Calls handed to the executor that have not started yet
+                "queued": self._queued,
+                "peak_running": self._peak_running,
+            }
+
 class Database:
-    def __init__(self, db_name=DB_NAME):
+    def __init__(self, db_name=DB_NAME, pool_size: int = DB_POOL_SIZE, pool_timeout: float = DB_POOL_TIMEOUT,
+                 profile: Optional[StorageProfile] = None, reader_pool_size: int = DB_READER_POOL_SIZE,
+                 max_concurrency: int = DB_MAX_CONCURRENCY, enable_metrics: bool = METRICS_ENABLED,
+                 slow_query_log: Optional[str] = SLOW_QUERY_LOG, slow_query_ms: float = SLOW_QUERY_MS,
+                 archive_dir: str = ARCHIVE_DIR):
         self.db_name = db_name
+        self.archive_dir = archive_dir or f"{os.path.splitext(db_name)[0]}_archive"
+        self._archive_files: Dict[Tuple, "archive.ArchiveFile"] = {}
+        self._archive_lock = threading.Lock()
+        # Set before the pools so every connection they create is instrumented
+        self.metrics = None
+        if enable_metrics or slow_query_log:
+            import metrics
+            self.metrics = metrics.MetricsRegistry(slow_query_ms)
+        self.slow_query_log = None
+        if slow_query_log:
+            self.slow_query_log = metrics.SlowQueryLog(slow_query_log, SLOW_QUERY_LOG_MAX_BYTES, SLOW_QUERY_LOG_BACKUPS,
+                                                       is_caller=lambda obj: isinstance(obj, BaseService))
+            self.metrics.slow_query_hook = self.slow_query_log.record
+        self.profile = profile or STORAGE_PROFILES[DB_STORAGE_PROFILE]
+        self.pool = ConnectionPool(self._connect, size=pool_size, timeout=pool_timeout)
+        self.reader_pool = None
+        if self.profile.reader_mode and db_name != ":memory:":
+            self.reader_pool = ConnectionPool(self._connect_reader, size=reader_pool_size, timeout=pool_timeout)
+        self._journal_mode_set = False
+        self._local = threading.local()
+        self.cache = ReferenceCache(self)
+        self.executor = DatabaseExecutor(max_concurrency)
+
+    async def run(self, fn, *args, **kwargs):
+        """Awaitable wrapper for a blocking service call, e.g. `await db.run(tx_service.get_summary, year=2025)`"""
+        with self.timed("db.run"):
+            return await self.executor.run(fn, *args, **kwargs)
+
+    async def iterate(self, iterator):
+        """Async iterator over a blocking one, e.g. a streamed export. Every item is pulled through the
+        executor, so streaming responses stay within DB_MAX_CONCURRENCY like other service calls."""
+        iterator = iter(iterator)
+        done = object()
+        try:
+            while True:
+                item = await self.run(next, iterator, done)
+                if item is done:
+                    return
+                yield item
+        finally:
+            # A client that disconnects mid-stream releases the generator's connection on an executor thread
+            if hasattr(iterator, "close"):
+                await self.run(iterator.close)
+
+    def timed(self, section: str):
+        """Records the duration of a block under `section` when metrics are enabled"""
+        return self.metrics.section(section) if self.metrics else nullcontext()
+
+    def _sqlite_connect(self, database: str, **kwargs) -> sqlite3.Connection:
+        if self.metrics:
+            import metrics
+            conn = sqlite3.connect(database, factory=metrics.InstrumentedConnection, **kwargs)
+            conn.registry = self.metrics
+            return conn
+        return sqlite3.connect(database, **kwargs)
+
+    def _apply_profile(self, conn):
+        p = self.profile
+        conn.execute(f"PRAGMA busy_timeout = {int(p.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA synchronous = {p.synchronous}")
+        conn.execute(f"PRAGMA cache_size = {-int(p.cache_size_kib)}")
+        conn.execute(f"PRAGMA mmap_size = {int(p.mmap_size)}")
+        conn.execute(f"PRAGMA temp_store = {p.temp_store}")
 
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_name)
+    def _connect(self):
+        # Pooled connections move between worker threads, the pool serializes their use
+        conn = self._sqlite_connect(self.db_name, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        self._apply_profile(conn)
+        if not self._journal_mode_set:
+            # journal_mode is persistent in the database file, setting it once is enough
+            conn.execute(f"PRAGMA journal_mode = {self.profile.journal_mode}")
+            self._journal_mode_set = True
         return conn
 
+    def _reader_uri(self) -> str:
+        if not self._journal_mode_set:
+            # Make sure the file exists and is in WAL before opening it read-only
+            with self.get_connection():
+                pass
+        # as_uri() percent-encodes '#', '?', '%' and spaces, which SQLite would otherwise read as URI syntax
+        return pathlib.Path(os.path.abspath(self.db_name)).as_uri() + "?mode=ro"
+
+    def _connect_reader(self):
+        conn = self._sqlite_connect(self._reader_uri(), uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        self._apply_profile(conn)
+        conn.execute("PRAGMA query_only = 1")
+        return conn
+
+    def _connect_watch(self):
+        # Uninstrumented: ReferenceCache polls it with PRAGMA data_version on every cached read
+        return sqlite3.connect(self._reader_uri(), uri=True, check_same_thread=False)
+
+    @contextmanager
+    def get_connection(self, readonly: bool = False, reuse: bool = True):
+        # Nested calls on the same thread share the outer checkout instead of taking a second slot.
+        # A read nested inside a write reuses the writer so it sees the uncommitted changes.
+        # reuse=False takes a private connection, for generators that may resume on other threads.
+        pool = self.reader_pool if readonly and self.reader_pool else self.pool
+        held = getattr(self._local, "held", None)
+        if held is None:
+            held = self._local.held = {}
+        if reuse:
+            conn = held.get(id(self.pool)) if readonly else None
+            conn = conn or held.get(id(pool))
+            if conn is not None:
+                yield conn
+                return
+
+        conn = pool.acquire()
+        if reuse:
+            held[id(pool)] = conn
+        broken = False
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                broken = True
+            raise
+        finally:
+            if reuse:
+                del held[id(pool)]
+            if self.metrics:
+                # Unfinished statements are reported while this thread still owns the connection
+                conn.finish_statements()
+            pool.release(conn, broken=broken)
+
+    def pool_stats(self) -> Dict[str, Any]:
+        stats = {"writer": self.pool.stats()}
+        if self.reader_pool:
+            stats["reader"] = self.reader_pool.stats()
+        stats["executor"] = self.executor.stats()
+        return stats
+
+    def close(self):
+        self.executor.shutdown()
+        self.cache.close()
+        if self.slow_query_log:
+            self.slow_query_log.close()
+        self.pool.close()
+        if self.reader_pool:
+            self.reader_pool.close()
+
     def init_db(self):
         if not os.path.exists(self.db_name):
             with open(SCHEMA_FILE, 'r', encoding='utf-8') as f:
                 schema = f.read()
-            conn = self.get_connection()
-            conn.executescript(schema)
+            with self.get_connection() as conn:
+                conn.executescript(schema)
+        self.migrate()
+
+    def migrate(self) -> int:
+        with self.get_connection() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for target, script in MIGRATIONS:
+                if target <= version:
+                    continue
+                conn.executescript(script)
+                conn.execute(f"PRAGMA user_version = {target}")
+                version = target
+            return version
+
+    def rebuild_rollup(self) -> int:
+        """Recomputes transaction_rollup from the transactions table, returns the number of groups"""
+        with self.get_connection() as conn:
+            # Both statements run in one implicit transaction, readers never see an empty rollup
+            conn.execute("DELETE FROM transaction_rollup")
+            conn.execute(ROLLUP_INSERT)
+            # Archived years are no longer in transactions, their groups come from the column files
+            for archived in self.archives().values():
+                conn.executemany(ROLLUP_UPSERT, [g[:7] + (g[8], g[7]) for g in archived.aggregate(ROLLUP_KEYS)])
+            self.cache.invalidate("transactions")
             conn.commit()
-            conn.close()
+            count = conn.execute("SELECT COUNT(*) FROM transaction_rollup").fetchone()[0]
+        return count
+
+    def rebuild_search_index(self) -> int:
+        """Recomputes transaction_search from the transactions table, returns the number of indexed rows"""
+        with self.get_connection() as conn:
+            conn.execute("DELETE FROM transaction_search")
+            conn.execute(SEARCH_INSERT)
+            self.cache.invalidate("transactions")
+            conn.commit()
+            count = conn.execute("SELECT COUNT(*) FROM transaction_search").fetchone()[0]
+        return count
+
+    def verify_rollup(self, tolerance: float = 0.005) -> List[Tuple]:
+        """Groups whose rollup sum or count differs from the transactions table and the archived years (empty when
+        in sync), as (keys..., amount, count, fresh amount, fresh count)"""
+        with self.get_connection(readonly=True) as conn:
+            stored = {tuple(row[:7]): (row[7], row[8])
+                      for row in conn.execute(f"SELECT {', '.join(ROLLUP_KEYS)}, amount, count FROM transaction_rollup")}
+            fresh = {tuple(row[:7]): [row[7], row[8]] for row in conn.execute(ROLLUP_SELECT)}
+        for archived in self.archives().values():
+            for g in archived.aggregate(ROLLUP_KEYS):
+                acc = fresh.setdefault(g[:7], [0.0, 0])
+                acc[0] += g[8]
+                acc[1] += g[7]
+        drift = []
+        for key in sorted(stored.keys() | fresh.keys()):
+            amount, count = stored.get(key, (0.0, 0))
+            fresh_amount, fresh_count = fresh.get(key, (0.0, 0))
+            if count != fresh_count or abs(amount - fresh_amount) > tolerance:
+                drift.append(key + (amount, count, fresh_amount, fresh_count))
+        return drift
+
+    def archived_years(self) -> Dict[Tuple[int, int], str]:
+        """Archive file paths by (taxpayer_id, year). The registry is cached until the "archives" data version
+        changes, which archive_year and restore_year bump in any process."""
+        return self.cache.get_or_load("archives", self._load_archived_years)
+
+    def _load_archived_years(self) -> Dict[Tuple[int, int], str]:
+        with self.get_connection(readonly=True) as conn:
+            rows = conn.execute("SELECT taxpayer_id, year, file FROM archived_years").fetchall()
+        with self._archive_lock:
+            # A year restored and archived again reuses its path, so every file is mapped again
+            self._archive_files = {}
+        return {(row['taxpayer_id'], row['year']): os.path.join(self.archive_dir, row['file']) for row in rows}
+
+    def archive_file(self, taxpayer_id: int, year: int) -> "archive.ArchiveFile":
+        """The memory-mapped file of an archived year, mapped once. A missing file fails only the reads of its year."""
+        path = self.archived_years().get((taxpayer_id, year))
+        if path is None:
+            raise ValueError(f"{year} of taxpayer {taxpayer_id} is not archived")
+        with self._archive_lock:
+            archived = self._archive_files.get(path)
+            if archived is None:
+                import archive
+                try:
+                    archived = archive.ArchiveFile(path)
+                except FileNotFoundError:
+                    raise ValueError(f"Archive file of {year} of taxpayer {taxpayer_id} is missing: {path}") from None
+                self._archive_files[path] = archived
+        return archived
+
+    def archives(self) -> Dict[Tuple[int, int], "archive.ArchiveFile"]:
+        """Memory-mapped files of every archived year by (taxpayer_id, year)"""
+        return {key: self.archive_file(*key) for key in self.archived_years()}
+
+    def archive_year(self, taxpayer_id: int, year: int, force: bool = False) -> Dict:
+        """Moves the transactions of a closed year (one with a final declaration, unless `force`) into a column
+        file. Their transaction_rollup groups stay, so summaries and calculations are unchanged."""
+        import archive
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = archive.archive_path(self.archive_dir, taxpayer_id, year)
+        with self.get_connection() as conn:
+            if not conn.in_transaction:
+                # Nothing may be added to the year between reading its rows and deleting them
+                conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT 1 FROM archived_years WHERE taxpayer_id=? AND year=?", (taxpayer_id, year)).fetchone():
+                raise ValueError(f"{year} of taxpayer {taxpayer_id} is already archived")
+            if not force and not conn.execute("""SELECT 1 FROM declarations WHERE taxpayer_id=? AND year=? AND status='final'""",
+                                              (taxpayer_id, year)).fetchone():
+                raise ValueError(f"{year} of taxpayer {taxpayer_id} has no final declaration, it is not closed")
+            rows = [dict(row) for row in conn.execute(f"SELECT {', '.join(TRANSACTION_COLUMNS)} FROM transactions WHERE taxpayer_id=? AND year=?",
+                                                      (taxpayer_id, year))]
+            if not rows:
+                raise ValueError(f"Taxpayer {taxpayer_id} has no transactions in {year}")
+            header = archive.write_archive(path, taxpayer_id, year, rows)
+            try:
+                conn.execute("INSERT INTO archived_years (taxpayer_id, year, file, rows, amount) VALUES (?, ?, ?, ?, ?)",
+                             (taxpayer_id, year, os.path.basename(path), header["rows"], header["amount"]))
+                conn.execute("""DELETE FROM transaction_search WHERE rowid IN
+                                (SELECT id FROM transactions WHERE taxpayer_id=? AND year=?)""", (taxpayer_id, year))
+                conn.execute("DELETE FROM transactions WHERE taxpayer_id=? AND year=?", (taxpayer_id, year))
+                self.cache.invalidate("transactions", "archives", scopes=[(taxpayer_id, year)])
+                conn.commit()
+            except BaseException:
+                os.remove(path)
+                raise
+        return {"taxpayer_id": taxpayer_id, "year": year, "rows": header["rows"], "amount": header["amount"],
+                "file": path, "bytes": os.path.getsize(path)}
+
+    def restore_year(self, taxpayer_id: int, year: int) -> int:
+        """Moves an archived year back into the transactions table and deletes its file, returns the row count"""
+        archived = self.archive_file(taxpayer_id, year)
+        rows = archived.records()
+        with self._archive_lock:
+            # Unmap before the file is deleted
+            self._archive_files.pop(archived.path, None)
+        columns = ", ".join(TRANSACTION_COLUMNS)
+        with self.get_connection() as conn:
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(f"INSERT INTO transactions ({columns}) VALUES ({', '.join('?' * len(TRANSACTION_COLUMNS))})",
+                             [tuple(row[c] for c in TRANSACTION_COLUMNS) for row in rows])
+            conn.execute(f"{SEARCH_INSERT} WHERE t.taxpayer_id = ? AND t.year = ?", (taxpayer_id, year))
+            conn.execute("DELETE FROM archived_years WHERE taxpayer_id=? AND year=?", (taxpayer_id, year))
+            self.cache.invalidate("transactions", "archives", scopes=[(taxpayer_id, year)])
+            conn.commit()
+        os.remove(archived.path)
+        return len(rows)
+
+# --- REPOSITORIES ---
+def _transaction_filters(year=None, taxpayer_id=None, transaction_type=None, month=None, source_id=None, is_taxable=None, tax_items_id=None) -> Tuple[str, List]:
+    # Shared WHERE clause for every query over the transactions table or its rollup (aliased as t)
+    query = ""
+    params = []
+    if year:
+        query += " AND t.year = ?"; params.append(year)
+    if month:
+        query += " AND t.month = ?"; params.append(month)
+    if taxpayer_id:
+        query += " AND t.taxpayer_id = ?"; params.append(taxpayer_id)
+    if transaction_type:
+        query += " AND t.type = ?"; params.append(transaction_type)
+    if source_id:
+        if isinstance(source_id, list):
+            placeholders = ','.join(['?' for _ in source_id])
+            query += f" AND t.source_id IN ({placeholders})"
+            params.extend(source_id)
+        else:
+            query += " AND t.source_id = ?"
+            params.append(source_id)
+    if is_taxable is not None:
+        query += " AND t.is_taxable = ?"; params.append(1 if is_taxable else 0)
+    if tax_items_id:
+        query += " AND t.tax_items_id = ?"; params.append(tax_items_id)
+    return query, params
+
+# Columns of the transactions table in table order, the same as archive.RECORD_COLUMNS
+TRANSACTION_COLUMNS = ("id", "taxpayer_id", "transaction_date", "year", "month", "day", "type", "source_id",
+                       "payment_method_id", "document_id", "description", "amount", "is_taxable", "tax_items_id", "gdrive_id")
+# Columns of a get_transactions row: every transactions column, then the joined names
+TRANSACTION_LIST_COLUMNS = TRANSACTION_COLUMNS + ("taxpayer_name", "source_name", "deduction_type", "method_name", "doc_ref",
+                                                     "doc_name", "relative_path", "tax_item_code", "tax_item_name")
+
+def _transactions_query(order_by: str = "t.transaction_date DESC, t.source_id ASC, t.id DESC", extra_where: str = "", extra_params: Optional[List] = None, **filters) -> Tuple[str, List]:
+    where, params = _transaction_filters(**filters)
+    query = """SELECT t.*, tp.full_name as taxpayer_name, s.name as source_name, s.deduction_type, pm.method_name,
+                      d.doc_ref, d.display_name as doc_name, d.relative_path, ti.code as tax_item_code, ti.name as tax_item_name
+               FROM transactions t
+               LEFT JOIN taxpayers tp ON t.taxpayer_id = tp.id
+               LEFT JOIN sources s ON t.source_id = s.id
+               LEFT JOIN payment_methods pm ON t.payment_method_id = pm.id
+               LEFT JOIN documents d ON t.document_id = d.id
+               LEFT JOIN tax_items ti ON t.tax_items_id = ti.id
+               WHERE 1=1""" + where + extra_where
+    query += " ORDER BY " + order_by
+    return query, params + (extra_params or [])
+
+class Repository(ABC):
+    """Storage behind the services.
+
+    Services read and write through these methods instead of SQL, so another backend (see
+    memory_repository.MemoryRepository) only has to implement them. Filters are the keyword
+    arguments of GET /transactions. Services cache reads in `cache` and bump it inside the write's transaction().
+    Full-text search, keyset pages, streamed JSON, analytics and query plans are SQLite features;
+    they use `db`, which is None for other backends."""
+
+    db: Optional[Database] = None
+    cache: ReferenceCache
+
+    def timed(self, section: str):
+        """Times a block under `section` when the backend records metrics"""
+        return nullcontext()
+
+    def transaction(self):
+        """Block whose writes and cache bumps are committed together"""
+        return nullcontext()
+
+    # Reference data
+    @abstractmethod
+    def get_taxpayers(self) -> List[Taxpayer]: ...
+    @abstractmethod
+    def add_taxpayer(self, t: Taxpayer) -> int: ...
+    @abstractmethod
+    def update_taxpayer(self, t: Taxpayer): ...
+    @abstractmethod
+    def delete_taxpayer(self, t_id: int): ...
+    @abstractmethod
+    def get_sources(self) -> List[Source]: ...
+    @abstractmethod
+    def get_source(self, source_id: int) -> Optional[Source]: ...
+    @abstractmethod
+    def add_source(self, s: Source) -> int: ...
+    @abstractmethod
+    def update_source(self, s: Source): ...
+    @abstractmethod
+    def delete_source(self, s_id: int): ...
+    @abstractmethod
+    def get_payment_methods(self) -> List[PaymentMethod]: ...
+    @abstractmethod
+    def add_payment_method(self, pm: PaymentMethod) -> int: ...
+    @abstractmethod
+    def update_payment_method(self, pm: PaymentMethod): ...
+    @abstractmethod
+    def delete_payment_method(self, pm_id: int): ...
+    @abstractmethod
+    def get_tax_items(self) -> List[TaxItem]:
+        """Ordered by code"""
+    @abstractmethod
+    def add_tax_item(self, ti: TaxItem) -> int: ...
+    @abstractmethod
+    def update_tax_item(self, ti: TaxItem): ...
+    @abstractmethod
+    def delete_tax_item(self, ti_id: int): ...
+    @abstractmethod
+    def get_documents(self) -> List[Document]: ...
+    @abstractmethod
+    def add_document(self, d: Document) -> int: ...
+
+    # Transactions
+    @abstractmethod
+    def add_transaction(self, t: Transaction) -> int: ...
+    @abstractmethod
+    def add_transactions(self, transactions: List[Transaction], chunk_size: int = 5000, atomic: bool = False) -> Tuple[int, List[Dict]]:
+        """Inserts all rows in one transaction. Returns (inserted_count, errors); errors carry the list index of
+        each rejected row. With atomic=True any rejected row rolls back the whole import."""
+    @abstractmethod
+    def update_transaction(self, t: Transaction): ...
+    @abstractmethod
+    def delete_transaction(self, t_id: int): ...
+    @abstractmethod
+    def get_transaction(self, t_id: int) -> Optional[Transaction]: ...
+    @abstractmethod
+    def get_last_year(self) -> Optional[int]: ...
+    @abstractmethod
+    def get_years(self) -> List[int]:
+        """Distinct transaction years, newest first"""
+    @abstractmethod
+    def get_transactions(self, **filters) -> List[Dict]:
+        """Transaction rows joined with their taxpayer, source, payment method, document and tax item names,
+        ordered by date (newest first), source id and id (newest first)"""
+    @abstractmethod
+    def get_totals(self, **filters) -> Dict:
+        """count, income, expense and taxable (income) sums of the filtered transactions"""
+    @abstractmethod
+    def get_taxable_totals(self, years: List[int], taxpayer_ids: Optional[List[int]] = None) -> List[Dict]:
+        """Taxable amount sums per (taxpayer_id, year, type, source_id, tax item), with the tax item's code and
+        name, ordered by those keys"""
+    @abstractmethod
+    def get_special_deductions(self, taxpayer_id: int, year: int) -> List[Dict]:
+        """Expense sums per name of the taxpayer's special deduction sources (deduction_type=1), ordered by name"""
+
+    # Tax settings and declarations
+    @abstractmethod
+    def get_tax_setting(self, year: int) -> Optional[TaxSetting]: ...
+    @abstractmethod
+    def save_tax_setting(self, s: TaxSetting): ...
+    @abstractmethod
+    def add_declaration(self, d: Declaration) -> int: ...
+    @abstractmethod
+    def add_declarations(self, declarations: List[Declaration], replace_drafts: bool = False) -> List[int]:
+        """Inserts all declarations in one transaction and returns their ids. With replace_drafts, the draft
+        declarations with the same taxpayer, year and name are deleted first."""
+    @abstractmethod
+    def get_declarations(self, taxpayer_id: int, year: int) -> List[Declaration]: ...
+    @abstractmethod
+    def delete_declaration(self, dec_id: int): ...
+    @abstractmethod
+    def get_last_final_actual_year(self, taxpayer_id: int, first_year: int, last_year: int) -> Optional[int]:
+        """Latest year in [first_year, last_year] with a final declaration that used the actual expense method"""
+
+class SqliteRepository(Repository):
+    """Repository over a SQLite Database. Keeps transaction_rollup and transaction_search current in the
+    same SQLite transaction as every transaction, source and tax item change. Rows of archived years are
+    read from their column files (Database.archive_year) and cannot be changed until restored."""
+
+    INSERT_QUERY = """INSERT INTO transactions (taxpayer_id, transaction_date, year, month, day, type, source_id, 
+                      payment_method_id, document_id, amount, description, is_taxable, tax_items_id, gdrive_id)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
 
-# --- SERVICES ---
-class BaseService:
     def __init__(self, db: Database):
         self.db = db
+        self.cache = db.cache
 
-class TaxpayerService(BaseService):
-    def get_all(self) -> List[Taxpayer]:
-        with self.db.get_connection() as conn:
+    def timed(self, section: str):
+        return self.db.timed(section)
+
+    def transaction(self):
+        # Writes commit when the outermost get_connection() block ends, so nested writes join it
+        return self.db.get_connection()
+
+    @staticmethod
+    def _reindex_search(conn: sqlite3.Connection, where: str, params) -> None:
+        """Rewrites the transaction_search rows of the transactions matching `where` (aliased as t)"""
+        conn.execute(f"DELETE FROM transaction_search WHERE rowid IN (SELECT t.id FROM transactions t WHERE {where})", params)
+        conn.execute(f"{SEARCH_INSERT} WHERE {where}", params)
+
+    def get_taxpayers(self) -> List[Taxpayer]:
+        with self.db.get_connection(readonly=True) as conn:
             rows = conn.execute("SELECT * FROM taxpayers").fetchall()
             return [Taxpayer(**dict(row)) for row in rows]
 
@@ -141,28 +1223,24 @@ class TaxpayerService(BaseService):
         query = "INSERT INTO taxpayers (full_name) VALUES (?)"
         with self.db.get_connection() as conn:
             cursor = conn.execute(query, (t.full_name,))
-            conn.commit()
             return cursor.lastrowid
 
     def update_taxpayer(self, t: Taxpayer):
         query = "UPDATE taxpayers SET full_name=? WHERE id=?"
         with self.db.get_connection() as conn:
             conn.execute(query, (t.full_name, t.id))
-            conn.commit()
 
     def delete_taxpayer(self, t_id: int):
         with self.db.get_connection() as conn:
             conn.execute("DELETE FROM taxpayers WHERE id=?", (t_id,))
-            conn.commit()
 
-class SourceService(BaseService):
-    def get_all(self) -> List[Source]:
-        with self.db.get_connection() as conn:
+    def get_sources(self) -> List[Source]:
+        with self.db.get_connection(readonly=True) as conn:
             rows = conn.execute("SELECT * FROM sources").fetchall()
             return [Source(**dict(row)) for row in rows]
-    
+
     def get_source(self, source_id: int) -> Optional[Source]:
-        with self.db.get_connection() as conn:
+        with self.db.get_connection(readonly=True) as conn:
             row = conn.execute("SELECT * FROM sources WHERE id=?", (source_id,)).fetchone()
             return Source(**dict(row)) if row else None
 
@@ -171,7 +1249,6 @@ class SourceService(BaseService):
                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
         with self.db.get_connection() as conn:
             cursor = conn.execute(query, (s.name, s.taxpayer_id, s.share_percentage, s.detail, s.default_amount, s.type, s.is_net, s.deduction_type))
-            conn.commit()
             return cursor.lastrowid
 
     def update_source(self, s: Source):
@@ -179,16 +1256,15 @@ class SourceService(BaseService):
                    WHERE id=?"""
         with self.db.get_connection() as conn:
             conn.execute(query, (s.name, s.taxpayer_id, s.share_percentage, s.detail, s.default_amount, s.type, s.is_net, s.deduction_type, s.id))
-            conn.commit()
+            self._reindex_search(conn, "t.source_id = ?", (s.id,))
 
     def delete_source(self, s_id: int):
         with self.db.get_connection() as conn:
             conn.execute("DELETE FROM sources WHERE id=?", (s_id,))
-            conn.commit()
+            self._reindex_search(conn, "t.source_id = ?", (s_id,))
 
-class PaymentMethodService(BaseService):
-    def get_all(self) -> List[PaymentMethod]:
-        with self.db.get_connection() as conn:
+    def get_payment_methods(self) -> List[PaymentMethod]:
+        with self.db.get_connection(readonly=True) as conn:
             rows = conn.execute("SELECT * FROM payment_methods").fetchall()
             return [PaymentMethod(**dict(row)) for row in rows]
 
@@ -196,37 +1272,19 @@ class PaymentMethodService(BaseService):
         query = "INSERT INTO payment_methods (method_name) VALUES (?)"
         with self.db.get_connection() as conn:
             cursor = conn.execute(query, (pm.method_name,))
-            conn.commit()
             return cursor.lastrowid
 
     def update_payment_method(self, pm: PaymentMethod):
         query = "UPDATE payment_methods SET method_name=? WHERE id=?"
         with self.db.get_connection() as conn:
             conn.execute(query, (pm.method_name, pm.id))
-            conn.commit()
 
     def delete_payment_method(self, pm_id: int):
         with self.db.get_connection() as conn:
             conn.execute("DELETE FROM payment_methods WHERE id=?", (pm_id,))
-            conn.commit()
-
-class DocumentService(BaseService):
-    def add_document(self, d: Document) -> int:
-        query = """INSERT INTO documents (doc_ref, display_name, relative_path, gdrive_id)
-                   VALUES (?, ?, ?, ?)"""
-        with self.db.get_connection() as conn:
-            cursor = conn.execute(query, (d.doc_ref, d.display_name, d.relative_path, d.gdrive_id))
-            conn.commit()
-            return cursor.lastrowid
 
-    def get_all(self) -> List[Document]:
-        with self.db.get_connection() as conn:
-            rows = conn.execute("SELECT * FROM documents").fetchall()
-            return [Document(**dict(row)) for row in rows]
-
-class TaxItemService(BaseService):
-    def get_all(self) -> List[TaxItem]:
-        with self.db.get_connection() as conn:
+    def get_tax_items(self) -> List[TaxItem]:
+        with self.db.get_connection(readonly=True) as conn:
             rows = conn.execute("SELECT * FROM tax_items ORDER BY code ASC").fetchall()
             return [TaxItem(**dict(row)) for row in rows]
 
@@ -234,30 +1292,145 @@ class TaxItemService(BaseService):
         query = "INSERT INTO tax_items (code, name) VALUES (?, ?)"
         with self.db.get_connection() as conn:
             cursor = conn.execute(query, (ti.code, ti.name))
-            conn.commit()
             return cursor.lastrowid
 
     def update_tax_item(self, ti: TaxItem):
         query = "UPDATE tax_items SET code=?, name=? WHERE id=?"
         with self.db.get_connection() as conn:
             conn.execute(query, (ti.code, ti.name, ti.id))
-            conn.commit()
+            self._reindex_search(conn, "t.tax_items_id = ?", (ti.id,))
 
     def delete_tax_item(self, ti_id: int):
         with self.db.get_connection() as conn:
             conn.execute("DELETE FROM tax_items WHERE id=?", (ti_id,))
-            conn.commit()
+            self._reindex_search(conn, "t.tax_items_id = ?", (ti_id,))
 
-class TransactionService(BaseService):
-    def add_transaction(self, t: Transaction):
-        query = """INSERT INTO transactions (taxpayer_id, transaction_date, year, month, day, type, source_id, 
-                   payment_method_id, document_id, amount, description, is_taxable, tax_items_id, gdrive_id)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
-        params = (t.taxpayer_id, t.transaction_date, t.year, t.month, t.day, t.type, t.source_id, 
-                  t.payment_method_id, t.document_id, t.amount, t.description, t.is_taxable, t.tax_items_id, t.gdrive_id)
+    def get_documents(self) -> List[Document]:
+        with self.db.get_connection(readonly=True) as conn:
+            rows = conn.execute("SELECT * FROM documents").fetchall()
+            return [Document(**dict(row)) for row in rows]
+
+    def add_document(self, d: Document) -> int:
+        query = """INSERT INTO documents (doc_ref, display_name, relative_path, gdrive_id)
+                   VALUES (?, ?, ?, ?)"""
         with self.db.get_connection() as conn:
-            conn.execute(query, params)
-            conn.commit()
+            cursor = conn.execute(query, (d.doc_ref, d.display_name, d.relative_path, d.gdrive_id))
+            return cursor.lastrowid
+
+    @staticmethod
+    def _insert_params(t: Transaction) -> Tuple:
+        return (t.taxpayer_id, t.transaction_date, t.year, t.month, t.day, t.type, t.source_id, 
+                t.payment_method_id, t.document_id, t.amount, t.description, t.is_taxable, t.tax_items_id, t.gdrive_id)
+
+    @staticmethod
+    def _rollup_key(t: Transaction) -> Tuple:
+        # Same normalization as ROLLUP_SELECT
+        return (t.taxpayer_id or 0, t.year or 0, t.month or 0, t.source_id, t.tax_items_id, t.type or 0,
+                1 if t.is_taxable else 0)
+
+    def _stored_rollup_key(self, conn: sqlite3.Connection, t_id: int) -> Optional[Tuple]:
+        row = conn.execute("""SELECT IFNULL(taxpayer_id, 0), IFNULL(year, 0), IFNULL(month, 0), source_id, tax_items_id,
+                                     IFNULL(type, 0), IFNULL(is_taxable, 0), amount
+                              FROM transactions WHERE id=?""", (t_id,)).fetchone()
+        return (tuple(row[:7]), row[7]) if row else None
+
+    @staticmethod
+    def _apply_rollup(conn: sqlite3.Connection, deltas: Dict[Tuple, List]):
+        """Adds {rollup key: [amount, count]} deltas to transaction_rollup and drops emptied groups"""
+        conn.executemany(ROLLUP_UPSERT, [key + (amount, count) for key, (amount, count) in deltas.items()])
+        shrunk = [key for key, (_, count) in deltas.items() if count < 0]
+        if shrunk:
+            conn.executemany(ROLLUP_PRUNE, shrunk)
+
+    def _rollup_deltas(self, transactions: List[Transaction]) -> Dict[Tuple, List]:
+        deltas = {}
+        for t in transactions:
+            acc = deltas.setdefault(self._rollup_key(t), [0.0, 0])
+            acc[0] += t.amount
+            acc[1] += 1
+        return deltas
+
+    def archives(self, year=None, taxpayer_id=None, **filters) -> List["archive.ArchiveFile"]:
+        """Archive files that can hold rows matching the transaction filters"""
+        return [self.db.archive_file(tp, y) for tp, y in self.db.archived_years()
+                if (not year or y == year) and (not taxpayer_id or tp == taxpayer_id)]
+
+    @staticmethod
+    def _archived_error(taxpayer_id: int, year: int) -> str:
+        return f"{year} of taxpayer {taxpayer_id} is archived, restore it before changing its transactions"
+
+    def _check_writable(self, t_id: Optional[int], *keys: Tuple) -> None:
+        archived = self.db.archived_years()
+        if not archived:
+            return
+        for key in keys:
+            if key in archived:
+                raise ValueError(self._archived_error(*key))
+        if t_id is not None:
+            for (taxpayer_id, year), f in self.db.archives().items():
+                if f.find(t_id) is not None:
+                    raise ValueError(self._archived_error(taxpayer_id, year))
+
+    def add_transaction(self, t: Transaction) -> int:
+        self._check_writable(None, (t.taxpayer_id, t.year))
+        with self.db.get_connection() as conn:
+            cursor = conn.execute(self.INSERT_QUERY, self._insert_params(t))
+            self._apply_rollup(conn, self._rollup_deltas([t]))
+            self._reindex_search(conn, "t.id = ?", (cursor.lastrowid,))
+            return cursor.lastrowid
+
+    def add_transactions(self, transactions: List[Transaction], chunk_size: int = 5000, atomic: bool = False) -> Tuple[int, List[Dict]]:
+        archived = self.db.archived_years()
+        positions = [i for i, t in enumerate(transactions) if (t.taxpayer_id, t.year) not in archived]
+        if len(positions) == len(transactions):
+            return self._insert_transactions(transactions, chunk_size, atomic)
+        # Rows of archived years are rejected like rows the database refuses
+        errors = [{"index": i, "error": self._archived_error(t.taxpayer_id, t.year)}
+                  for i, t in enumerate(transactions) if (t.taxpayer_id, t.year) in archived]
+        if atomic:
+            return 0, errors
+        inserted, db_errors = self._insert_transactions([transactions[i] for i in positions], chunk_size, atomic)
+        errors += [dict(e, index=positions[e["index"]]) for e in db_errors]
+        return inserted, sorted(errors, key=lambda e: e["index"])
+
+    def _insert_transactions(self, transactions: List[Transaction], chunk_size: int, atomic: bool) -> Tuple[int, List[Dict]]:
+        # `chunk_size` rows per executemany; a chunk the database rejects is retried row by row
+        inserted = 0
+        errors = []
+        with self.db.get_connection() as conn:
+            if not conn.in_transaction:
+                # Explicit BEGIN so releasing the chunk savepoints does not commit
+                conn.execute("BEGIN")
+            # New rows get ids above the current maximum, they are indexed for search in one statement at the end
+            last_id = conn.execute("SELECT IFNULL(MAX(id), 0) FROM transactions").fetchone()[0]
+            for start in range(0, len(transactions), chunk_size):
+                chunk = transactions[start:start + chunk_size]
+                conn.execute("SAVEPOINT bulk_chunk")
+                try:
+                    conn.executemany(self.INSERT_QUERY, [self._insert_params(t) for t in chunk])
+                    # One rollup upsert per group instead of per row
+                    self._apply_rollup(conn, self._rollup_deltas(chunk))
+                    conn.execute("RELEASE bulk_chunk")
+                    inserted += len(chunk)
+                    continue
+                except sqlite3.IntegrityError:
+                    conn.execute("ROLLBACK TO bulk_chunk")
+                    conn.execute("RELEASE bulk_chunk")
+                # Slow path only for a failing chunk: find the offending rows one by one
+                accepted = []
+                for offset, t in enumerate(chunk):
+                    try:
+                        conn.execute(self.INSERT_QUERY, self._insert_params(t))
+                        accepted.append(t)
+                    except sqlite3.IntegrityError as e:
+                        errors.append({"index": start + offset, "error": str(e)})
+                self._apply_rollup(conn, self._rollup_deltas(accepted))
+                inserted += len(accepted)
+            if atomic and errors:
+                conn.rollback()
+                return 0, errors
+            self._reindex_search(conn, "t.id > ?", (last_id,))
+        return inserted, errors
 
     def update_transaction(self, t: Transaction):
         query = """UPDATE transactions SET taxpayer_id=?, transaction_date=?, year=?, month=?, day=?, type=?, 
@@ -266,84 +1439,643 @@ class TransactionService(BaseService):
         params = (t.taxpayer_id, t.transaction_date, t.year, t.month, t.day, t.type, t.source_id, 
                   t.payment_method_id, t.document_id, t.amount, t.description, t.is_taxable, t.tax_items_id, t.gdrive_id, t.id)
         with self.db.get_connection() as conn:
+            stored = self._stored_rollup_key(conn, t.id)
+            self._check_writable(None if stored else t.id, (t.taxpayer_id, t.year), *([stored[0][:2]] if stored else []))
             conn.execute(query, params)
-            conn.commit()
+            if stored:
+                deltas = self._rollup_deltas([t])
+                acc = deltas.setdefault(stored[0], [0.0, 0])
+                acc[0] -= stored[1]
+                acc[1] -= 1
+                self._apply_rollup(conn, deltas)
+            self._reindex_search(conn, "t.id = ?", (t.id,))
 
     def delete_transaction(self, t_id: int):
         with self.db.get_connection() as conn:
+            stored = self._stored_rollup_key(conn, t_id)
+            if not stored:
+                self._check_writable(t_id)
             conn.execute("DELETE FROM transactions WHERE id=?", (t_id,))
-            conn.commit()
+            if stored:
+                self._apply_rollup(conn, {stored[0]: [-stored[1], -1]})
+            conn.execute("DELETE FROM transaction_search WHERE rowid=?", (t_id,))
 
     def get_transaction(self, t_id: int) -> Optional[Transaction]:
-        with self.db.get_connection() as conn:
+        with self.db.get_connection(readonly=True) as conn:
             row = conn.execute("SELECT * FROM transactions WHERE id=?", (t_id,)).fetchone()
             if row:
                 d = dict(row)
                 d.pop('tax_item_code', None)  # Prevent mapping error from deprecated column
                 return Transaction(**d)
-            return None
+        for f in self.db.archives().values():
+            d = f.find(t_id)
+            if d:
+                return Transaction(**d)
+        return None
 
-    def get_last_year(self) -> int:
-        query = "SELECT MAX(year) as last_year FROM transactions"
-        with self.db.get_connection() as conn:
-            row = conn.execute(query).fetchone()
-            if row and row['last_year']:
-                return row['last_year']
-        from datetime import datetime
-        return datetime.now().year
+    def get_last_year(self) -> Optional[int]:
+        with self.db.get_connection(readonly=True) as conn:
+            last = conn.execute("SELECT MAX(year) FROM transactions").fetchone()[0]
+        return max([y for y in [last] + [year for _, year in self.db.archived_years()] if y is not None], default=None)
 
     def get_years(self) -> List[int]:
-        query = "SELECT DISTINCT year FROM transactions ORDER BY year DESC"
+        with self.db.get_connection(readonly=True) as conn:
+            years = [row[0] for row in conn.execute("SELECT DISTINCT year FROM transactions ORDER BY year DESC")]
+        archived = {year for _, year in self.db.archived_years()} - set(years)
+        return sorted(years + list(archived), key=lambda y: (y is not None, y or 0), reverse=True) if archived else years
+
+    def get_transactions(self, **filters) -> List[Dict]:
+        query, params = _transactions_query(**filters)
+        with self.db.get_connection(readonly=True) as conn:
+            rows = conn.execute(query, params).fetchall()
+        with self.db.timed("transactions.rows_to_dicts"):
+            result = [dict(row) for row in rows]
+        archived = self.archives(**filters)
+        if archived:
+            with self.db.timed("transactions.archive"):
+                result += self._archived_transactions(archived, filters)
+                # Same order as _transactions_query
+                result.sort(key=lambda r: (r["transaction_date"], -r["source_id"], r["id"]), reverse=True)
+        return result
+
+    def archived_page(self, filters: Dict, order, limit: int, after: Optional[List] = None) -> List[Dict]:
+        """Up to `limit` rows of each archive file matching `filters`, in `order` after the keyset values
+        `after`; merged with the same page of the transactions table they give a keyset page of both"""
+        archived = self.archives(**filters)
+        return self._archived_transactions(archived, filters, order, limit, after) if archived else []
+
+    def _archived_transactions(self, archived: List["archive.ArchiveFile"], filters: Dict, order=None,
+                               limit: Optional[int] = None, after: Optional[List] = None) -> List[Dict]:
+        """Matching rows of the archive files with the names get_transactions joins in. With `order`, only the
+        first `limit` rows of each file that come after the keyset values `after` (ArchiveFile.page)."""
+        with self.db.get_connection(readonly=True) as conn:
+            taxpayers = {row[0]: row[1] for row in conn.execute("SELECT id, full_name FROM taxpayers")}
+            sources = {row[0]: tuple(row[1:]) for row in conn.execute("SELECT id, name, deduction_type FROM sources")}
+            methods = {row[0]: row[1] for row in conn.execute("SELECT id, method_name FROM payment_methods")}
+            documents = {row[0]: tuple(row[1:]) for row in conn.execute("SELECT id, doc_ref, display_name, relative_path FROM documents")}
+            tax_items = {row[0]: tuple(row[1:]) for row in conn.execute("SELECT id, code, name FROM tax_items")}
+        rows = []
+        for f in archived:
+            mask = f.mask(**filters)
+            for row in (f.page(order, limit, after, mask) if order else f.records(mask)):
+                source_name, deduction_type = sources.get(row["source_id"], (None, None))
+                doc_ref, doc_name, relative_path = documents.get(row["document_id"], (None, None, None))
+                tax_item_code, tax_item_name = tax_items.get(row["tax_items_id"], (None, None))
+                row.update(taxpayer_name=taxpayers.get(row["taxpayer_id"]), source_name=source_name,
+                           deduction_type=deduction_type, method_name=methods.get(row["payment_method_id"]),
+                           doc_ref=doc_ref, doc_name=doc_name, relative_path=relative_path,
+                           tax_item_code=tax_item_code, tax_item_name=tax_item_name)
+                rows.append(row)
+        return rows
+
+    def get_totals(self, **filters) -> Dict:
+        # Every filter column is a rollup key, so the sums come from O(#groups) rollup rows
+        where, params = _transaction_filters(**filters)
+        query = f"""SELECT IFNULL(SUM(t.count), 0) as count,
+                           TOTAL(CASE WHEN t.type = {TransactionType.INCOME} THEN t.amount END) as income,
+                           TOTAL(CASE WHEN t.type = {TransactionType.EXPENSE} THEN t.amount END) as expense,
+                           TOTAL(CASE WHEN t.type = {TransactionType.INCOME} AND t.is_taxable THEN t.amount END) as taxable
+                    FROM transaction_rollup t
+                    WHERE 1=1""" + where
+        with self.db.get_connection(readonly=True) as conn:
+            return dict(conn.execute(query, params).fetchone())
+
+    def get_taxable_totals(self, years: List[int], taxpayer_ids: Optional[List[int]] = None) -> List[Dict]:
+        # One grouped pass over the taxable rollup groups of all requested years
+        query = f"""SELECT t.taxpayer_id, t.year, t.type, t.source_id, ti.code as tax_item_code, ti.name as tax_item_name,
+                           SUM(t.amount) as amount
+                    FROM transaction_rollup t
+                    LEFT JOIN tax_items ti ON t.tax_items_id = ti.id
+                    WHERE t.is_taxable = 1 AND t.year IN ({','.join('?' * len(years))})"""
+        params = list(years)
+        if taxpayer_ids is not None and len(taxpayer_ids) <= 500:
+            query += f" AND t.taxpayer_id IN ({','.join('?' * len(taxpayer_ids))})"
+            params += taxpayer_ids
+        query += " GROUP BY t.taxpayer_id, t.year, t.type, t.source_id, t.tax_items_id"
+        with self.db.get_connection(readonly=True) as conn:
+            rows = [dict(row) for row in conn.execute(query, params)]
+        if taxpayer_ids is not None and len(taxpayer_ids) > 500:
+            wanted = set(taxpayer_ids)
+            rows = [row for row in rows if row['taxpayer_id'] in wanted]
+        return rows
+
+    def get_special_deductions(self, taxpayer_id: int, year: int) -> List[Dict]:
+        # We need to join the rollup with sources to check deduction_type
+        query = """
+            SELECT s.name, SUM(t.amount) as amount 
+            FROM transaction_rollup t
+            JOIN sources s ON t.source_id = s.id
+            WHERE t.taxpayer_id = ? AND t.year = ? AND t.type = -1 AND s.deduction_type = 1
+            GROUP BY s.name
+        """
+        with self.db.get_connection(readonly=True) as conn:
+            rows = conn.execute(query, (taxpayer_id, year)).fetchall()
+            return [{"name": row['name'], "amount": row['amount']} for row in rows]
+
+    def get_tax_setting(self, year: int) -> Optional[TaxSetting]:
+        with self.db.get_connection(readonly=True) as conn:
+            row = conn.execute("SELECT * FROM tax_settings WHERE year=?", (year,)).fetchone()
+            return TaxSetting(**dict(row)) if row else None
+
+    def save_tax_setting(self, s: TaxSetting):
+        query = """INSERT OR REPLACE INTO tax_settings (year, exemption_amount, declaration_limit, lump_sum_rate, withholding_rate, tax_brackets)
+                   VALUES (?, ?, ?, ?, ?, ?)"""
+        with self.db.get_connection() as conn:
+            conn.execute(query, (s.year, s.exemption_amount, s.declaration_limit, s.lump_sum_rate, s.withholding_rate, s.tax_brackets))
+
+    DECLARATION_INSERT = """INSERT INTO declarations (taxpayer_id, year, name, expense_method, total_income, 
+                            exemption_applied, expense_amount, deductions_amount, tax_base, calculated_tax, 
+                            withholding_tax, net_tax_to_pay, status)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+    @staticmethod
+    def _declaration_params(d: Declaration) -> Tuple:
+        return (d.taxpayer_id, d.year, d.name, d.expense_method, d.total_income, d.exemption_applied,
+                d.expense_amount, d.deductions_amount, d.tax_base, d.calculated_tax, d.withholding_tax,
+                d.net_tax_to_pay, d.status)
+
+    def add_declaration(self, d: Declaration) -> int:
+        with self.db.get_connection() as conn:
+            cursor = conn.execute(self.DECLARATION_INSERT, self._declaration_params(d))
+            return cursor.lastrowid
+
+    def add_declarations(self, declarations: List[Declaration], replace_drafts: bool = False) -> List[int]:
         with self.db.get_connection() as conn:
-            rows = conn.execute(query).fetchall()
-            years = [row['year'] for row in rows]
-            if not years:
-                from datetime import datetime
-                years = [datetime.now().year]
-            return years
+            if replace_drafts:
+                conn.executemany("DELETE FROM declarations WHERE taxpayer_id=? AND year=? AND name=? AND status='draft'",
+                                 list({(d.taxpayer_id, d.year, d.name) for d in declarations}))
+            ids = [conn.execute(self.DECLARATION_INSERT, self._declaration_params(d)).lastrowid for d in declarations]
+            return ids
+
+    def get_declarations(self, taxpayer_id: int, year: int) -> List[Declaration]:
+        with self.db.get_connection(readonly=True) as conn:
+            rows = conn.execute("SELECT * FROM declarations WHERE taxpayer_id=? AND year=?", (taxpayer_id, year)).fetchall()
+            return [Declaration(**dict(row)) for row in rows]
+
+    def delete_declaration(self, dec_id: int):
+        with self.db.get_connection() as conn:
+            conn.execute("DELETE FROM declarations WHERE id=?", (dec_id,))
+
+    def get_last_final_actual_year(self, taxpayer_id: int, first_year: int, last_year: int) -> Optional[int]:
+        with self.db.get_connection(readonly=True) as conn:
+            return conn.execute("""SELECT MAX(year) FROM declarations
+                                   WHERE taxpayer_id = ? AND status = 'final' AND expense_method = 'actual'
+                                   AND year BETWEEN ? AND ?""", (taxpayer_id, first_year, last_year)).fetchone()[0]
+
+# --- SERVICES ---
+class BaseService:
+    def __init__(self, db: Union[Database, Repository]):
+        # A Database is served through SqliteRepository, other backends are passed as their Repository
+        self.repo = db if isinstance(db, Repository) else SqliteRepository(db)
+        self.db = self.repo.db
+        self.cache = self.repo.cache
+
+    def _sqlite(self) -> Database:
+        """The SQLite Database behind SQLite-only features such as full-text search"""
+        if self.db is None:
+            raise NotImplementedError(f"{type(self.repo).__name__} does not support this operation, it needs SQLite")
+        return self.db
+
+class TaxpayerService(BaseService):
+    def get_all(self) -> List[Taxpayer]:
+        return list(self.cache.get_or_load("taxpayers", self.repo.get_taxpayers))
+
+    def add_taxpayer(self, t: Taxpayer) -> int:
+        with self.repo.transaction():
+            t_id = self.repo.add_taxpayer(t)
+            self.cache.invalidate("taxpayers")
+        return t_id
+
+    def update_taxpayer(self, t: Taxpayer):
+        with self.repo.transaction():
+            self.repo.update_taxpayer(t)
+            self.cache.invalidate("taxpayers")
+
+    def delete_taxpayer(self, t_id: int):
+        with self.repo.transaction():
+            self.repo.delete_taxpayer(t_id)
+            self.cache.invalidate("taxpayers")
+
+class SourceService(BaseService):
+    def get_all(self) -> List[Source]:
+        return list(self.cache.get_or_load("sources", self.repo.get_sources))
+
+    def get_source(self, source_id: int) -> Optional[Source]:
+        return self.repo.get_source(source_id)
+
+    def add_source(self, s: Source) -> int:
+        with self.repo.transaction():
+            s_id = self.repo.add_source(s)
+            self.cache.invalidate("sources")
+        return s_id
+
+    def update_source(self, s: Source):
+        with self.repo.transaction():
+            self.repo.update_source(s)
+            self.cache.invalidate("sources")
+
+    def delete_source(self, s_id: int):
+        with self.repo.transaction():
+            self.repo.delete_source(s_id)
+            self.cache.invalidate("sources")
+
+class PaymentMethodService(BaseService):
+    def get_all(self) -> List[PaymentMethod]:
+        return list(self.cache.get_or_load("payment_methods", self.repo.get_payment_methods))
+
+    def add_payment_method(self, pm: PaymentMethod) -> int:
+        with self.repo.transaction():
+            pm_id = self.repo.add_payment_method(pm)
+            self.cache.invalidate("payment_methods")
+        return pm_id
+
+    def update_payment_method(self, pm: PaymentMethod):
+        with self.repo.transaction():
+            self.repo.update_payment_method(pm)
+            self.cache.invalidate("payment_methods")
+
+    def delete_payment_method(self, pm_id: int):
+        with self.repo.transaction():
+            self.repo.delete_payment_method(pm_id)
+            self.cache.invalidate("payment_methods")
+
+class DocumentService(BaseService):
+    def add_document(self, d: Document) -> int:
+        with self.repo.transaction():
+            doc_id = self.repo.add_document(d)
+            self.cache.invalidate("documents")
+        return doc_id
+
+    def get_all(self) -> List[Document]:
+        return self.repo.get_documents()
+
+class TaxItemService(BaseService):
+    def get_all(self) -> List[TaxItem]:
+        return list(self.cache.get_or_load("tax_items", self.repo.get_tax_items))
+
+    def add_tax_item(self, ti: TaxItem) -> int:
+        with self.repo.transaction():
+            ti_id = self.repo.add_tax_item(ti)
+            self.cache.invalidate("tax_items")
+        return ti_id
+
+    def update_tax_item(self, ti: TaxItem):
+        with self.repo.transaction():
+            self.repo.update_tax_item(ti)
+            self.cache.invalidate("tax_items")
+
+    def delete_tax_item(self, ti_id: int):
+        with self.repo.transaction():
+            self.repo.delete_tax_item(ti_id)
+            self.cache.invalidate("tax_items")
+
+class TransactionService(BaseService):
+    def add_transaction(self, t: Transaction) -> int:
+        with self.repo.transaction():
+            t_id = self.repo.add_transaction(t)
+            self.cache.invalidate("transactions", scopes=[(t.taxpayer_id, t.year)])
+        return t_id
+
+    def add_transactions(self, transactions: List[Transaction], chunk_size: int = 5000, atomic: bool = False) -> Tuple[int, List[Dict]]:
+        """Bulk insert inside a single database transaction, `chunk_size` rows per executemany.
+        Returns (inserted_count, errors); errors carry the list index of each row the database rejected.
+        With atomic=True any rejected row rolls back the whole import."""
+        with self.repo.transaction():
+            inserted, errors = self.repo.add_transactions(transactions, chunk_size=chunk_size, atomic=atomic)
+            if inserted:
+                self.cache.invalidate("transactions", scopes={(t.taxpayer_id, t.year) for t in transactions})
+        return inserted, errors
+
+    def update_transaction(self, t: Transaction):
+        with self.repo.transaction():
+            # The (taxpayer_id, year) the row moves out of changes as well as the one it moves into
+            stored = self.repo.get_transaction(t.id)
+            self.repo.update_transaction(t)
+            scopes = {(t.taxpayer_id, t.year)}
+            if stored:
+                scopes.add((stored.taxpayer_id, stored.year))
+            self.cache.invalidate("transactions", scopes=scopes)
+
+    def delete_transaction(self, t_id: int):
+        with self.repo.transaction():
+            stored = self.repo.get_transaction(t_id)
+            self.repo.delete_transaction(t_id)
+            self.cache.invalidate("transactions", scopes=[(stored.taxpayer_id, stored.year)] if stored else [])
+
+    def get_transaction(self, t_id: int) -> Optional[Transaction]:
+        return self.repo.get_transaction(t_id)
+
+    def get_last_year(self) -> int:
+        return self.cache.get_or_load("transactions", self._load_last_year, key="last_year")
+
+    def _load_last_year(self) -> int:
+        return self.repo.get_last_year() or datetime.now().year
+
+    def get_years(self) -> List[int]:
+        return list(self.cache.get_or_load("transactions", self._load_years, key="years"))
+
+    def _load_years(self) -> List[int]:
+        return self.repo.get_years() or [datetime.now().year]
 
     def get_transactions(self, year=None, taxpayer_id=None, transaction_type=None, month=None, source_id=None, is_taxable=None, tax_items_id=None) -> List[Dict]:
-        query = """SELECT t.*, tp.full_name as taxpayer_name, s.name as source_name, s.deduction_type, pm.method_name,
-                          d.doc_ref, d.display_name as doc_name, d.relative_path, ti.code as tax_item_code, ti.name as tax_item_name
-                   FROM transactions t
-                   LEFT JOIN taxpayers tp ON t.taxpayer_id = tp.id
-                   LEFT JOIN sources s ON t.source_id = s.id
-                   LEFT JOIN payment_methods pm ON t.payment_method_id = pm.id
-                   LEFT JOIN documents d ON t.document_id = d.id
-                   LEFT JOIN tax_items ti ON t.tax_items_id = ti.id
-                   WHERE 1=1"""
-        params = []
-        if year:
-            query += " AND t.year = ?"; params.append(year)
-        if month:
-            query += " AND t.month = ?"; params.append(month)
-        if taxpayer_id:
-            query += " AND t.taxpayer_id = ?"; params.append(taxpayer_id)
-        if transaction_type:
-            query += " AND t.type = ?"; params.append(transaction_type)
-        if source_id:
-            if isinstance(source_id, list):
-                placeholders = ','.join(['?' for _ in source_id])
-                query += f" AND t.source_id IN ({placeholders})"
-                params.extend(source_id)
+        return self.repo.get_transactions(year=year, taxpayer_id=taxpayer_id, transaction_type=transaction_type, month=month,
+                                          source_id=source_id, is_taxable=is_taxable, tax_items_id=tax_items_id)
+
+    def iter_transactions(self, batch_size: int = 1000, **filters):
+        """Yields get_transactions rows in batches of `batch_size` dicts without materializing the full result"""
+        batches = self._tuple_batches(batch_size, filters)
+        columns = next(batches)
+        for rows in batches:
+            yield [dict(zip(columns, row)) for row in rows]
+
+    def _tuple_batches(self, batch_size: int, filters: Dict):
+        """Yields the get_transactions column names, then the rows as tuples in batches of `batch_size`.
+        Filters that reach an archived year are served by get_transactions, which merges the archive in."""
+        db = self._sqlite()
+        if self.repo.archives(**filters):
+            yield list(TRANSACTION_LIST_COLUMNS)
+            rows = self.get_transactions(**filters)
+            for start in range(0, len(rows), batch_size):
+                yield [tuple(row[c] for c in TRANSACTION_LIST_COLUMNS) for row in rows[start:start + batch_size]]
+            return
+        query, params = _transactions_query(**filters)
+        with db.get_connection(readonly=True, reuse=False) as conn:
+            cursor = conn.execute(query, params)
+            cursor.row_factory = None  # Plain tuples, no sqlite3.Row per row
+            yield [d[0] for d in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+
+    def iter_transactions_json(self, shape: str = "objects", batch_size: int = 1000, **filters):
+        """Yields the GET /transactions body as JSON byte chunks, encoded straight from cursor batches"""
+        if shape not in TRANSACTION_SHAPES:
+            raise ValueError(f"Unsupported shape '{shape}', expected one of: {', '.join(TRANSACTION_SHAPES)}")
+        return self._iter_transactions_json(shape, batch_size, filters)
+
+    def _iter_transactions_json(self, shape: str, batch_size: int, filters: Dict):
+        income = expense = taxable = 0.0
+        batches = self._tuple_batches(batch_size, filters)
+        columns = next(batches)
+        type_i, amount_i, taxable_i = columns.index("type"), columns.index("amount"), columns.index("is_taxable")
+        if shape == "columnar":
+            yield b'{"transactions":{"columns":' + dump_json(columns) + b',"rows":['
+        else:
+            yield b'{"transactions":['
+        separator = b""
+        for rows in batches:
+            # Summed in list order, like get_transactions_with_summary
+            for row in rows:
+                if row[type_i] == TransactionType.INCOME:
+                    income += row[amount_i]
+                    if row[taxable_i]:
+                        taxable += row[amount_i]
+                elif row[type_i] == TransactionType.EXPENSE:
+                    expense += row[amount_i]
+            chunk = dump_json(rows if shape == "columnar" else [dict(zip(columns, row)) for row in rows])
+            yield separator + chunk[1:-1]
+            separator = b","
+        yield (b"]}" if shape == "columnar" else b"]") + b',"summary":' + dump_json(self._summary(income, expense, taxable)) + b"}"
+
+    def export_transactions(self, fmt: str = "ndjson", batch_size: int = 1000, **filters):
+        """Yields NDJSON or CSV text chunks, one chunk per fetched batch"""
+        if fmt not in ("ndjson", "csv"):
+            raise ValueError(f"Unsupported export format '{fmt}', expected 'ndjson' or 'csv'")
+        if fmt == "csv":
+            # Header first, so an export without rows is still a parseable CSV
+            buf = io.StringIO()
+            csv.writer(buf, lineterminator="\n").writerow(TRANSACTION_LIST_COLUMNS)
+            yield buf.getvalue()
+        for batch in self.iter_transactions(batch_size=batch_size, **filters):
+            if fmt == "ndjson":
+                yield "".join(json.dumps(row, ensure_ascii=False, default=str) + "\n" for row in batch)
+                continue
+            buf = io.StringIO()
+            csv.DictWriter(buf, fieldnames=TRANSACTION_LIST_COLUMNS, lineterminator="\n").writerows(batch)
+            yield buf.getvalue()
+
+    def explain_transactions(self, **filters) -> List[str]:
+        """Returns the EXPLAIN QUERY PLAN details of get_transactions for the given filters"""
+        query, params = _transactions_query(**filters)
+        with self._sqlite().get_connection(readonly=True) as conn:
+            rows = conn.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()
+            return [row['detail'] for row in rows]
+
+    @staticmethod
+    def _search_expression(text: str) -> str:
+        # Every word becomes a quoted prefix term, so user input is never parsed as FTS5 query syntax
+        terms = [term for term in text.replace("ı", "i").split() if any(ch.isalnum() for ch in term)]
+        return " ".join('"' + term.replace('"', '""') + '"*' for term in terms)
+
+    def search_transactions(self, text: str, limit: int = 50, offset: int = 0, **filters) -> Dict:
+        """Transactions whose description, source, tax item or document matches every word of `text` (as a prefix),
+        with the same filters as get_transactions. Up to SEARCH_RANK_LIMIT matches are ordered by bm25 score,
+        broader searches by newest transaction id."""
+        expression = self._search_expression(text)
+        if not expression:
+            raise ValueError("Search text must contain at least one word")
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"Page size must be between 1 and {MAX_PAGE_SIZE}")
+        if offset < 0:
+            raise ValueError("Offset must not be negative")
+        where, params = _transaction_filters(**filters)
+        weights = ", ".join(str(w) for w in SEARCH_WEIGHTS)
+        with self._sqlite().get_connection(readonly=True) as conn:
+            # The probe stops after SEARCH_RANK_LIMIT + 1 matches; narrower searches come back complete and scored
+            probe = conn.execute(f"""SELECT rowid AS id, bm25(transaction_search, {weights}) AS score FROM transaction_search
+                                     WHERE transaction_search MATCH ? LIMIT ?""",
+                                 (expression, SEARCH_RANK_LIMIT + 1)).fetchall()
+            ranked = len(probe) <= SEARCH_RANK_LIMIT
+            if ranked:
+                scores = {r['id']: r['score'] for r in probe}
+                ids = list(scores)
+                if where and ids:
+                    ids = [r[0] for r in conn.execute(f"SELECT t.id FROM transactions t WHERE t.id IN (SELECT value FROM json_each(?)){where}",
+                                                      [json.dumps(ids)] + params).fetchall()]
+                ids.sort(key=lambda i: (scores[i], -i))
+                total = len(ids)
+                page = [(i, scores[i]) for i in ids[offset:offset + limit]]
+            elif where:
+                # IN (...) materializes the matching rowids once, a join would run MATCH again for every filtered row
+                filtered = f"""FROM transactions t
+                               WHERE t.id IN (SELECT rowid FROM transaction_search WHERE transaction_search MATCH ?){where}"""
+                page = conn.execute(f"SELECT t.id, COUNT(*) OVER () {filtered} ORDER BY t.id DESC LIMIT ? OFFSET ?",
+                                    [expression] + params + [limit, offset]).fetchall()
+                total = page[0][1] if page else conn.execute(f"SELECT COUNT(*) {filtered}", [expression] + params).fetchone()[0]
+                page = [(r[0], None) for r in page]
             else:
-                query += " AND t.source_id = ?"
-                params.append(source_id)
-        if is_taxable is not None:
-            query += " AND t.is_taxable = ?"; params.append(1 if is_taxable else 0)
-        if tax_items_id:
-            query += " AND t.tax_items_id = ?"; params.append(tax_items_id)
-        
-        query += " ORDER BY t.transaction_date DESC, t.source_id ASC, t.id DESC"
-        with self.db.get_connection() as conn:
-            rows = conn.execute(query, params).fetchall()
-            return [dict(row) for row in rows]
+                total = conn.execute("SELECT COUNT(*) FROM transaction_search WHERE transaction_search MATCH ?", (expression,)).fetchone()[0]
+                page = [(r[0], None) for r in conn.execute("""SELECT rowid FROM transaction_search WHERE transaction_search MATCH ?
+                                                              ORDER BY rowid DESC LIMIT ? OFFSET ?""",
+                                                           (expression, limit, offset)).fetchall()]
+            rows = {}
+            if page:
+                placeholders = ",".join("?" * len(page))
+                query, _ = _transactions_query(order_by="t.id", extra_where=f" AND t.id IN ({placeholders})")
+                rows = {row['id']: dict(row) for row in conn.execute(query, [i for i, _ in page]).fetchall()}
+        # bm25 is lower for better matches, score is flipped so that higher means more relevant
+        results = [dict(rows[i], score=None if score is None else round(-score, 4)) for i, score in page if i in rows]
+        return {"transactions": results, "page": {"limit": limit, "offset": offset, "total": total, "ranked": ranked}}
 
     def get_summary(self, year=None, taxpayer_id=None, transaction_type=None, month=None, source_id=None, is_taxable=None, tax_items_id=None) -> Dict:
+        row = self.repo.get_totals(year=year, taxpayer_id=taxpayer_id, transaction_type=transaction_type, month=month,
+                                   source_id=source_id, is_taxable=is_taxable, tax_items_id=tax_items_id)
+        return self._summary(row['income'], row['expense'], row['taxable'])
+
+    def get_analytics(self, group_by: List[str], years: Optional[List[int]] = None, shape: str = "objects", **filters) -> Dict:
+        """Count, income, expense, taxable and net totals per combination of `group_by` columns, as a series ordered
+        by those columns. Sums come from transaction_rollup; payment_method_id is not a rollup key, so grouping by it
+        aggregates the transactions table instead. `years` restricts (and compares) several years in one call."""
+        unknown = [col for col in group_by if col not in ANALYTICS_GROUPS]
+        if unknown:
+            raise ValueError(f"Unsupported group_by '{unknown[0]}', expected any of: {', '.join(ANALYTICS_GROUPS)}")
+        if shape not in TRANSACTION_SHAPES:
+            raise ValueError(f"Unsupported shape '{shape}', expected one of: {', '.join(TRANSACTION_SHAPES)}")
+        group_by = list(dict.fromkeys(group_by))
+        where, params = _transaction_filters(**filters)
+        if years:
+            where += f" AND t.year IN ({','.join('?' * len(years))})"
+            params.extend(years)
+        rollup = "payment_method_id" not in group_by
+        # Same normalization as ROLLUP_SELECT, so both sources return 0 for missing keys
+        keys = "".join(f"IFNULL(t.{col}, 0) AS {col}, " for col in group_by)
+        query = f"""SELECT {keys}{'IFNULL(SUM(t.count), 0)' if rollup else 'COUNT(*)'} as count,
+                           TOTAL(CASE WHEN t.type = {TransactionType.INCOME} THEN t.amount END) as income,
+                           TOTAL(CASE WHEN t.type = {TransactionType.EXPENSE} THEN t.amount END) as expense,
+                           TOTAL(CASE WHEN t.type = {TransactionType.INCOME} AND t.is_taxable THEN t.amount END) as taxable
+                    FROM {'transaction_rollup' if rollup else 'transactions'} t
+                    WHERE 1=1""" + where
+        if group_by:
+            positions = ", ".join(str(i + 1) for i in range(len(group_by)))
+            query += f" GROUP BY {positions} HAVING count > 0 ORDER BY {positions}"
+        with self._sqlite().get_connection(readonly=True) as conn:
+            rows = [tuple(row) for row in conn.execute(query, params)]
+        archived = [] if rollup else [f for f in self.repo.archives(**filters) if not years or f.year in years]
+        if archived:
+            # Archived rows are only in their column files (the rollup still covers them)
+            merged = {row[:len(group_by)]: list(row[len(group_by):]) for row in rows}
+            for f in archived:
+                for g in f.aggregate(group_by, f.mask(**filters)):
+                    acc = merged.setdefault(g[:len(group_by)], [0, 0.0, 0.0, 0.0])
+                    acc[0] += g[len(group_by)]
+                    for i in (1, 2, 3):
+                        acc[i] += g[len(group_by) + 1 + i]
+            rows = [key + tuple(acc) for key, acc in sorted(merged.items())]
+
+        columns = group_by + ["count", "total_income", "total_expense", "taxable_income", "net_income"]
+        n = len(group_by)
+        values = [row[:n] + (row[n], row[n + 1], row[n + 2], row[n + 3], row[n + 1] - row[n + 2]) for row in rows]
+        income, expense, taxable = (sum(v[len(group_by) + i] for v in values) for i in (1, 2, 3))
+        totals = dict(self._summary(income, expense, taxable), count=sum(v[len(group_by)] for v in values))
+        return {
+            "group_by": group_by,
+            "years": list(years or []),
+            "series": {"columns": columns, "rows": values} if shape == "columnar" else [dict(zip(columns, v)) for v in values],
+            "totals": totals,
+        }
+
+    def get_transactions_page(self, limit: int = 100, cursor: Optional[str] = None, sort: str = "date_desc", shape: str = "objects", **filters) -> Dict:
+        """Keyset-paginated transaction list with next/prev cursors, plus the summary and total of the whole filter"""
+        if sort not in TRANSACTION_SORTS:
+            raise ValueError(f"Unsupported sort '{sort}', expected one of: {', '.join(TRANSACTION_SORTS)}")
+        if shape not in TRANSACTION_SHAPES:
+            raise ValueError(f"Unsupported shape '{shape}', expected one of: {', '.join(TRANSACTION_SHAPES)}")
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"Page size must be between 1 and {MAX_PAGE_SIZE}")
+        keys = TRANSACTION_SORTS[sort]
+
+        backwards, values = False, None
+        extra_where, extra_params = "", []
+        if cursor:
+            backwards, values = self._decode_cursor(cursor, sort)
+            extra_where, extra_params = self._keyset_condition(keys, values, backwards)
+        # A previous page is read in reverse order starting from the cursor, then flipped back
+        order = [(col, ("ASC" if d == "DESC" else "DESC") if backwards else d) for col, d in keys]
+        order_by = ", ".join(f"t.{col} {d}" for col, d in order)
+
+        query, params = _transactions_query(order_by=order_by, extra_where=extra_where, extra_params=extra_params, **filters)
+        query += " LIMIT ?"
+        params.append(limit + 1)
+        with self._sqlite().get_connection(readonly=True) as conn:
+            result = conn.execute(query, params)
+            result.row_factory = None
+            columns = [d[0] for d in result.description]
+            rows = result.fetchall()
+        # Each matching archive file contributes its own first limit + 1 rows after the cursor, merged in the same order
+        archived = [tuple(row[c] for c in columns) for row in self.repo.archived_page(filters, order, limit + 1, values)]
+        if archived:
+            rows += archived
+            for col, d in reversed(order):
+                rows.sort(key=lambda row, i=columns.index(col): row[i], reverse=d == "DESC")
+            rows = rows[:limit + 1]
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+        has_next = True if backwards else has_more
+        has_prev = has_more if backwards else cursor is not None
+
+        aggregate = self.repo.get_totals(**filters)
+        first, last = (dict(zip(columns, rows[0])), dict(zip(columns, rows[-1]))) if rows else (None, None)
+        return {
+            "transactions": {"columns": columns, "rows": rows} if shape == "columnar" else [dict(zip(columns, row)) for row in rows],
+            "summary": self._summary(aggregate['income'], aggregate['expense'], aggregate['taxable']),
+            "page": {
+                "limit": limit,
+                "sort": sort,
+                "total": aggregate['count'],
+                "next_cursor": self._encode_cursor(sort, False, last, keys) if rows and has_next else None,
+                "prev_cursor": self._encode_cursor(sort, True, first, keys) if rows and has_prev else None,
+            }
+        }
+
+    @staticmethod
+    def _keyset_condition(keys, values, backwards: bool) -> Tuple[str, List]:
+        # Expands (k1, k2, k3) > (v1, v2, v3) for mixed sort directions:
+        # k1 > v1 OR (k1 = v1 AND k2 > v2) OR (k1 = v1 AND k2 = v2 AND k3 > v3)
+        clauses, params = [], []
+        for i, (col, direction) in enumerate(keys):
+            after = (direction == "DESC") != backwards
+            parts = [f"t.{c} = ?" for c, _ in keys[:i]] + [f"t.{col} {'<' if after else '>'} ?"]
+            clauses.append("(" + " AND ".join(parts) + ")")
+            params.extend(values[:i + 1])
+        return " AND (" + " OR ".join(clauses) + ")", params
+
+    @staticmethod
+    def _encode_cursor(sort: str, backwards: bool, row: Dict, keys) -> str:
+        payload = {"s": sort, "b": backwards, "k": [row[col] for col, _ in keys]}
+        return base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode().rstrip("=")
+
+    @staticmethod
+    def _decode_cursor(cursor: str, sort: str) -> Tuple[bool, List]:
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            payload = json.loads(base64.urlsafe_b64decode(padded))
+            backwards, values = bool(payload["b"]), list(payload["k"])
+        except (ValueError, KeyError, TypeError):
+            raise ValueError("Invalid cursor")
+        if payload.get("s") != sort or len(values) != len(TRANSACTION_SORTS[sort]):
+            raise ValueError("Cursor does not match the requested sort")
+        return backwards, values
+
+    def get_transactions_with_summary(self, year=None, taxpayer_id=None, transaction_type=None, month=None, source_id=None, is_taxable=None, tax_items_id=None) -> Tuple[List[Dict], Dict]:
+        """Returns the transaction list and its summary from a single query"""
         txs = self.get_transactions(year, taxpayer_id, transaction_type, month, source_id, is_taxable, tax_items_id)
-        income = sum(t['amount'] for t in txs if t['type'] == TransactionType.INCOME)
-        expense = sum(t['amount'] for t in txs if t['type'] == TransactionType.EXPENSE)
-        taxable = sum(t['amount'] for t in txs if t['type'] == TransactionType.INCOME and t['is_taxable'])
+        income = expense = taxable = 0.0
+        for t in txs:
+            if t['type'] == TransactionType.INCOME:
+                income += t['amount']
+                if t['is_taxable']:
+                    taxable += t['amount']
+            elif t['type'] == TransactionType.EXPENSE:
+                expense += t['amount']
+        return txs, self._summary(income, expense, taxable)
+
+    @staticmethod
+    def _summary(income: float, expense: float, taxable: float) -> Dict:
         return {
             "total_income": income, "total_expense": expense, 
             "taxable_income": taxable, "net_income": income - expense
@@ -351,108 +2083,152 @@ class TransactionService(BaseService):
 
 class TaxSettingService(BaseService):
     def get_settings(self, year: int) -> Optional[TaxSetting]:
-        with self.db.get_connection() as conn:
-            row = conn.execute("SELECT * FROM tax_settings WHERE year=?", (year,)).fetchone()
-            if row:
-                return TaxSetting(**dict(row))
-            # Fallback defaults for 2025 if not found
-            if year == 2025:
-                # Default Brackets for 2025 (Simple Example, should be updated)
-                # 0-158.000 -> 15%
-                # 158.000 - 380.000 -> 20%
-                # ... Simplified for planning
-                import json
-                brackets = [
-                    {"limit": 158000, "rate": 0.15},
-                    {"limit": 380000, "rate": 0.20},
-                    {"limit": 800000, "rate": 0.27},
-                    {"limit": 1900000, "rate": 0.35},
-                    {"limit": 999999999, "rate": 0.40}
-                ]
-                return TaxSetting(
-                    year=2025,
-                    exemption_amount=47000.0,
-                    declaration_limit=330000.0,
-                    lump_sum_rate=0.15,
-                    withholding_rate=0.20,
-                    tax_brackets=json.dumps(brackets)
-                )
-            return None
+        return self.cache.get_or_load("tax_settings", lambda: self._load_settings(year), key=year)
+
+    def get_compiled_brackets(self, year: int) -> Optional["tax_engine.CompiledBrackets"]:
+        """Bracket table of `year` compiled for O(log n) lookups, cached until save_settings"""
+        def compile_brackets():
+            import tax_engine
+            settings = self.get_settings(year)
+            return tax_engine.CompiledBrackets.from_json(settings.tax_brackets) if settings else None
+        return self.cache.get_or_load("tax_settings", compile_brackets, key=("brackets", year))
+
+    def _load_settings(self, year: int) -> Optional[TaxSetting]:
+        settings = self.repo.get_tax_setting(year)
+        if settings:
+            return settings
+        # Fallback defaults for 2025 if not found
+        if year == 2025:
+            # Default Brackets for 2025 (Simple Example, should be updated)
+            # 0-158.000 -> 15%
+            # 158.000 - 380.000 -> 20%
+            # ... Simplified for planning
+            brackets = [
+                {"limit": 158000, "rate": 0.15},
+                {"limit": 380000, "rate": 0.20},
+                {"limit": 800000, "rate": 0.27},
+                {"limit": 1900000, "rate": 0.35},
+                {"limit": 999999999, "rate": 0.40}
+            ]
+            return TaxSetting(
+                year=2025,
+                exemption_amount=47000.0,
+                declaration_limit=330000.0,
+                lump_sum_rate=0.15,
+                withholding_rate=0.20,
+                tax_brackets=json.dumps(brackets)
+            )
+        return None
 
     def save_settings(self, s: TaxSetting):
-        query = """INSERT OR REPLACE INTO tax_settings (year, exemption_amount, declaration_limit, lump_sum_rate, withholding_rate, tax_brackets)
-                   VALUES (?, ?, ?, ?, ?, ?)"""
-        with self.db.get_connection() as conn:
-            conn.execute(query, (s.year, s.exemption_amount, s.declaration_limit, s.lump_sum_rate, s.withholding_rate, s.tax_brackets))
-            conn.commit()
+        with self.repo.transaction():
+            self.repo.save_tax_setting(s)
+            self.cache.invalidate("tax_settings")
 
 class DeclarationService(BaseService):
-    def save_declaration(self, d: Declaration):
-        query = """INSERT INTO declarations (taxpayer_id, year, name, expense_method, total_income, 
-                   exemption_applied, expense_amount, deductions_amount, tax_base, calculated_tax, 
-                   withholding_tax, net_tax_to_pay, status)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
-        params = (d.taxpayer_id, d.year, d.name, d.expense_method, d.total_income, d.exemption_applied,
-                  d.expense_amount, d.deductions_amount, d.tax_base, d.calculated_tax, d.withholding_tax,
-                  d.net_tax_to_pay, d.status)
-        with self.db.get_connection() as conn:
-            conn.execute(query, params)
-            conn.commit()
+    def save_declaration(self, d: Declaration) -> int:
+        with self.repo.transaction():
+            dec_id = self.repo.add_declaration(d)
+            self.cache.invalidate("declarations")
+        return dec_id
+
+    def save_declarations(self, declarations: List[Declaration], replace_drafts: bool = False) -> List[int]:
+        """Writes many declarations in one transaction, see Repository.add_declarations"""
+        with self.repo.transaction():
+            ids = self.repo.add_declarations(declarations, replace_drafts=replace_drafts)
+            self.cache.invalidate("declarations")
+        return ids
 
     def get_declarations(self, taxpayer_id: int, year: int) -> List[Declaration]:
-        with self.db.get_connection() as conn:
-            rows = conn.execute("SELECT * FROM declarations WHERE taxpayer_id=? AND year=?", (taxpayer_id, year)).fetchall()
-            return [Declaration(**dict(row)) for row in rows]
+        return self.repo.get_declarations(taxpayer_id, year)
 
     def delete_declaration(self, dec_id: int):
-        with self.db.get_connection() as conn:
-            conn.execute("DELETE FROM declarations WHERE id=?", (dec_id,))
-            conn.commit()
+        with self.repo.transaction():
+            self.repo.delete_declaration(dec_id)
+            self.cache.invalidate("declarations")
+
+    def prepare_declaration(self, taxpayer_id: int, year: int, method: str = "optimal", name: Optional[str] = None) -> Optional[Declaration]:
+        """Unsaved draft declaration of the taxpayer's year, claiming the special deductions recorded in the
+        database. `optimal` takes the cheapest legal scenario of optimize(), otherwise `method` must be legal
+        for the year. Returns None when the year has no taxable income or expenses."""
+        if method not in EXPENSE_METHODS + ("optimal",):
+            raise ValueError(f"Unknown expense method {method!r}")
+        deductions = self.get_special_deductions_from_db(taxpayer_id, year)
+        if method == "optimal":
+            result = self.optimize(taxpayer_id, year, deductions)["best"]
+            if result is None:
+                raise ValueError("No expense method is allowed for this year")
+        else:
+            blocked = self._blocked_methods(taxpayer_id, year)
+            if method in blocked:
+                raise ValueError(blocked[method])
+            result = self.calculate(taxpayer_id, year, method, deductions)
+        if not result["total_income"] and not result["total_general_expenses_actual"]:
+            return None
+        return Declaration(
+            id=None, taxpayer_id=taxpayer_id, year=year, name=name or f"Taslak {year}", expense_method=result["method"],
+            total_income=result["total_income"], exemption_applied=result["exemption_applied"],
+            expense_amount=result["expense_amount"], deductions_amount=result["deductions_amount"],
+            tax_base=result["tax_base"], calculated_tax=result["calculated_tax"],
+            withholding_tax=result["withholding_tax"], net_tax_to_pay=result["net_tax_to_pay"], status="draft")
     
     def calculate_tax_liability(self, tax_base: float, brackets: List[Dict]) -> Tuple[float, List[Dict]]:
         # Calculates progressive tax and returns (total_tax, breakdown)
-        tax = 0.0
-        previous_limit = 0.0
-        remaining_base = tax_base
-        breakdown = []
-
-        for b in brackets:
-            limit = b['limit']
-            rate = b['rate']
-            
-            taxable_in_bracket = min(remaining_base, limit - previous_limit)
-            if taxable_in_bracket <= 0:
-                break
-            
-            bracket_tax = taxable_in_bracket * rate
-            tax += bracket_tax
-            breakdown.append({
-                "rate": rate,
-                "base": taxable_in_bracket,
-                "tax": bracket_tax
-            })
-            
-            remaining_base -= taxable_in_bracket
-            previous_limit = limit
-            
-            if remaining_base <= 0:
-                break
-        
-        return tax, breakdown
+        import tax_engine
+        return tax_engine.CompiledBrackets(brackets).liability(tax_base)
+
+    @staticmethod
+    def _calculation_key(taxpayer_id: int, year: int, method: str, other_deductions: List[Dict]) -> Optional[Tuple]:
+        try:
+            key = (taxpayer_id, year, method, tuple(tuple(sorted(d.items())) for d in other_deductions))
+            hash(key)
+        except (AttributeError, TypeError):
+            return None  # Not a list of flat dicts, calculated without the cache
+        return key
+
+    def get_cached_calculation(self, taxpayer_id: int, year: int, method: str, other_deductions: List[Dict]) -> Optional[Dict]:
+        """The cached `calculate` result if it is still current, None otherwise. Loads no data, it only checks
+        the stored data versions (PRAGMA data_version, plus a primary key read after a write)"""
+        cache = self.cache.calculations
+        key = self._calculation_key(taxpayer_id, year, method, other_deductions)
+        if key is None or cache.max_bytes <= 0:
+            return None
+        return cache.get(key, cache.stamp(taxpayer_id, year), count_miss=False)
 
     def calculate(self, taxpayer_id: int, year: int, method: str, other_deductions: List[Dict]) -> Dict:
+        """Results are cached by arguments until the transactions of (taxpayer_id, year) or the sources,
+        tax items, tax settings or taxpayers change (CalculationCache)"""
+        cache = self.cache.calculations
+        key = self._calculation_key(taxpayer_id, year, method, other_deductions)
+        if key is None or cache.max_bytes <= 0:
+            return self._calculate(taxpayer_id, year, method, other_deductions)
+        stamp = cache.stamp(taxpayer_id, year)
+        result = cache.get(key, stamp)
+        if result is None:
+            result = self._calculate(taxpayer_id, year, method, other_deductions)
+            cache.put(key, stamp, result)
+        return result
+
+    def _calculate(self, taxpayer_id: int, year: int, method: str, other_deductions: List[Dict]) -> Dict:
+        with self.repo.timed("declaration.load_inputs"):
+            inputs = self._load_calculation_inputs(taxpayer_id, year)
+        with self.repo.timed("declaration.compute"):
+            return self._calculate_from_inputs(inputs, method, other_deductions)
+
+    def _load_calculation_inputs(self, taxpayer_id: int, year: int) -> Dict:
+        # Steps 1-3 and the expense totals of step 5: everything that depends on the database
+        # but not on the chosen method or deductions, so scenarios can share one load.
         # 1. Get Settings
-        ts_service = TaxSettingService(self.db)
+        ts_service = TaxSettingService(self.repo)
         settings = ts_service.get_settings(year)
         if not settings:
             raise ValueError(f"Tax settings for {year} not found")
 
         # 2. Get Transactions
-        tx_service = TransactionService(self.db)
-        src_service = SourceService(self.db)
-        # Fetch all income and expenses for this taxpayer/year
+        src_service = SourceService(self.repo)
+        # Income and expense sums per source and tax item for this taxpayer/year, read from the rollup
         # IMPORTANT: Only include IS_TAXABLE=True transactions
-        transactions = tx_service.get_transactions(year=year, taxpayer_id=taxpayer_id, is_taxable=True)
+        transactions = self.repo.get_taxable_totals([year], [taxpayer_id])
         
         # 3. Income Calculation (Gross Up)
         total_income = 0.0
@@ -483,21 +2259,6 @@ class DeclarationService(BaseService):
                 total_income += amount
                 total_mesken_income += amount # is_net = 0 -> Mesken
 
-        # 4. Exemption
-        exemption = settings.exemption_amount
-        
-        # New Rule: If Total Income > Exemption Limit (1.2M for 2025), NO exemption.
-        # This applies regardless of expense method.
-        if settings.exemption_limit > 0 and total_income > settings.exemption_limit:
-            exemption = 0.0
-
-        # Apply exemption to mesken income (exemption cannot exceed mesken income technically)
-        exemption = min(exemption, total_mesken_income)
-        mesken_income_after_exemption = max(0, total_mesken_income - exemption)
-        isyeri_income_after_exemption = total_isyeri_income
-        
-        taxable_income_after_exemption = mesken_income_after_exemption + isyeri_income_after_exemption
-        
         # 5. Safi Irat (Expense Deduction)
         total_general_expenses = 0.0
         total_mesken_expense = 0.0
@@ -521,8 +2282,49 @@ class DeclarationService(BaseService):
                     else:
                         total_mesken_expense += t['amount']
                         
-        actual_expenses_breakdown = [{"code": k[0], "name": k[1], "amount": v} for k, v in actual_expenses_breakdown_dict.items()]
+        # Ordered by tax item code like calculate_batch, not by the order the rollup groups are read in
+        actual_expenses_breakdown = [{"code": k[0], "name": k[1], "amount": v} for k, v in sorted(actual_expenses_breakdown_dict.items())]
+
+        return {
+            "settings": settings,
+            "brackets": ts_service.get_compiled_brackets(year),
+            "total_income": total_income,
+            "total_withholding": total_withholding,
+            "total_mesken_income": total_mesken_income,
+            "total_isyeri_income": total_isyeri_income,
+            "total_general_expenses": total_general_expenses,
+            "total_mesken_expense": total_mesken_expense,
+            "total_isyeri_expense": total_isyeri_expense,
+            "actual_expenses_breakdown": actual_expenses_breakdown,
+        }
+
+    def _calculate_from_inputs(self, inputs: Dict, method: str, other_deductions: List[Dict]) -> Dict:
+        # Steps 4-7, pure computation over the loaded inputs
+        settings = inputs["settings"]
+        total_income = inputs["total_income"]
+        total_withholding = inputs["total_withholding"]
+        total_mesken_income = inputs["total_mesken_income"]
+        total_isyeri_income = inputs["total_isyeri_income"]
+        total_general_expenses = inputs["total_general_expenses"]
+        total_mesken_expense = inputs["total_mesken_expense"]
+        total_isyeri_expense = inputs["total_isyeri_expense"]
+        actual_expenses_breakdown = [dict(item) for item in inputs["actual_expenses_breakdown"]]
+
+        # 4. Exemption
+        exemption = settings.exemption_amount
+        
+        # New Rule: If Total Income > Exemption Limit (1.2M for 2025), NO exemption.
+        # This applies regardless of expense method.
+        if settings.exemption_limit > 0 and total_income > settings.exemption_limit:
+            exemption = 0.0
 
+        # Apply exemption to mesken income (exemption cannot exceed mesken income technically)
+        exemption = min(exemption, total_mesken_income)
+        mesken_income_after_exemption = max(0, total_mesken_income - exemption)
+        isyeri_income_after_exemption = total_isyeri_income
+        
+        taxable_income_after_exemption = mesken_income_after_exemption + isyeri_income_after_exemption
+        
         deductible_expense = 0.0
         expense_ratio = 1.0
 
@@ -556,9 +2358,7 @@ class DeclarationService(BaseService):
         if matrah < 0: matrah = 0
 
         # 7. Tax Calculation
-        import json
-        brackets = json.loads(settings.tax_brackets)
-        calculated_tax, tax_breakdown = self.calculate_tax_liability(matrah, brackets)
+        calculated_tax, tax_breakdown = inputs["brackets"].liability(matrah)
         
         net_tax_to_pay = calculated_tax - total_withholding
 
@@ -586,16 +2386,187 @@ class DeclarationService(BaseService):
             "deductions_amount": allowed_special_deduction
         }
 
+    def calculate_batch(self, jobs: List[Tuple]) -> List[Dict]:
+        """Vectorized `calculate` for many (taxpayer_id, year, method[, other_deductions]) jobs.
+
+        All taxable transactions of the requested years are aggregated in one query and the tax steps
+        run as NumPy array operations. Results have the same keys as `calculate` plus taxpayer_id and
+        year; actual_expenses_breakdown is ordered by tax item code.
+        """
+        import numpy as np
+        import tax_engine
+        if not jobs:
+            return []
+        years = sorted({job[1] for job in jobs})
+        ts_service = TaxSettingService(self.repo)
+        settings = {y: ts_service.get_settings(y) for y in years}
+        missing = [str(y) for y, st in settings.items() if not st]
+        if missing:
+            raise ValueError(f"Tax settings for {', '.join(missing)} not found")
+        sources_map = {s.id: s for s in SourceService(self.repo).get_all()}
+
+        # One grouped pass over the taxable rollup groups of all requested years
+        taxpayer_ids = sorted({job[0] for job in jobs})
+
+        # (taxpayer_id, year) -> [mesken income, işyeri net income, mesken expense, işyeri expense]
+        totals: Dict[Tuple[int, int], List[float]] = {}
+        breakdowns: Dict[Tuple[int, int], Dict[Tuple[str, str], float]] = {}
+        for row in self.repo.get_taxable_totals(years, taxpayer_ids):
+            src = sources_map.get(row['source_id'])
+            if not src:
+                continue
+            key = (row['taxpayer_id'], row['year'])
+            acc = totals.setdefault(key, [0.0, 0.0, 0.0, 0.0])
+            if row['type'] == TransactionType.INCOME:
+                acc[1 if src.is_net == 1 else 0] += row['amount']
+            elif row['type'] == TransactionType.EXPENSE and src.deduction_type == 0:
+                acc[3 if src.is_net == 1 else 2] += row['amount']
+                item = (row['tax_item_code'] or 'DİĞER', row['tax_item_name'] or 'Diğer Giderler')
+                items = breakdowns.setdefault(key, {})
+                items[item] = items.get(item, 0.0) + row['amount']
+
+        n = len(jobs)
+        inputs = np.zeros((4, n))
+        special = np.zeros(n)
+        for i, job in enumerate(jobs):
+            inputs[:, i] = totals.get((job[0], job[1]), (0.0, 0.0, 0.0, 0.0))
+            if len(job) > 3 and job[3]:
+                special[i] = sum(d['amount'] for d in job[3])
+        methods = np.array([job[2] for job in jobs])
+        job_years = np.array([job[1] for job in jobs])
+
+        def per_year(attr):
+            return np.array([getattr(settings[y], attr) for y in job_years], dtype=float)
+
+        r = tax_engine.calculate_matrah(
+            inputs[0], inputs[1], inputs[2], inputs[3], special,
+            methods == 'lump_sum', methods == 'actual',
+            per_year('withholding_rate'), per_year('exemption_amount'),
+            per_year('exemption_limit'), per_year('lump_sum_rate'))
+
+        # 7. Progressive tax, one bracket table per year
+        tax = np.zeros(n)
+        tax_breakdowns: List[List[Dict]] = [[] for _ in range(n)]
+        for y in years:
+            compiled = ts_service.get_compiled_brackets(y)
+            idx = np.nonzero(job_years == y)[0]
+            year_tax, bases, taxes = compiled.evaluate(r["matrah"][idx])
+            tax[idx] = year_tax
+            for j, i in enumerate(idx):
+                tax_breakdowns[i] = [{"rate": b['rate'], "base": float(bases[j, k]), "tax": float(taxes[j, k])}
+                                     for k, b in enumerate(compiled.brackets) if bases[j, k] > 0]
+        net_tax = tax - r["withholding_tax"]
+
+        results = []
+        for i, job in enumerate(jobs):
+            result = {k: float(v[i]) for k, v in r.items()}
+            items = breakdowns.get((job[0], job[1]), {})
+            result.update({
+                "taxpayer_id": job[0],
+                "year": job[1],
+                "method": job[2],
+                "calculated_tax": float(tax[i]),
+                "tax_breakdown": tax_breakdowns[i],
+                "actual_expenses_breakdown": [{"code": k[0], "name": k[1], "amount": v} for k, v in sorted(items.items())],
+                "net_tax_to_pay": float(net_tax[i]),
+                "expense_amount": result["deductible_expense"],
+                "expense_method": job[2],
+                "tax_base": result["matrah"],
+                "deductions_amount": result["allowed_special_deduction"],
+            })
+            results.append(result)
+        return results
+
+    def optimize(self, taxpayer_id: int, year: int, other_deductions: Optional[List[Dict]] = None) -> Dict:
+        """Evaluates every expense method and special deduction combination from a single data load.
+
+        Returns all scenarios side by side and the cheapest legal one (lowest net_tax_to_pay).
+        """
+        if other_deductions is None:
+            other_deductions = self.get_special_deductions_from_db(taxpayer_id, year)
+        inputs = self._load_calculation_inputs(taxpayer_id, year)
+        blocked = self._blocked_methods(taxpayer_id, year)
+
+        # Every subset while the count is small, otherwise just none vs all
+        if len(other_deductions) <= OPTIMIZER_MAX_DEDUCTION_SUBSETS:
+            subsets = [list(c) for r in range(len(other_deductions) + 1)
+                       for c in itertools.combinations(other_deductions, r)]
+        else:
+            subsets = [[], list(other_deductions)]
+
+        scenarios = []
+        for method in EXPENSE_METHODS:
+            for deductions in subsets:
+                result = self._calculate_from_inputs(inputs, method, deductions)
+                result["deductions_used"] = [d.get('name') for d in deductions]
+                result["legal"] = method not in blocked
+                result["reason"] = blocked.get(method)
+                scenarios.append(result)
+
+        legal = [s for s in scenarios if s["legal"]]
+        # Ties go to the scenario that claims fewer deductions
+        best = min(legal, key=lambda s: (round(s["net_tax_to_pay"], 2), len(s["deductions_used"]))) if legal else None
+        return {
+            "taxpayer_id": taxpayer_id,
+            "year": year,
+            "scenarios": scenarios,
+            "best": best,
+        }
+
+    def _blocked_methods(self, taxpayer_id: int, year: int) -> Dict[str, str]:
+        # GVK md. 74: after choosing actual expenses, lump sum is not allowed for two years
+        locked_by = self.repo.get_last_final_actual_year(taxpayer_id, year - ACTUAL_METHOD_LOCK_YEARS, year - 1)
+        if locked_by is not None:
+            return {"lump_sum": f"Actual expense method was chosen for {locked_by}, lump sum is not allowed for two years"}
+        return {}
+
     def get_special_deductions_from_db(self, taxpayer_id: int, year: int) -> List[Dict]:
         """Fetches transactions that are marked as Special Deduction (deduction_type=1)"""
-        # We need to join transactions with sources to check deduction_type
-        query = """
-            SELECT s.name, SUM(t.amount) as amount 
-            FROM transactions t
-            JOIN sources s ON t.source_id = s.id
-            WHERE t.taxpayer_id = ? AND t.year = ? AND t.type = -1 AND s.deduction_type = 1
-            GROUP BY s.name
-        """
-        with self.db.get_connection() as conn:
-            rows = conn.execute(query, (taxpayer_id, year)).fetchall()
-            return [{"name": row['name'], "amount": row['amount']} for row in rows]
+        return self.repo.get_special_deductions(taxpayer_id, year)
+
+
+class ServiceContainer:
+    """Database and services of the API, each built on first use.
+
+    Importing api.py constructs nothing; the first request (or the startup hook) builds the
+    Database, and each service is created when an endpoint first asks for it. Construction
+    times are kept in `init_ms` for GET /stats/startup."""
+
+    def __init__(self, db_factory: Callable[[], Database] = Database):
+        self._db_factory = db_factory
+        self._db = None
+        self._services = {}
+        self._lock = threading.Lock()
+        self.init_ms: Dict[str, float] = {}
+
+    @property
+    def db(self) -> Database:
+        if self._db is None:
+            with self._lock:
+                if self._db is None:
+                    started = time.perf_counter()
+                    self._db = self._db_factory()
+                    self.init_ms["Database"] = round((time.perf_counter() - started) * 1000, 3)
+        return self._db
+
+    def get(self, service_cls):
+        service = self._services.get(service_cls)
+        if service is None:
+            db = self.db
+            with self._lock:
+                service = self._services.get(service_cls)
+                if service is None:
+                    started = time.perf_counter()
+                    service = self._services[service_cls] = service_cls(db)
+                    self.init_ms[service_cls.__name__] = round((time.perf_counter() - started) * 1000, 3)
+        return service
+
+    def use(self, db: Database):
+        """Points the container at `db`, e.g. a benchmark database; services are rebuilt on next use"""
+        with self._lock:
+            self._db = db
+            self._services = {}
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
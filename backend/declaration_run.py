@@ -0,0 +1,237 @@
+"""Draft declarations for many taxpayers at once, for the filing season.
+
+The taxpayers are split into chunks that a process pool prepares in parallel with
+DeclarationService.prepare_declaration. Every worker process opens its own read-only connection
+to the database file. The parent process collects the drafts and writes them in one transaction
+(DeclarationService.save_declarations), replacing the drafts of the same name an earlier run left.
+The API starts runs as background jobs (POST /declarations/runs) and reports their progress and
+per-taxpayer errors (GET /declarations/runs/{job_id}). From the command line:
+
+    python declaration_run.py --year 2025                     # cheapest legal method per taxpayer
+    python declaration_run.py personal_finance.db --year 2025 --method actual --workers 4
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Tuple
+
+from core import (DB_NAME, DECLARATION_RUN_WORKERS, EXPENSE_METHODS, Database, Declaration, DeclarationService,
+                  TaxpayerService, TaxSettingService)
+
+RUN_METHODS = EXPENSE_METHODS + ("optimal",)
+# Chunks per worker: enough to balance the load and report progress, few enough to keep pickling cheap
+CHUNKS_PER_WORKER = 4
+MAX_CHUNK_SIZE = 500
+# Finished runs GET /declarations/runs still lists
+KEEP_FINISHED_RUNS = 20
+ACTIVE_STATES = ("queued", "running", "saving")
+
+
+class DeclarationRun:
+    """Parameters and progress of one run. Results are recorded per chunk, `status()` is safe to call
+    from other threads while the run is in progress."""
+
+    def __init__(self, year: int, method: str = "optimal", name: Optional[str] = None,
+                 taxpayer_ids: Optional[List[int]] = None, workers: int = 0):
+        if method not in RUN_METHODS:
+            raise ValueError(f"Unknown expense method {method!r}, expected one of {', '.join(RUN_METHODS)}")
+        self.id = uuid.uuid4().hex
+        self.year = year
+        self.method = method
+        self.name = name or f"Toplu taslak {year}"
+        self.taxpayer_ids = taxpayer_ids
+        self.workers = max(1, workers or DECLARATION_RUN_WORKERS or os.cpu_count() or 1)
+        self.state = "queued"
+        self.total = 0
+        self.done = 0
+        self.prepared = 0
+        self.skipped = 0
+        self.saved = 0
+        self.errors: List[Dict] = []
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def start(self, total: int):
+        with self._lock:
+            self.state, self.total, self.started_at = "running", total, time.time()
+
+    def record(self, results: List[Tuple]) -> List[Declaration]:
+        """Counts one chunk's (taxpayer_id, draft, error) results and returns its drafts"""
+        drafts = [draft for _, draft, error in results if draft is not None and error is None]
+        with self._lock:
+            self.done += len(results)
+            self.prepared += len(drafts)
+            for taxpayer_id, draft, error in results:
+                if error is not None:
+                    self.errors.append({"taxpayer_id": taxpayer_id, "error": error})
+                elif draft is None:
+                    self.skipped += 1
+        return drafts
+
+    def saving(self):
+        with self._lock:
+            self.state = "saving"
+
+    def finish(self, saved: int = 0, error: Optional[str] = None):
+        with self._lock:
+            self.state = "failed" if error else "done"
+            self.saved, self.error, self.finished_at = saved, error, time.time()
+
+    def status(self) -> Dict:
+        with self._lock:
+            elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+            return {
+                "id": self.id, "year": self.year, "method": self.method, "name": self.name, "workers": self.workers,
+                "state": self.state, "total": self.total, "done": self.done, "prepared": self.prepared,
+                "skipped": self.skipped, "failed": len(self.errors), "saved": self.saved,
+                "elapsed_seconds": round(elapsed, 3), "per_second": round(self.done / elapsed, 1) if elapsed else 0.0,
+                "error": self.error, "errors": list(self.errors),
+            }
+
+
+def prepare_chunk(service: DeclarationService, taxpayer_ids: List[int], year: int, method: str,
+                  name: str) -> List[Tuple[int, Optional[Declaration], Optional[str]]]:
+    """(taxpayer_id, draft or None, error or None) per taxpayer; one taxpayer's error does not stop the others"""
+    results = []
+    for taxpayer_id in taxpayer_ids:
+        try:
+            results.append((taxpayer_id, service.prepare_declaration(taxpayer_id, year, method, name), None))
+        except ValueError as e:
+            results.append((taxpayer_id, None, str(e)))
+        except Exception as e:
+            results.append((taxpayer_id, None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+# The worker process's own service, set up once by the pool initializer
+_worker_service: Optional[DeclarationService] = None
+
+
+def _start_worker(db_name: str, archive_dir: str):
+    global _worker_service
+    # Workers only read, so one connection per pool is enough; drafts are written by the parent
+    db = Database(db_name, pool_size=1, reader_pool_size=1, max_concurrency=1, archive_dir=archive_dir)
+    _worker_service = DeclarationService(db)
+
+
+def _prepare_chunk_in_worker(taxpayer_ids: List[int], year: int, method: str, name: str):
+    return prepare_chunk(_worker_service, taxpayer_ids, year, method, name)
+
+
+def check_run(db: Database, run: DeclarationRun):
+    """Errors that would fail every taxpayer of the run, raised before it starts"""
+    if not TaxSettingService(db).get_settings(run.year):
+        raise ValueError(f"Tax settings for {run.year} not found")
+    if run.workers > 1 and db.db_name == ":memory:":
+        raise ValueError("Worker processes need a database file, use workers=1 for an in-memory database")
+
+
+def run_declarations(db: Database, run: DeclarationRun,
+                     on_progress: Optional[Callable[[DeclarationRun], None]] = None) -> DeclarationRun:
+    """Prepares the drafts of `run` (in a process pool when run.workers > 1) and saves them in one transaction.
+    Failures of the whole run are recorded in run.error rather than raised."""
+    service = DeclarationService(db)
+    try:
+        check_run(db, run)
+        taxpayer_ids = run.taxpayer_ids or [t.id for t in TaxpayerService(db).get_all()]
+        run.start(len(taxpayer_ids))
+        size = max(1, min(MAX_CHUNK_SIZE, -(-len(taxpayer_ids) // (run.workers * CHUNKS_PER_WORKER))))
+        chunks = [taxpayer_ids[i:i + size] for i in range(0, len(taxpayer_ids), size)]
+        drafts: List[Declaration] = []
+        if run.workers == 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                drafts += run.record(prepare_chunk(service, chunk, run.year, run.method, run.name))
+                if on_progress:
+                    on_progress(run)
+        else:
+            # spawn rather than fork: the parent may hold open connections and running threads (the API)
+            with ProcessPoolExecutor(max_workers=min(run.workers, len(chunks)), mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_start_worker, initargs=(os.path.abspath(db.db_name), db.archive_dir)) as pool:
+                futures = [pool.submit(_prepare_chunk_in_worker, chunk, run.year, run.method, run.name) for chunk in chunks]
+                for future in as_completed(futures):
+                    drafts += run.record(future.result())
+                    if on_progress:
+                        on_progress(run)
+        run.saving()
+        # Taxpayer order, whichever chunk finished first
+        drafts.sort(key=lambda d: d.taxpayer_id)
+        run.finish(saved=len(service.save_declarations(drafts, replace_drafts=True)))
+    except Exception as e:
+        run.finish(error=str(e) if isinstance(e, ValueError) else f"{type(e).__name__}: {e}")
+    return run
+
+
+class DeclarationJobs:
+    """Background declaration runs of the API. One run at a time, each on its own thread."""
+
+    def __init__(self):
+        self._runs: Dict[str, DeclarationRun] = {}
+        self._lock = threading.Lock()
+
+    def start(self, db: Database, run: DeclarationRun) -> DeclarationRun:
+        check_run(db, run)
+        with self._lock:
+            if any(r.state in ACTIVE_STATES for r in self._runs.values()):
+                raise ValueError("Another declaration run is in progress")
+            finished = [r.id for r in self._runs.values() if r.state not in ACTIVE_STATES]
+            for run_id in finished[:max(0, len(finished) - KEEP_FINISHED_RUNS + 1)]:
+                del self._runs[run_id]
+            self._runs[run.id] = run
+        threading.Thread(target=run_declarations, args=(db, run), name=f"declaration-run-{run.id[:8]}", daemon=True).start()
+        return run
+
+    def get(self, run_id: str) -> Optional[DeclarationRun]:
+        return self._runs.get(run_id)
+
+    def all(self) -> List[DeclarationRun]:
+        with self._lock:
+            return list(self._runs.values())
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("db", nargs="?", default=DB_NAME)
+    parser.add_argument("--year", type=int, required=True)
+    parser.add_argument("--method", choices=RUN_METHODS, default="optimal",
+                        help="Expense method; optimal picks the cheapest legal one per taxpayer")
+    parser.add_argument("--name", help="Draft name, drafts of the same name from an earlier run are replaced")
+    parser.add_argument("--taxpayer", type=int, action="append", dest="taxpayer_ids", help="Only this taxpayer (repeatable)")
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes (default DECLARATION_RUN_WORKERS or one per CPU)")
+    args = parser.parse_args(argv[1:])
+
+    db = Database(args.db)
+    db.init_db()
+    try:
+        run = DeclarationRun(args.year, args.method, args.name, args.taxpayer_ids, args.workers)
+
+        def progress(r: DeclarationRun):
+            print(f"\r{r.done}/{r.total} taxpayers", end="", file=sys.stderr, flush=True)
+
+        run_declarations(db, run, on_progress=progress)
+        print(file=sys.stderr)
+        status = run.status()
+        for failure in status["errors"]:
+            print(f"ERROR taxpayer {failure['taxpayer_id']}: {failure['error']}")
+        if status["error"]:
+            print(f"FAILED {status['error']}")
+            return 1
+        print(f"{status['saved']} drafts '{status['name']}' saved for {status['year']}, {status['skipped']} taxpayers without "
+              f"data, {status['failed']} failed; {status['per_second']} taxpayers/s with {status['workers']} workers")
+        return 1 if status["errors"] else 0
+    except ValueError as e:
+        print(f"ERROR {e}")
+        return 1
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
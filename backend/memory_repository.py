@@ -0,0 +1,437 @@
+"""Repository kept entirely in Python structures, without SQLite.
+
+Useful to benchmark the calculations without disk I/O and as the reference for new backends:
+check_repositories.py runs the same scenario through the services on SqliteRepository and on
+MemoryRepository and compares the results. Transactions are indexed by (taxpayer_id, year) and
+aggregated into an incremental rollup with the same keys as transaction_rollup, so totals and
+declaration inputs cost O(#groups) like they do in SQLite.
+
+    repo = MemoryRepository.from_database(Database("personal_finance.db"))
+    DeclarationService(repo).calculate(1, 2024, "lump_sum", [])
+"""
+import sqlite3
+import threading
+from dataclasses import fields, replace
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from core import (Database, Declaration, Document, PaymentMethod, ReferenceCache, Repository, Source, TaxItem,
+                  TaxSetting, Taxpayer, Transaction, TransactionType)
+
+# Columns of the transactions table, in table order, as returned by `SELECT t.*`
+TRANSACTION_COLUMNS = ("id", "taxpayer_id", "transaction_date", "year", "month", "day", "type", "source_id",
+                       "payment_method_id", "document_id", "description", "amount", "is_taxable", "tax_items_id",
+                       "gdrive_id")
+# NOT NULL columns of the transactions table, checked in table order like SQLite does
+TRANSACTION_REQUIRED = ("transaction_date", "source_id", "amount", "tax_items_id")
+TRANSACTION_FIELDS = tuple(f.name for f in fields(Transaction))
+
+
+def _timestamp() -> str:
+    # Same format as SQLite's CURRENT_TIMESTAMP
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _matches(row: Dict, year=None, taxpayer_id=None, transaction_type=None, month=None, source_id=None,
+             is_taxable=None, tax_items_id=None) -> bool:
+    """Python counterpart of core._transaction_filters for a transaction or rollup row"""
+    if year and row["year"] != year:
+        return False
+    if month and row["month"] != month:
+        return False
+    if taxpayer_id and row["taxpayer_id"] != taxpayer_id:
+        return False
+    if transaction_type and row["type"] != transaction_type:
+        return False
+    if source_id:
+        if isinstance(source_id, list):
+            if row["source_id"] not in source_id:
+                return False
+        elif row["source_id"] != source_id:
+            return False
+    if is_taxable is not None and row["is_taxable"] != (1 if is_taxable else 0):
+        return False
+    if tax_items_id and row["tax_items_id"] != tax_items_id:
+        return False
+    return True
+
+
+class MemoryRepository(Repository):
+    """Repository over dicts keyed by id. Ids follow the SQLite tables: AUTOINCREMENT tables never reuse an id,
+    sources and payment methods continue from the current maximum."""
+
+    def __init__(self):
+        self.cache = ReferenceCache()
+        self._lock = threading.RLock()
+        self._taxpayers: Dict[int, Taxpayer] = {}
+        self._sources: Dict[int, Source] = {}
+        self._payment_methods: Dict[int, PaymentMethod] = {}
+        self._tax_items: Dict[int, TaxItem] = {}
+        self._documents: Dict[int, Document] = {}
+        self._tax_settings: Dict[int, TaxSetting] = {}
+        self._declarations: Dict[int, Declaration] = {}
+        self._transactions: Dict[int, Dict] = {}
+        # (taxpayer_id, year) -> ids of its transactions
+        self._by_taxpayer_year: Dict[Tuple, set] = {}
+        # (taxpayer_id, year) -> {(month, source_id, tax_items_id, type, is_taxable): [amount, count]}
+        self._rollup: Dict[Tuple, Dict[Tuple, List]] = {}
+        # Last id handed out per AUTOINCREMENT table
+        self._sequences: Dict[str, int] = {}
+
+    @classmethod
+    def from_database(cls, db: Database) -> "MemoryRepository":
+        """Copies every table of a SQLite database, keeping the ids"""
+        repo = cls()
+        with db.get_connection(readonly=True) as conn:
+            def rows(table: str):
+                return [dict(row) for row in conn.execute(f"SELECT * FROM {table} ORDER BY 1")]
+            repo._taxpayers = {r["id"]: Taxpayer(**r) for r in rows("taxpayers")}
+            repo._sources = {r["id"]: Source(**r) for r in rows("sources")}
+            repo._payment_methods = {r["id"]: PaymentMethod(**r) for r in rows("payment_methods")}
+            repo._tax_items = {r["id"]: TaxItem(**r) for r in rows("tax_items")}
+            repo._documents = {r["id"]: Document(**{k: v for k, v in r.items() if k in Document.__annotations__})
+                               for r in rows("documents")}
+            repo._tax_settings = {r["year"]: TaxSetting(**r) for r in rows("tax_settings")}
+            repo._declarations = {r["id"]: Declaration(**r) for r in rows("declarations")}
+            for r in conn.execute(f"SELECT {', '.join(TRANSACTION_COLUMNS)} FROM transactions ORDER BY id"):
+                repo._store_transaction(dict(r))
+            repo._sequences = {r["name"]: r["seq"] for r in rows("sqlite_sequence")}
+        return repo
+
+    def _next_id(self, table: str, existing: Dict, autoincrement: bool = True) -> int:
+        if not autoincrement:
+            return max(existing, default=0) + 1
+        next_id = max(self._sequences.get(table, 0), max(existing, default=0)) + 1
+        self._sequences[table] = next_id
+        return next_id
+
+    # Reference data
+    def get_taxpayers(self) -> List[Taxpayer]:
+        with self._lock:
+            return [replace(t) for _, t in sorted(self._taxpayers.items())]
+
+    def add_taxpayer(self, t: Taxpayer) -> int:
+        with self._lock:
+            t_id = self._next_id("taxpayers", self._taxpayers)
+            self._taxpayers[t_id] = replace(t, id=t_id)
+            return t_id
+
+    def update_taxpayer(self, t: Taxpayer):
+        with self._lock:
+            if t.id in self._taxpayers:
+                self._taxpayers[t.id] = replace(t)
+
+    def delete_taxpayer(self, t_id: int):
+        with self._lock:
+            self._taxpayers.pop(t_id, None)
+
+    def get_sources(self) -> List[Source]:
+        with self._lock:
+            return [replace(s) for _, s in sorted(self._sources.items())]
+
+    def get_source(self, source_id: int) -> Optional[Source]:
+        with self._lock:
+            s = self._sources.get(source_id)
+            return replace(s) if s else None
+
+    def add_source(self, s: Source) -> int:
+        with self._lock:
+            s_id = self._next_id("sources", self._sources, autoincrement=False)
+            self._sources[s_id] = replace(s, id=s_id)
+            return s_id
+
+    def update_source(self, s: Source):
+        with self._lock:
+            if s.id in self._sources:
+                self._sources[s.id] = replace(s)
+
+    def delete_source(self, s_id: int):
+        with self._lock:
+            self._sources.pop(s_id, None)
+
+    def get_payment_methods(self) -> List[PaymentMethod]:
+        with self._lock:
+            return [replace(pm) for _, pm in sorted(self._payment_methods.items())]
+
+    def add_payment_method(self, pm: PaymentMethod) -> int:
+        with self._lock:
+            pm_id = self._next_id("payment_methods", self._payment_methods, autoincrement=False)
+            self._payment_methods[pm_id] = replace(pm, id=pm_id)
+            return pm_id
+
+    def update_payment_method(self, pm: PaymentMethod):
+        with self._lock:
+            if pm.id in self._payment_methods:
+                self._payment_methods[pm.id] = replace(pm)
+
+    def delete_payment_method(self, pm_id: int):
+        with self._lock:
+            self._payment_methods.pop(pm_id, None)
+
+    def get_tax_items(self) -> List[TaxItem]:
+        with self._lock:
+            return [replace(ti) for ti in sorted(self._tax_items.values(), key=lambda ti: (ti.code, ti.id))]
+
+    def add_tax_item(self, ti: TaxItem) -> int:
+        with self._lock:
+            ti_id = self._next_id("tax_items", self._tax_items)
+            self._tax_items[ti_id] = replace(ti, id=ti_id)
+            return ti_id
+
+    def update_tax_item(self, ti: TaxItem):
+        with self._lock:
+            if ti.id in self._tax_items:
+                self._tax_items[ti.id] = replace(ti)
+
+    def delete_tax_item(self, ti_id: int):
+        with self._lock:
+            self._tax_items.pop(ti_id, None)
+
+    def get_documents(self) -> List[Document]:
+        with self._lock:
+            return [replace(d) for _, d in sorted(self._documents.items())]
+
+    def add_document(self, d: Document) -> int:
+        with self._lock:
+            doc_id = self._next_id("documents", self._documents)
+            self._documents[doc_id] = replace(d, id=doc_id, created_at=_timestamp())
+            return doc_id
+
+    # Transactions
+    @staticmethod
+    def _row(t: Transaction, t_id: int) -> Dict:
+        """The stored form of `t`: the values SQLite would read back for its columns"""
+        for column in TRANSACTION_REQUIRED:
+            if getattr(t, column) is None:
+                raise sqlite3.IntegrityError(f"NOT NULL constraint failed: transactions.{column}")
+        row = {column: getattr(t, column, None) for column in TRANSACTION_COLUMNS}
+        row["id"] = t_id
+        row["transaction_date"] = str(t.transaction_date)
+        row["amount"] = float(t.amount)
+        row["is_taxable"] = None if t.is_taxable is None else (1 if t.is_taxable else 0)
+        return row
+
+    @staticmethod
+    def _rollup_key(row: Dict) -> Tuple[Tuple, Tuple]:
+        # Same normalization as ROLLUP_SELECT, split into the index key and the rest
+        return ((row["taxpayer_id"] or 0, row["year"] or 0),
+                (row["month"] or 0, row["source_id"], row["tax_items_id"], row["type"] or 0, row["is_taxable"] or 0))
+
+    def _store_transaction(self, row: Dict):
+        self._transactions[row["id"]] = row
+        self._by_taxpayer_year.setdefault((row["taxpayer_id"], row["year"]), set()).add(row["id"])
+        outer, inner = self._rollup_key(row)
+        acc = self._rollup.setdefault(outer, {}).setdefault(inner, [0.0, 0])
+        acc[0] += row["amount"]
+        acc[1] += 1
+
+    def _remove_transaction(self, t_id: int) -> Optional[Dict]:
+        row = self._transactions.pop(t_id, None)
+        if row is None:
+            return None
+        index_key = (row["taxpayer_id"], row["year"])
+        ids = self._by_taxpayer_year[index_key]
+        ids.discard(t_id)
+        if not ids:
+            del self._by_taxpayer_year[index_key]
+        outer, inner = self._rollup_key(row)
+        groups = self._rollup[outer]
+        acc = groups[inner]
+        acc[0] -= row["amount"]
+        acc[1] -= 1
+        # Emptied groups are dropped like ROLLUP_PRUNE does
+        if acc[1] <= 0:
+            del groups[inner]
+            if not groups:
+                del self._rollup[outer]
+        return row
+
+    def add_transaction(self, t: Transaction) -> int:
+        with self._lock:
+            row = self._row(t, max(self._sequences.get("transactions", 0), max(self._transactions, default=0)) + 1)
+            self._sequences["transactions"] = row["id"]
+            self._store_transaction(row)
+            return row["id"]
+
+    def add_transactions(self, transactions: List[Transaction], chunk_size: int = 5000, atomic: bool = False) -> Tuple[int, List[Dict]]:
+        # `chunk_size` only matters for SQLite; rows are validated first so atomic imports never half-apply
+        with self._lock:
+            next_id = max(self._sequences.get("transactions", 0), max(self._transactions, default=0)) + 1
+            rows = []
+            errors = []
+            for index, t in enumerate(transactions):
+                try:
+                    rows.append(self._row(t, next_id + len(rows)))
+                except sqlite3.IntegrityError as e:
+                    errors.append({"index": index, "error": str(e)})
+            if atomic and errors:
+                return 0, errors
+            for row in rows:
+                self._store_transaction(row)
+            if rows:
+                self._sequences["transactions"] = rows[-1]["id"]
+            return len(rows), errors
+
+    def update_transaction(self, t: Transaction):
+        with self._lock:
+            if t.id not in self._transactions:
+                return
+            row = self._row(t, t.id)
+            self._remove_transaction(t.id)
+            self._store_transaction(row)
+
+    def delete_transaction(self, t_id: int):
+        with self._lock:
+            self._remove_transaction(t_id)
+
+    def get_transaction(self, t_id: int) -> Optional[Transaction]:
+        with self._lock:
+            row = self._transactions.get(t_id)
+            return Transaction(**{k: row[k] for k in TRANSACTION_FIELDS}) if row else None
+
+    def get_last_year(self) -> Optional[int]:
+        with self._lock:
+            return max((year for _, year in self._by_taxpayer_year if year is not None), default=None)
+
+    def get_years(self) -> List[int]:
+        with self._lock:
+            years = {year for _, year in self._by_taxpayer_year}
+        # SQLite sorts NULL below every number, so it comes last in DESC order
+        return sorted((y for y in years if y is not None), reverse=True) + ([None] if None in years else [])
+
+    def _filtered_rows(self, filters: Dict) -> List[Dict]:
+        year, taxpayer_id = filters.get("year"), filters.get("taxpayer_id")
+        if year or taxpayer_id:
+            # Only the (taxpayer_id, year) buckets the filter can match are visited
+            ids = [t_id for (tp, y), bucket in self._by_taxpayer_year.items()
+                   if (not year or y == year) and (not taxpayer_id or tp == taxpayer_id) for t_id in bucket]
+            rows = [self._transactions[t_id] for t_id in ids]
+        else:
+            rows = self._transactions.values()
+        return [row for row in rows if _matches(row, **filters)]
+
+    def get_transactions(self, **filters) -> List[Dict]:
+        with self._lock:
+            rows = self._filtered_rows(filters)
+            taxpayers, sources, payment_methods = self._taxpayers, self._sources, self._payment_methods
+            documents, tax_items = self._documents, self._tax_items
+            result = []
+            for row in rows:
+                tp = taxpayers.get(row["taxpayer_id"])
+                s = sources.get(row["source_id"])
+                pm = payment_methods.get(row["payment_method_id"])
+                d = documents.get(row["document_id"])
+                ti = tax_items.get(row["tax_items_id"])
+                result.append(dict(row, taxpayer_name=tp.full_name if tp else None,
+                                   source_name=s.name if s else None, deduction_type=s.deduction_type if s else None,
+                                   method_name=pm.method_name if pm else None,
+                                   doc_ref=d.doc_ref if d else None, doc_name=d.display_name if d else None,
+                                   relative_path=d.relative_path if d else None,
+                                   tax_item_code=ti.code if ti else None, tax_item_name=ti.name if ti else None))
+        # Date (newest first), source id, id (newest first) like _transactions_query
+        result.sort(key=lambda r: (r["transaction_date"], -r["source_id"], r["id"]), reverse=True)
+        return result
+
+    def _rollup_rows(self, year=None, taxpayer_id=None):
+        """Yields rollup groups as dicts with the ROLLUP_KEYS columns, amount and count"""
+        for (tp, y), groups in self._rollup.items():
+            if (year and y != year) or (taxpayer_id and tp != taxpayer_id):
+                continue
+            for (month, source_id, tax_items_id, tx_type, is_taxable), (amount, count) in groups.items():
+                yield {"taxpayer_id": tp, "year": y, "month": month, "source_id": source_id,
+                       "tax_items_id": tax_items_id, "type": tx_type, "is_taxable": is_taxable,
+                       "amount": amount, "count": count}
+
+    def get_totals(self, **filters) -> Dict:
+        totals = {"count": 0, "income": 0.0, "expense": 0.0, "taxable": 0.0}
+        with self._lock:
+            for row in self._rollup_rows(filters.get("year"), filters.get("taxpayer_id")):
+                if not _matches(row, **filters):
+                    continue
+                totals["count"] += row["count"]
+                if row["type"] == TransactionType.INCOME:
+                    totals["income"] += row["amount"]
+                    if row["is_taxable"]:
+                        totals["taxable"] += row["amount"]
+                elif row["type"] == TransactionType.EXPENSE:
+                    totals["expense"] += row["amount"]
+        return totals
+
+    def get_taxable_totals(self, years: List[int], taxpayer_ids: Optional[List[int]] = None) -> List[Dict]:
+        sums: Dict[Tuple, float] = {}
+        with self._lock:
+            if taxpayer_ids is None:
+                wanted_years = set(years)
+                buckets = [key for key in self._rollup if key[1] in wanted_years]
+            else:
+                # Direct lookups instead of a scan over every (taxpayer_id, year) bucket
+                buckets = [(tp, y) for tp in set(taxpayer_ids) for y in set(years) if (tp, y) in self._rollup]
+            for tp, y in buckets:
+                groups = self._rollup[(tp, y)]
+                for (_, source_id, tax_items_id, tx_type, is_taxable), (amount, _) in groups.items():
+                    if is_taxable == 1:
+                        key = (tp, y, tx_type, source_id, tax_items_id)
+                        sums[key] = sums.get(key, 0.0) + amount
+            rows = []
+            for (tp, y, tx_type, source_id, tax_items_id), amount in sorted(sums.items()):
+                ti = self._tax_items.get(tax_items_id)
+                rows.append({"taxpayer_id": tp, "year": y, "type": tx_type, "source_id": source_id,
+                             "tax_item_code": ti.code if ti else None, "tax_item_name": ti.name if ti else None,
+                             "amount": amount})
+        return rows
+
+    def get_special_deductions(self, taxpayer_id: int, year: int) -> List[Dict]:
+        sums: Dict[str, float] = {}
+        with self._lock:
+            for (_, source_id, _, tx_type, _), (amount, _) in self._rollup.get((taxpayer_id, year), {}).items():
+                s = self._sources.get(source_id)
+                if tx_type == TransactionType.EXPENSE and s and s.deduction_type == 1:
+                    sums[s.name] = sums.get(s.name, 0.0) + amount
+        return [{"name": name, "amount": amount} for name, amount in sorted(sums.items())]
+
+    # Tax settings and declarations
+    def get_tax_setting(self, year: int) -> Optional[TaxSetting]:
+        with self._lock:
+            s = self._tax_settings.get(year)
+            return replace(s) if s else None
+
+    def save_tax_setting(self, s: TaxSetting):
+        # Same columns as the SQLite INSERT OR REPLACE, so exemption_limit goes back to its default
+        with self._lock:
+            self._tax_settings[s.year] = replace(s, exemption_limit=0.0)
+
+    def add_declaration(self, d: Declaration) -> int:
+        with self._lock:
+            dec_id = self._next_id("declarations", self._declarations)
+            self._declarations[dec_id] = replace(d, id=dec_id, created_at=_timestamp())
+            return dec_id
+
+    def add_declarations(self, declarations: List[Declaration], replace_drafts: bool = False) -> List[int]:
+        with self._lock:
+            if replace_drafts:
+                names = {(d.taxpayer_id, d.year, d.name) for d in declarations}
+                self._declarations = {i: d for i, d in self._declarations.items()
+                                      if d.status != "draft" or (d.taxpayer_id, d.year, d.name) not in names}
+            return [self.add_declaration(d) for d in declarations]
+
+    def get_declarations(self, taxpayer_id: int, year: int) -> List[Declaration]:
+        with self._lock:
+            return [replace(d) for _, d in sorted(self._declarations.items())
+                    if d.taxpayer_id == taxpayer_id and d.year == year]
+
+    def delete_declaration(self, dec_id: int):
+        with self._lock:
+            self._declarations.pop(dec_id, None)
+
+    def get_last_final_actual_year(self, taxpayer_id: int, first_year: int, last_year: int) -> Optional[int]:
+        with self._lock:
+            return max((d.year for d in self._declarations.values()
+                        if d.taxpayer_id == taxpayer_id and d.status == 'final' and d.expense_method == 'actual'
+                        and first_year <= d.year <= last_year), default=None)
+
+    def stats(self) -> Dict:
+        """Sizes of the stored tables and indexes"""
+        with self._lock:
+            return {"transactions": len(self._transactions), "taxpayer_years": len(self._by_taxpayer_year),
+                    "rollup_groups": sum(len(groups) for groups in self._rollup.values()),
+                    "declarations": len(self._declarations), "sources": len(self._sources)}
@@ -0,0 +1,391 @@
+"""Opt-in request, query and section metrics rendered in the Prometheus text format.
+
+Enabled with METRICS_ENABLED=1. Database connections are then created as
+InstrumentedConnection, whose cursors time every statement including the fetches and
+report it under a normalized fingerprint. api.py adds a middleware that times every route.
+SLOW_QUERY_LOG=<file> additionally writes a SlowQueryLog entry for every slow statement.
+"""
+import json
+import logging
+import logging.handlers
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Distinct fingerprints kept before new ones are folded into "other", keeps label cardinality bounded
+MAX_FINGERPRINTS = 500
+MAX_FINGERPRINT_LENGTH = 300
+
+logger = logging.getLogger("mtax.sql")
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE = re.compile(r"\s+")
+
+
+def fingerprint(sql: str) -> str:
+    """SQL with literals replaced by ? and IN lists collapsed, so each query shape is one series"""
+    text = _STRING.sub("?", sql)
+    text = _NUMBER.sub("?", text)
+    text = _IN_LIST.sub("(?...)", text)
+    text = _SPACE.sub(" ", text).strip()
+    return text[:MAX_FINGERPRINT_LENGTH]
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self) -> List[int]:
+        total, out = 0, []
+        for c in self.counts:
+            total += c
+            out.append(total)
+        return out
+
+
+def _labels(**labels) -> str:
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}" if labels else ""
+
+
+class MetricsRegistry:
+    """Thread-safe store of route, query and section timings plus the recent slow queries"""
+    def __init__(self, slow_query_ms: float = 200.0, keep_slow_queries: int = 50):
+        self.slow_query_ms = slow_query_ms
+        self._lock = threading.Lock()
+        self.requests: Dict[Tuple[str, str, int], Histogram] = {}
+        self.queries: Dict[str, Dict] = {}
+        self.sections: Dict[str, Histogram] = {}
+        self.slow_queries = deque(maxlen=keep_slow_queries)
+        self.slow_query_total = 0
+        # Called as hook(connection, sql, parameters, seconds) for every slow statement
+        self.slow_query_hook: Optional[Callable] = None
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float):
+        with self._lock:
+            key = (method, route, status)
+            hist = self.requests.get(key)
+            if hist is None:
+                hist = self.requests[key] = Histogram()
+            hist.observe(seconds)
+
+    def observe_query(self, sql: str, parameters, seconds: float, rows: int, connection=None):
+        fp = fingerprint(sql)
+        slow = seconds * 1000 >= self.slow_query_ms
+        with self._lock:
+            entry = self.queries.get(fp)
+            if entry is None:
+                if len(self.queries) >= MAX_FINGERPRINTS:
+                    fp = "other"
+                entry = self.queries.setdefault(fp, {"histogram": Histogram(), "rows": 0})
+            entry["histogram"].observe(seconds)
+            entry["rows"] += rows
+            if slow:
+                self.slow_query_total += 1
+                self.slow_queries.append({"fingerprint": fp, "ms": round(seconds * 1000, 2), "rows": rows,
+                                          "at": time.strftime("%Y-%m-%dT%H:%M:%S")})
+        if slow:
+            logger.warning("Slow query %.1f ms, %d rows: %s", seconds * 1000, rows, fp)
+            if self.slow_query_hook:
+                self.slow_query_hook(connection, sql, parameters, seconds)
+
+    def observe_section(self, name: str, seconds: float):
+        with self._lock:
+            hist = self.sections.get(name)
+            if hist is None:
+                hist = self.sections[name] = Histogram()
+            hist.observe(seconds)
+
+    @contextmanager
+    def section(self, name: str):
+        """Times a block of Python work, e.g. row-to-dict conversion or the tax computation"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_section(name, time.perf_counter() - started)
+
+    def render(self) -> str:
+        """Prometheus text exposition of the recorded histograms and counters"""
+        lines = []
+
+        def histogram(name: str, help_text: str, series):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, hist in series:
+                for bound, total in zip(hist.buckets, hist.cumulative()):
+                    lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {total}")
+                lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {hist.count}")
+                lines.append(f"{name}_sum{_labels(**labels)} {hist.sum}")
+                lines.append(f"{name}_count{_labels(**labels)} {hist.count}")
+
+        with self._lock:
+            histogram("mtax_http_request_duration_seconds", "API request latency by route",
+                      [({"method": m, "route": r, "status": s}, h) for (m, r, s), h in sorted(self.requests.items())])
+            histogram("mtax_db_query_duration_seconds", "SQL statement time including fetches, by fingerprint",
+                      [({"query": fp}, e["histogram"]) for fp, e in sorted(self.queries.items())])
+            lines.append("# HELP mtax_db_query_rows_total Rows returned or changed, by fingerprint")
+            lines.append("# TYPE mtax_db_query_rows_total counter")
+            for fp, e in sorted(self.queries.items()):
+                lines.append(f"mtax_db_query_rows_total{_labels(query=fp)} {e['rows']}")
+            lines.append("# HELP mtax_db_slow_queries_total Statements slower than the slow query threshold")
+            lines.append("# TYPE mtax_db_slow_queries_total counter")
+            lines.append(f"mtax_db_slow_queries_total {self.slow_query_total}")
+            histogram("mtax_section_duration_seconds", "Python work outside SQL, by section",
+                      [({"section": n}, h) for n, h in sorted(self.sections.items())])
+        return "\n".join(lines) + "\n"
+
+
+def render_stats(pool_stats: Dict[str, Dict], cache_stats: Dict) -> str:
+    """Connection pool, executor, reference cache and calculation cache statistics as Prometheus metrics"""
+    metrics: Dict[str, Tuple[str, str, List]] = {}
+
+    def add(name: str, kind: str, help_text: str, value, **labels):
+        metrics.setdefault(name, (kind, help_text, []))[2].append((labels, value))
+
+    for pool, stats in pool_stats.items():
+        if pool == "executor":
+            for key, value in stats.items():
+                add(f"mtax_db_executor_{key}", "gauge", f"Database executor {key.replace('_', ' ')}", value)
+            continue
+        for key, value in stats.items():
+            add(f"mtax_db_pool_{key}", "gauge", f"Connection pool {key.replace('_', ' ')}", value, pool=pool)
+    add("mtax_cache_hits_total", "counter", "Reference cache hits", cache_stats["hits"])
+    add("mtax_cache_misses_total", "counter", "Reference cache misses", cache_stats["misses"])
+    add("mtax_cache_entries", "gauge", "Reference cache entries", cache_stats["entries"])
+    for entity, version in cache_stats["versions"].items():
+        add("mtax_cache_version", "gauge", "Reference data version by entity", version, entity=entity)
+    calculations = cache_stats["calculations"]
+    add("mtax_calculation_cache_hits_total", "counter", "Declaration calculation cache hits", calculations["hits"])
+    add("mtax_calculation_cache_misses_total", "counter", "Declaration calculation cache misses", calculations["misses"])
+    add("mtax_calculation_cache_evictions_total", "counter", "Declaration calculation cache evictions", calculations["evictions"])
+    add("mtax_calculation_cache_entries", "gauge", "Declaration calculation cache entries", calculations["entries"])
+    add("mtax_calculation_cache_bytes", "gauge", "Approximate size of the cached calculation results", calculations["bytes"])
+
+    lines = []
+    for name, (kind, help_text, series) in metrics.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in series:
+            lines.append(f"{name}{_labels(**labels)} {float(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def redact(parameters) -> Any:
+    """Keeps integers (ids, years, months, flags) and hides amounts and free text"""
+    def one(value):
+        if value is None or isinstance(value, (bool, int)):
+            return value
+        if isinstance(value, float):
+            return "<float>"
+        if isinstance(value, (str, bytes)):
+            return f"<{type(value).__name__} len={len(value)}>"
+        return f"<{type(value).__name__}>"
+    if parameters is None:
+        return None
+    if isinstance(parameters, dict):
+        return {k: one(v) for k, v in parameters.items()}
+    return [one(v) for v in parameters]
+
+
+class SlowQueryLog:
+    """Diagnostic record of every slow statement: full SQL, redacted parameters, elapsed time,
+    the calling service method and its EXPLAIN QUERY PLAN, written as JSON lines to a rotating file.
+    """
+    def __init__(self, path: Optional[str] = None, max_bytes: int = 10 * 1024 * 1024, backups: int = 5,
+                 keep: int = 100, is_caller: Optional[Callable[[Any], bool]] = None):
+        self.path = path
+        self.recent = deque(maxlen=keep)
+        # Decides which `self` on the call stack is reported as the caller, e.g. service instances
+        self.is_caller = is_caller or (lambda obj: False)
+        self._logger = None
+        if path:
+            self._logger = logging.getLogger(f"mtax.slow_query.{id(self)}")
+            self._logger.propagate = False
+            self._logger.setLevel(logging.INFO)
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                                           encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger.addHandler(handler)
+
+    def caller(self) -> Optional[str]:
+        frame = sys._getframe(1)
+        while frame:
+            obj = frame.f_locals.get("self")
+            if obj is not None and self.is_caller(obj):
+                return f"{type(obj).__name__}.{frame.f_code.co_name}"
+            frame = frame.f_back
+        return None
+
+    @staticmethod
+    def explain(connection, sql: str, parameters) -> List[str]:
+        if connection is None or (parameters is None and "?" in sql):
+            return []  # executemany: there is no single parameter set to plan with
+        try:
+            # A plain cursor, so the EXPLAIN itself is not instrumented
+            cursor = connection.cursor(sqlite3.Cursor)
+            rows = cursor.execute("EXPLAIN QUERY PLAN " + sql, parameters or ()).fetchall()
+        except sqlite3.Error as e:
+            return [f"EXPLAIN failed: {e}"]
+        return [row[3] for row in rows]
+
+    def record(self, connection, sql: str, parameters, seconds: float) -> Dict:
+        entry = {
+            "at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "ms": round(seconds * 1000, 2),
+            "caller": self.caller(),
+            "sql": " ".join(sql.split()),
+            "params": redact(parameters),
+            "plan": self.explain(connection, sql, parameters),
+        }
+        self.recent.append(entry)
+        if self._logger:
+            self._logger.info(json.dumps(entry, ensure_ascii=False))
+        return entry
+
+    def close(self):
+        if self._logger:
+            for handler in list(self._logger.handlers):
+                handler.close()
+                self._logger.removeHandler(handler)
+
+
+class _Statement:
+    """Timing of one statement, kept by its connection until the statement is reported"""
+    __slots__ = ("sql", "parameters", "rows", "elapsed")
+
+    def __init__(self, sql: str, parameters):
+        self.sql, self.parameters, self.rows, self.elapsed = sql, parameters, 0, 0.0
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that reports each statement once it is done: exhausted, re-executed, closed or released.
+    A statement left unfinished, e.g. by a single fetchone(), is reported by its connection's
+    finish_statements() instead of at garbage collection, which may run on another thread after
+    the connection went back to its pool."""
+    _statement: Optional[_Statement] = None
+
+    def _begin(self, sql: str, parameters):
+        self._finish()
+        self._statement = _Statement(sql, parameters)
+        self.connection._pending.add(self._statement)
+
+    def _finish(self):
+        statement, self._statement = self._statement, None
+        if statement is None or statement.sql is None:
+            return
+        if self.description is None:
+            statement.rows = max(self.rowcount, 0)
+        self.connection._report(statement)
+
+    def _timed(self, call, *args):
+        started = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            if self._statement is not None:
+                self._statement.elapsed += time.perf_counter() - started
+
+    def _fetched(self, rows: int):
+        if self._statement is not None:
+            self._statement.rows += rows
+
+    def execute(self, sql, parameters=()):
+        self._begin(sql, parameters)
+        result = self._timed(super().execute, sql, parameters)
+        if self.description is None:
+            self._finish()  # No rows to fetch, the statement is done
+        return result
+
+    def executemany(self, sql, seq_of_parameters):
+        self._begin(sql, None)
+        result = self._timed(super().executemany, sql, seq_of_parameters)
+        self._finish()
+        return result
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._finish()
+        else:
+            self._fetched(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed(super().fetchmany, self.arraysize if size is None else size)
+        self._fetched(len(rows))
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._fetched(len(rows))
+        self._finish()
+        return rows
+
+    def __next__(self):
+        try:
+            row = self._timed(super().__next__)
+        except StopIteration:
+            self._finish()
+            raise
+        self._fetched(1)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    registry: Optional[MetricsRegistry] = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending = set()  # _Statement of cursors not yet exhausted or closed
+
+    def _report(self, statement: _Statement):
+        self._pending.discard(statement)
+        sql, statement.sql = statement.sql, None
+        if self.registry:
+            self.registry.observe_query(sql, statement.parameters, statement.elapsed, statement.rows, self)
+
+    def finish_statements(self):
+        """Reports the statements still pending on this connection. Called by the thread that owns
+        the connection, before it goes back to its pool."""
+        for statement in list(self._pending):
+            self._report(statement)
+
+    def close(self):
+        self.finish_statements()
+        super().close()
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
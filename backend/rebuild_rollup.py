@@ -0,0 +1,41 @@
+"""Rebuilds or verifies the transaction_rollup aggregate table and the transaction_search index.
+
+TransactionService keeps both current on every insert, update and delete. Rebuild them after
+restoring a backup or writing to the transactions table outside of TransactionService.
+
+    python rebuild_rollup.py                        # database from DB_PATH
+    python rebuild_rollup.py personal_finance.db
+    python rebuild_rollup.py personal_finance.db --verify
+"""
+import argparse
+import sys
+
+from core import DB_NAME, Database
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("db", nargs="?", default=DB_NAME)
+    parser.add_argument("--verify", action="store_true", help="Only report groups that are out of sync")
+    args = parser.parse_args(argv[1:])
+
+    db = Database(args.db)
+    db.init_db()
+    try:
+        if args.verify:
+            drift = db.verify_rollup()
+            for row in drift:
+                print(f"OUT OF SYNC {row}")
+            print(f"{len(drift)} rollup groups out of sync")
+            return 1 if drift else 0
+        groups = db.rebuild_rollup()
+        print(f"Rebuilt transaction_rollup: {groups} groups")
+        rows = db.rebuild_search_index()
+        print(f"Rebuilt transaction_search: {rows} rows")
+        return 0
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,6 +1,6 @@
 import { Injectable } from '@angular/core';
 import { HttpClient } from '@angular/common/http';
-import { Observable } from 'rxjs';
+import { Observable, map } from 'rxjs';
 
 export interface Taxpayer {
     id: number;
@@ -60,9 +60,67 @@ export interface Summary {
     net_income: number;
 }
 
+export interface PageInfo {
+    limit: number;
+    sort: 'date_desc' | 'date_asc' | 'amount_desc' | 'amount_asc';
+    total: number;
+    next_cursor: string | null;
+    prev_cursor: string | null;
+}
+
+// `shape=columnar` layout: column names once, then one value array per row
+export interface ColumnarRows {
+    columns: string[];
+    rows: any[][];
+}
+
+export interface ColumnarDashboardData {
+    transactions: ColumnarRows;
+    summary: Summary;
+    page?: PageInfo;
+}
+
+export function fromColumnar<T>(data: ColumnarRows): T[] {
+    const { columns, rows } = data;
+    return rows.map(row => {
+        const obj: any = {};
+        for (let i = 0; i < columns.length; i++) obj[columns[i]] = row[i];
+        return obj as T;
+    });
+}
+
 export interface DashboardData {
     transactions: Transaction[];
     summary: Summary;
+    page?: PageInfo; // Only present when `limit` or `cursor` is sent
+}
+
+export interface SearchResult {
+    transactions: (Transaction & { score: number })[];
+    page: { limit: number; offset: number; total: number };
+}
+
+export type AnalyticsGroup = 'year' | 'month' | 'taxpayer_id' | 'source_id' | 'tax_items_id' | 'payment_method_id';
+
+export interface AnalyticsPoint {
+    year?: number;
+    month?: number;
+    taxpayer_id?: number;
+    source_id?: number;
+    tax_items_id?: number;
+    payment_method_id?: number;
+    count: number;
+    total_income: number;
+    total_expense: number;
+    taxable_income: number;
+    net_income: number;
+}
+
+export interface Analytics {
+    group_by: AnalyticsGroup[];
+    years: number[];
+    series: AnalyticsPoint[];
+    totals: Summary & { count: number };
 }
 
 export interface TaxSetting {
@@ -127,7 +185,18 @@ export class ApiService {
     }
 
     getDashboard(params: any): Observable<DashboardData> {
-        return this.http.get<DashboardData>(`${this.apiUrl}/transactions`, { params });
+        // Columnar payload is about half the size and parses faster for long transaction lists
+        return this.http.get<ColumnarDashboardData>(`${this.apiUrl}/transactions`, { params: { ...params, shape: 'columnar' } }).pipe(
+            map(data => ({ ...data, transactions: fromColumnar<Transaction>(data.transactions) }))
+        );
+    }
+
+    searchTransactions(q: string, params: any = {}): Observable<SearchResult> {
+        return this.http.get<SearchResult>(`${this.apiUrl}/transactions/search`, { params: { ...params, q } });
+    }
+
+    getAnalytics(groupBy: AnalyticsGroup[], years: number[] = [], params: any = {}): Observable<Analytics> {
+        return this.http.get<Analytics>(`${this.apiUrl}/analytics`, { params: { ...params, group_by: groupBy, years } });
     }
 
     getTransaction(id: number): Observable<Transaction> {